@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Stand-in for a package mirror and the AUR, for benchmarking and testing the
+# prefetch stage without a network.  Serves synthetic package and source
+# files of a configured size, at a configured latency and per-connection
+# bandwidth; the files of a directory (run_bench.py puts AUR git repositories
+# prepared for git's dumb HTTP transport there); the AUR RPC info endpoint
+# for the packages in its config; and a keyserver's HKP lookup, answered with
+# a stand-in key for any key ID.
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.parse
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class mirrorhandler(BaseHTTPRequestHandler):
+    def log_message(self,format,*args):
+        pass
+    def send(self,body,size=None):
+        # body is bytes, or None for size synthetic bytes.
+        config=self.server.config
+        time.sleep(config.get('latency',0))
+        size=len(body) if body is not None else size
+        self.send_response(200)
+        self.send_header('Content-Length',str(size))
+        self.end_headers()
+        bandwidth=config.get('bandwidth',0)
+        chunk=65536
+        sent=0
+        start=time.time()
+        while sent<size:
+            n=min(chunk,size-sent)
+            self.wfile.write(body[sent:sent+n] if body is not None else b'\0'*n)
+            sent+=n
+            if bandwidth:
+                ahead=sent/bandwidth-(time.time()-start)
+                if ahead>0:
+                    time.sleep(ahead)
+        with self.server.lock:
+            self.server.stats['requests']+=1
+            self.server.stats['bytes']+=size
+    def do_GET(self):
+        config=self.server.config
+        url=urllib.parse.urlparse(self.path)
+        path=urllib.parse.unquote(url.path)
+        local=(self.server.directory/path.lstrip('/')).resolve()
+        if path.startswith('/rpc/'):
+            names=urllib.parse.parse_qs(url.query).get('arg[]',[])
+            results=[config['aur'][n] for n in names if n in config.get('aur',{})]
+            self.send(json.dumps({'results':results}).encode())
+        elif path=='/pks/lookup':
+            key=urllib.parse.parse_qs(url.query).get('search',[''])[0]
+            key=key[2:] if key.startswith('0x') else key
+            self.send(f'-----BEGIN PGP PUBLIC KEY BLOCK-----\nComment: bench key {key.upper()}\n\n-----END PGP PUBLIC KEY BLOCK-----\n'.encode())
+        elif local.is_file() and str(local).startswith(str(self.server.directory.resolve())):
+            with open(local,'rb') as f:
+                self.send(f.read())
+        elif '.pkg.tar' in path or path.startswith('/src/'):
+            self.send(None,config.get('size',0))
+        else:
+            self.send_error(404)
+
+def serve(directory,config,port=0):
+    # Starts the mirror on a background thread; returns the server and its URL.
+    server=ThreadingHTTPServer(('127.0.0.1',port),mirrorhandler)
+    server.daemon_threads=True
+    server.directory=Path(directory)
+    server.config=config
+    server.lock=threading.Lock()
+    server.stats={'requests':0,'bytes':0}
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server,f'http://127.0.0.1:{server.server_address[1]}'
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Serve a stand-in package mirror and AUR.')
+    parser.add_argument('directory',help='directory whose files are served as they are')
+    parser.add_argument('--port',type=int,default=8080)
+    parser.add_argument('--size',type=int,default=1<<20,help='bytes per synthetic package or source file')
+    parser.add_argument('--latency',type=float,default=0.0,help='seconds before each response')
+    parser.add_argument('--bandwidth',type=int,default=0,help='bytes per second per connection (0: unlimited)')
+    parser.add_argument('--aur',help='JSON file of AUR RPC results by package name')
+    args = parser.parse_args()
+    aur={}
+    if args.aur:
+        with open(args.aur,'r') as f:
+            aur=json.load(f)
+    server,url=serve(args.directory,{'size':args.size,'latency':args.latency,'bandwidth':args.bandwidth,'aur':aur},args.port)
+    print(f'Serving {args.directory} at {url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sys.exit(0)
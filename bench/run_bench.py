@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Offline benchmark of the build orchestrator.  Runs the real stages of
+# build_image.py in a scratch directory, against a synthetic packages.txt,
+# with every external command (zfs, arch-chroot, pacstrap, pacman, trizen,
+# ssh, rsync, mount, ...) replaced by bench/shim.py.  Reports end-to-end time,
+# the time spent in the stand-ins' simulated latency, the orchestration
+# overhead on top of it, subprocess counts and the builder's peak memory.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import traceback
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+
+here = Path(__file__).resolve().parent
+sys.path.insert(0,str(here))
+import mirror
+repo = here.parent
+commands = ['zfs','arch-chroot','chroot','unshare','pacstrap','pacman','trizen','ssh','rsync','mount','umount','repo-add','mksquashfs','mkfs.erofs']
+
+def synthetic_packages(args):
+    # Repository packages, groups and AUR packages in the proportions asked
+    # for; returns packages.txt lines, the sync package list and the groups.
+    lines=[]
+    repo_names=[]
+    groups={}
+    for n in range(args.packages):
+        if n%100 < args.group_percent:
+            g=f'group{n}'
+            groups[g]=[f'{g}-member{m}' for m in range(args.group_size)]
+            repo_names.extend(groups[g])
+            lines.append(f'g:{g}')
+        elif n%100 < args.group_percent+args.aur_percent:
+            lines.append(f'aurpkg{n}')
+        else:
+            repo_names.append(f'pkg{n}')
+            lines.append(f'pkg{n}')
+    return lines,repo_names,groups
+
+def aur_repositories(names,work,url):
+    # A git repository per AUR package, served over git's dumb HTTP transport
+    # by the mirror, with a .SRCINFO listing one source file on the mirror.
+    for name in names:
+        src=work/'aur-src'/name
+        os.makedirs(src)
+        with open(src/'.SRCINFO','w') as f:
+            f.write(f'pkgbase = {name}\n\tpkgver = 1.0\n\tpkgrel = 1\n\tsource = {url}/src/{name}-1.0.tar.gz\n\npkgname = {name}\n')
+        with open(src/'PKGBUILD','w') as f:
+            f.write(f'pkgname={name}\npkgver=1.0\npkgrel=1\narch=(any)\nsource=({url}/src/{name}-1.0.tar.gz)\n')
+        git=['git','-c','user.name=bench','-c','user.email=bench@localhost','-c','init.defaultBranch=master']
+        subprocess.run(git+['init','-q',str(src)],check=True)
+        subprocess.run(git+['-C',str(src),'add','-A'],check=True)
+        subprocess.run(git+['-C',str(src),'commit','-qm',name],check=True)
+        subprocess.run(git+['clone','-q','--bare',str(src),str(work/'mirror'/f'{name}.git')],check=True)
+        subprocess.run(git+['-C',str(work/'mirror'/f'{name}.git'),'update-server-info'],check=True)
+
+def setup(args,work,server,url):
+    for f in ['pacman.conf','mkinitcpio.conf','fstab','sudoers-nopass','makepkg1.conf','trizen.conf','keys.txt','slim.txt']:
+        shutil.copy(repo/f,work/f)
+    shutil.copytree(repo/'root_files',work/'root_files')
+    shutil.copytree(repo/'initcpio',work/'initcpio')
+    (work/'zpool.cache').touch()
+    os.makedirs(work/'packages')
+    for f in ['overlayroot-0.2-2-any.pkg.tar.zst','E01-early-1-1-any.pkg.tar.zst','L01-late-1-1-any.pkg.tar.zst']:
+        (work/'packages'/f).touch()
+    lines,repo_names,groups=synthetic_packages(args)
+    os.makedirs(work/'mirror')
+    if args.aur_git:
+        aur=[l for l in lines if l.startswith('aurpkg')]
+        aur_repositories(aur,work,url)
+        server.config['aur']={n:{'Name':n,'PackageBase':n,'Version':'1.0-1'} for n in aur}
+    with open(work/'packages.txt','w') as f:
+        f.write('\n'.join(lines)+'\n')
+    with open(work/'build_config.py','w') as f:
+        f.write(f"""NAS_USER='bench'
+NAS_IP='127.0.0.1'
+NAS_IMAGE_PATH='{work}/nas'
+ZFS_NAS_IMAGE_PATH='bench/nas'
+ROOT_PASSWORD='bench'
+INNER_USER='bench'
+INNER_PASSWORD='bench'
+ZFS_CWD='bench'
+PACKAGE_BATCH={args.batch}
+CHROOT_SESSION={args.session}
+AUR_URL='{url}'
+KEYSERVER='{url}'
+""")
+        for setting in args.config:
+            f.write(setting+'\n')
+    latency={'default':args.latency}
+    lines_out={'default':args.output_lines}
+    for spec in args.set_latency:
+        name,value=spec.split('=')
+        latency[name]=float(value)
+    for spec in args.set_output:
+        name,value=spec.split('=')
+        lines_out[name]=int(value)
+    fail={}
+    for spec in args.fail:
+        pattern,rate=spec.rsplit('=',1)
+        fail[pattern]=float(rate)
+    with open(work/'shim.json','w') as f:
+        json.dump({'root':str(work/'.install'),'latency':latency,'output_lines':lines_out,
+                   'fail':fail,'repo':repo_names,'groups':groups,
+                   'mirror':url,'pkgcache':str(work/'.cache/pkg'),'size':args.mirror_size*1024},f)
+    os.makedirs(work/'bin')
+    for c in commands:
+        os.symlink(here/'shim.py',work/'bin'/c)
+
+def child(args):
+    # Runs in the scratch directory, with the stand-ins first on PATH.
+    sys.path.insert(0,os.getcwd())
+    sys.path.insert(0,str(repo))
+    import build_image
+    start=time.time()
+    error=None
+    try:
+        build_image.run_build(build_image.stageFinish,jobs=args.jobs)
+    except BaseException as e:
+        traceback.print_exc()
+        error=repr(e)
+    result={'wall':time.time()-start,'maxrss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,'error':error}
+    with open('result.json','w') as f:
+        json.dump(result,f)
+
+def report(args,work,server):
+    with open(work/'result.json','r') as f:
+        result=json.load(f)
+    calls=[]
+    with open(work/'calls.jsonl','r') as f:
+        for line in f:
+            calls.append(json.loads(line))
+    sleep=sum(c['sleep'] for c in calls)
+    shim=sum(c['wall'] for c in calls)
+    counts={}
+    for c in calls:
+        counts[c['cmd']]=counts.get(c['cmd'],0)+1
+    summary={
+        'packages':args.packages,
+        'jobs':args.jobs,
+        'batch':args.batch,
+        'session':args.session,
+        'wall':round(result['wall'],3),
+        'simulated_latency':round(sleep,3),
+        'overhead':round(result['wall']-sleep,3),
+        'stand_in_wall':round(shim,3),
+        'subprocesses':len(calls),
+        'failed_subprocesses':sum(1 for c in calls if c['rc']),
+        'peak_rss_kib':result['maxrss'],
+        'mirror_requests':server.stats['requests'],
+        'mirror_bytes':server.stats['bytes'],
+        'counts':counts,
+        'error':result['error'],
+    }
+    if args.json:
+        print(json.dumps(summary,indent=1))
+        return
+    print(f"packages {args.packages}, jobs {args.jobs}, batch {args.batch}, session {args.session}")
+    print(f"    end to end          {summary['wall']:10.3f} s")
+    print(f"    simulated latency   {summary['simulated_latency']:10.3f} s")
+    print(f"    overhead            {summary['overhead']:10.3f} s  (end to end minus simulated latency)")
+    print(f"    subprocesses        {summary['subprocesses']:10d}  ({summary['failed_subprocesses']} failed)")
+    print(f"    peak RSS            {summary['peak_rss_kib']/1024:10.1f} MiB")
+    print(f"    mirror              {summary['mirror_requests']:10d}  requests, {summary['mirror_bytes']/2**20:.1f} MiB")
+    for c,n in sorted(counts.items(),key=lambda i: -i[1]):
+        print(f"        {c:12s} {n:8d}")
+    if result['error']:
+        print(f"    build failed: {result['error']}")
+
+def arguments():
+    parser = argparse.ArgumentParser(description='Benchmark build_image.py against stand-in commands.')
+    parser.add_argument('--packages',type=int,default=500,help='entries in the synthetic packages.txt')
+    parser.add_argument('--group-percent',type=int,default=5,help='percentage of entries that are groups')
+    parser.add_argument('--group-size',type=int,default=10,help='packages per group')
+    parser.add_argument('--aur-percent',type=int,default=10,help='percentage of entries that are AUR packages')
+    parser.add_argument('--jobs',type=int,default=1,help='passed to run_build')
+    parser.add_argument('--batch',type=lambda v: v.lower() in ('1','true','yes'),default=True,help='PACKAGE_BATCH')
+    parser.add_argument('--session',type=lambda v: v.lower() in ('1','true','yes'),default=True,help='CHROOT_SESSION')
+    parser.add_argument('--latency',type=float,default=0.0,help='default stand-in latency in seconds')
+    parser.add_argument('--set-latency',action='append',default=[],metavar='CMD=SECONDS',help='latency of one command')
+    parser.add_argument('--output-lines',type=int,default=2,help='default lines printed per stand-in call')
+    parser.add_argument('--set-output',action='append',default=[],metavar='CMD=LINES',help='output lines of one command')
+    parser.add_argument('--config',action='append',default=[],metavar='NAME=VALUE',help='extra build_config.py setting (a Python assignment)')
+    parser.add_argument('--fail',action='append',default=[],metavar='PATTERN=RATE',help='fail calls containing PATTERN with probability RATE')
+    parser.add_argument('--mirror-size',type=int,default=256,help='KiB per package or source file served by the mirror stand-in')
+    parser.add_argument('--mirror-latency',type=float,default=0.0,help='seconds before each mirror response')
+    parser.add_argument('--mirror-bandwidth',type=int,default=0,help='KiB/s per mirror connection (0: unlimited)')
+    parser.add_argument('--aur-git',action='store_true',help='serve a git repository and source file for every AUR package')
+    parser.add_argument('--workdir',help='scratch directory to use (kept afterwards)')
+    parser.add_argument('--json',action='store_true',help='print the results as JSON')
+    parser.add_argument('--child',action='store_true',help=argparse.SUPPRESS)
+    return parser
+
+if __name__=="__main__":
+    args = arguments().parse_args()
+    if args.child:
+        child(args)
+        sys.exit(0)
+    work=Path(args.workdir or tempfile.mkdtemp(prefix='netboot-bench-')).resolve()
+    os.makedirs(work,exist_ok=True)
+    server,url=mirror.serve(work/'mirror',{'size':args.mirror_size*1024,'latency':args.mirror_latency,'bandwidth':args.mirror_bandwidth*1024})
+    setup(args,work,server,url)
+    env=dict(os.environ,BENCH_DIR=str(work),PATH=f"{work/'bin'}:{os.environ['PATH']}")
+    with open(work/'build.log','w') as log:
+        subprocess.run([sys.executable,__file__,'--child']+sys.argv[1:],cwd=work,env=env,stdout=log,stderr=subprocess.STDOUT)
+    report(args,work,server)
+    if not args.workdir:
+        shutil.rmtree(work)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# Stand-in for the external commands build_image.py runs (zfs, arch-chroot,
+# pacstrap, pacman, trizen, ssh, rsync, mksquashfs, ...).  run_bench.py links
+# it onto PATH under each command's name.  It sleeps for the configured
+# latency, prints the configured number of output lines, fails when told to,
+# and emulates just enough of each command (directories created in the
+# target, packages installed, groups and sync package lists, a sync database
+# and mirrorlist, a keyring, ZFS datasets and snapshots as directories and
+# copies, images written) for the real stages to run.
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import shutil
+import tarfile
+import io
+import urllib.request
+from pathlib import Path
+
+start = time.time()
+bench = Path(os.environ['BENCH_DIR'])
+with open(bench/'shim.json','r') as f:
+    config = json.load(f)
+root = Path(config['root'])
+name = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+
+def setting(key,command):
+    values = config[key]
+    return values.get(command,values['default'])
+
+def inner_command(args):
+    # The command run inside a chroot: 'bash -c CMD', or whatever follows the
+    # chroot directory.
+    if 'bash' in args and '-c' in args:
+        return args[args.index('-c')+1]
+    i = args.index('chroot')+1 if name=='unshare' else 0
+    while i<len(args) and args[i].startswith('-'):
+        i += 1
+    return ' '.join(shlex.quote(a) for a in args[i+1:])
+
+def installed():
+    local = root/'var/lib/pacman/local'
+    return {d.rsplit('-',2)[0] for d in os.listdir(local)} if local.is_dir() else set()
+
+def install(packages):
+    for p in packages:
+        os.makedirs(root/'var/lib/pacman/local'/f'{p}-1.0-1',exist_ok=True)
+        with open(root/'var/lib/pacman/local'/f'{p}-1.0-1'/'desc','w') as f:
+            f.write(f'%NAME%\n{p}\n\n%VERSION%\n1.0-1\n\n')
+
+def package_file(p):
+    return f'{p}-1.0-1-x86_64.pkg.tar.zst'
+
+def download(packages):
+    # As pacman does without a prefetch: the packages missing from the cache,
+    # one after another, from the stand-in mirror.
+    if not config.get('mirror'):
+        return
+    cache = Path(config['pkgcache'])
+    os.makedirs(cache,exist_ok=True)
+    for p in packages:
+        f = cache/package_file(p)
+        if f.exists():
+            continue
+        with urllib.request.urlopen(f"{config['mirror']}/{f.name}",timeout=60) as r:
+            data = r.read()
+        with open(f'{f}.part','wb') as out:
+            out.write(data)
+        os.replace(f'{f}.part',f)
+
+def pacman(words,out):
+    # Returns an exit code; handles the queries and installs the stages make.
+    ops = [w for w in words if w.startswith('-') and not w.startswith('--')]
+    targets = [w for w in words if not w.startswith('-') and '/' not in w and w not in ('pacman','trizen','sudo','-u','env')]
+    op = ''.join(o.lstrip('-') for o in ops)
+    if op.startswith('Q'):
+        if 'q' in op and not targets:
+            out.extend(sorted(installed()))
+            return 0
+        return 0 if set(targets)<=installed() else 1
+    if op.startswith('S') and 'l' in op:
+        out.extend(config['repo'])
+        return 0
+    if op.startswith('S') and 'p' in op:
+        names = []
+        for t in targets:
+            if t in config['groups']:
+                names.extend(config['groups'][t])
+            elif t in config['repo']:
+                names.append(t)
+            else:
+                sys.stderr.write(f'error: target not found: {t}\n')
+                return 1
+        out.extend(f"{config.get('mirror','http://mirror.invalid')}/{package_file(n)}" for n in names if n not in installed())
+        return 0
+    if op.startswith('S') and 'g' in op:
+        for g in targets:
+            out.extend(f'{g} {p}' for p in config['groups'].get(g,[]))
+        return 0 if all(g in config['groups'] for g in targets) else 1
+    if op.startswith('S') and 'trizen' not in words and name!='trizen':
+        download(t for t in targets if t not in installed())
+    if op.startswith('S') or op.startswith('U'):
+        install(t for t in targets if not t.endswith('.zst'))
+    return 0
+
+def emulate(cmd,out):
+    rc = 0
+    for part in cmd.replace('&&',';').split(';'):
+        try:
+            words = shlex.split(part.split('|')[0].split('>')[0])
+        except ValueError:
+            continue
+        while words and words[0] in ('sudo','-u','env') or (words and '=' in words[0]):
+            words = words[2:] if words[0]=='-u' else words[1:]
+        if not words:
+            continue
+        if words[0]=='mkdir':
+            for w in words[1:]:
+                if not w.startswith('-'):
+                    os.makedirs(root/w.lstrip('/'),exist_ok=True)
+        elif words[0] in ('pacman','trizen'):
+            rc = rc or pacman(words,out)
+        elif words[0]=='gpg':
+            # The keyring is the IDs of the stand-in keys imported.
+            keyring = root/'.bench-gpg'
+            keys = keyring.read_text().split() if keyring.exists() else []
+            if '--import' in words:
+                with open(root/words[-1].lstrip('/'),'r') as f:
+                    keys += [l.split()[-1] for l in f if l.startswith('Comment: bench key')]
+                keyring.write_text('\n'.join(keys)+'\n')
+            elif '--list-keys' in words:
+                out.extend(f'pub:-:4096:1:{k}::::::scESC:' for k in keys)
+        elif words[0]=='mkinitcpio' and '-g' in words:
+            with open(root/words[words.index('-g')+1].lstrip('/'),'wb') as f:
+                f.write(os.urandom(1<<20))
+    return rc
+
+def pacstrap():
+    for d in ['etc/zfs','boot','usr/lib/modules/6.0.0-bench','etc/modules-load.d','usr/bin','usr/lib/initcpio/hooks','usr/lib/initcpio/install',
+              'var/lib/pacman/local','var/lib/pacman/sync','var/cache/pacman/pkg','home','tmp','run','proc','sys','dev']:
+        os.makedirs(root/d,exist_ok=True)
+    (root/'usr/bin/bash').touch()
+    with open(root/'usr/lib/modules/6.0.0-bench/pkgbase','w') as f:
+        f.write('linux\n')
+    sync_db()
+    install(a for a in args if not a.startswith('-') and '/' not in a)
+
+def sync_db():
+    # A core.db with the synthetic repository packages and groups, served by
+    # the stand-in mirror, as pacstrap leaves them after its -Sy.
+    groups = {p:g for g,members in config['groups'].items() for p in members}
+    with tarfile.open(root/'var/lib/pacman/sync/core.db','w:gz') as tar:
+        for p in config['repo']:
+            desc = f'%FILENAME%\n{package_file(p)}\n\n%NAME%\n{p}\n\n%VERSION%\n1.0-1\n\n%CSIZE%\n{config.get("size",0)}\n\n'
+            if p in groups:
+                desc += f'%GROUPS%\n{groups[p]}\n\n'
+            data = desc.encode()
+            info = tarfile.TarInfo(f'{p}-1.0-1/desc')
+            info.size = len(data)
+            tar.addfile(info,io.BytesIO(data))
+    os.makedirs(root/'etc/pacman.d',exist_ok=True)
+    with open(root/'etc/pacman.d/mirrorlist','w') as f:
+        f.write(f"Server = {config.get('mirror','http://mirror.invalid')}/$repo/os/$arch\n")
+
+def dataset_path(ds):
+    # Datasets of the 'bench' pool live under the scratch directory, as the
+    # pool's mountpoints would; snapshots are copies kept in snapshots/.
+    if not ds.startswith('bench/') or '..' in ds:
+        sys.exit(f'zfs: dataset {ds!r} is not in the bench pool')
+    return bench/ds[len('bench/'):]
+
+def snapshot_path(snap):
+    return bench/'snapshots'/snap.replace('/','%')
+
+def snapshots():
+    store = bench/'snapshots'
+    return sorted(n.replace('%','/') for n in os.listdir(store) if not n.endswith('.origin')) if store.is_dir() else []
+
+def tree_size(path):
+    return sum(os.lstat(os.path.join(d,f)).st_size for d,_,files in os.walk(path) for f in files)
+
+def zfs(args,out):
+    words = [a for a in args if not a.startswith('-')]
+    if args[0]=='create':
+        os.makedirs(dataset_path(words[-1]),exist_ok=True)
+    elif args[0]=='snapshot':
+        if snapshot_path(words[-1]).exists():
+            return 1
+        shutil.copytree(dataset_path(words[-1].split('@')[0]),snapshot_path(words[-1]),symlinks=True)
+    elif args[0]=='rollback':
+        ds = dataset_path(words[-1].split('@')[0])
+        shutil.rmtree(ds)
+        shutil.copytree(snapshot_path(words[-1]),ds,symlinks=True)
+    elif args[0]=='clone':
+        shutil.copytree(snapshot_path(words[1]),dataset_path(words[2]),symlinks=True)
+        with open(snapshot_path(words[2]+'.origin'),'w') as f:
+            f.write(words[1])
+    elif args[0]=='destroy':
+        if '@' in words[-1]:
+            # dataset@snap1,snap2,... destroys several at once.
+            ds,names = words[-1].split('@')
+            for snap in names.split(','):
+                if not snapshot_path(f'{ds}@{snap}').exists():
+                    return 1
+                shutil.rmtree(snapshot_path(f'{ds}@{snap}'))
+        elif dataset_path(words[-1]).exists():
+            shutil.rmtree(dataset_path(words[-1]))
+            if snapshot_path(words[-1]+'.origin').exists():
+                os.remove(snapshot_path(words[-1]+'.origin'))
+            for snap in snapshots():
+                if snap.startswith(words[-1]+'@'):
+                    shutil.rmtree(snapshot_path(snap))
+        else:
+            return 1
+    elif args[0]=='rename':
+        os.makedirs(dataset_path(words[-1]).parent,exist_ok=True)
+        os.rename(dataset_path(words[-2]),dataset_path(words[-1]))
+        for snap in snapshots():
+            if snap.startswith(words[-2]+'@'):
+                os.rename(snapshot_path(snap),snapshot_path(words[-1]+snap[len(words[-2]):]))
+    elif args[0]=='list' and 'snapshot' in args:
+        for snap in snapshots():
+            if snap.startswith(words[-1]+'/') or snap.startswith(words[-1]+'@'):
+                out.append(snap+('\toff' if 'name,defer_destroy' in args else ''))
+    elif args[0]=='list':
+        return 0 if dataset_path(words[-1]).exists() else 1
+    elif args[0]=='get' and 'origin' in args:
+        if not dataset_path(words[-1]).exists():
+            return 1
+        origin = snapshot_path(words[-1]+'.origin')
+        out.append(origin.read_text() if origin.exists() else '-')
+    elif args[0]=='get' and len(words)>3 and words[2] in ('used','usedbysnapshots'):
+        # Snapshots are full copies here, so they use all of their size.
+        ds = words[-1]
+        if not dataset_path(ds).exists():
+            return 1
+        snaps = [s for s in snapshots() if s.startswith(ds+'@') or (words[2]=='used' and s.startswith(ds+'/'))]
+        out.append(str(sum(tree_size(p) for p in [snapshot_path(s) for s in snaps]+([dataset_path(ds)] if words[2]=='used' else []))))
+    elif args[0]=='get':
+        out.append('0')
+    return 0
+
+out = []
+rc = 0
+command = ' '.join(args)
+if name in ('arch-chroot','chroot','unshare'):
+    command = inner_command(args)
+    rc = emulate(command,out)
+elif name=='pacstrap':
+    pacstrap()
+elif name in ('pacman','trizen'):
+    rc = pacman(args,out)
+elif name=='zfs':
+    rc = zfs(args,out)
+elif name in ('mksquashfs','mkfs.erofs'):
+    # The image is written where it is asked for: after the source for
+    # mksquashfs, before it for mkfs.erofs.
+    paths = [a for a in args if not a.startswith('-') and '=' not in a and not a[0].isdigit()]
+    with open(paths[1] if name=='mksquashfs' else paths[0],'wb') as f:
+        f.write(os.urandom(1<<20))
+elif name=='ssh':
+    command = args[-1] if args else ''
+    if 'ls ' in command:
+        out.append('1000')
+
+for pattern,rate in config['fail'].items():
+    if pattern in f'{name} {command}' and random.random()<rate:
+        rc = 1
+
+latency = setting('latency',name)
+time.sleep(latency)
+lines = setting('output_lines',name)
+# Listings are parsed by the builder, and carry nothing but what was asked for.
+if name=='zfs' and args[:1] in (['list'],['get']):
+    lines = 0
+if 'TIMEFORMAT' in command:
+    out.append('0.05')
+    lines = 0
+if lines:
+    out.extend(f'{name}: output line {n} for {command[:60]}' for n in range(lines))
+if out:
+    sys.stdout.write('\n'.join(out)+'\n')
+
+with open(bench/'calls.jsonl','a') as f:
+    f.write(json.dumps({'cmd':name,'rc':rc,'sleep':latency,'wall':time.time()-start})+'\n')
+sys.exit(rc)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Loopback load test of tftpserv.py: starts the server on a scratch directory
+# laid out like NAS_IMAGE_PATH, with one build whose /boot holds a file of the
+# given size, and has many clients fetch it at once.  Reports the aggregate
+# throughput, the spread of the clients' completion times, failed or corrupt
+# transfers and the server's retransmissions.  --baseline runs the same load
+# with plain 512 byte lock-step transfers first, for comparison.
+import os
+import sys
+import time
+import random
+import socket
+import struct
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import shutil
+from pathlib import Path
+
+here = Path(__file__).resolve().parent
+sys.path.insert(0,str(here.parent))
+import tftpserv
+from tftpserv import RRQ, DATA, ACK, ERROR, OACK
+
+class client(asyncio.DatagramProtocol):
+    # A client asking for blksize and windowsize (when not the defaults),
+    # acknowledging every window, and on a gap the last block it has in
+    # order.  Drops received blocks with probability loss.
+    def __init__(self,server,filename,blksize,windowsize,loss,timeout,done):
+        self.server=server
+        self.filename=filename
+        self.blksize=blksize
+        self.windowsize=windowsize
+        self.options={}
+        if blksize!=512:
+            self.options['blksize']=blksize
+        if windowsize!=1:
+            self.options['windowsize']=windowsize
+        self.loss=loss
+        self.timeout=timeout
+        self.done=done
+        self.data=bytearray()
+        self.expected=1
+        self.in_window=0
+        self.gap=False
+        self.peer=None
+        self.retries=0
+        self.timer=None
+        self.last=None
+    def connection_made(self,transport):
+        self.transport=transport
+        try:
+            transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,1<<22)
+        except OSError:
+            pass
+        request=struct.pack('!H',RRQ)+self.filename.encode()+b'\0octet\0'
+        for name,value in self.options.items():
+            request+=name.encode()+b'\0'+str(value).encode()+b'\0'
+        self.send(request,self.server)
+    def send(self,packet,addr):
+        self.last=(packet,addr)
+        self.transport.sendto(packet,addr)
+        self.arm()
+    def arm(self):
+        if self.timer:
+            self.timer.cancel()
+        self.timer=asyncio.get_event_loop().call_later(self.timeout,self.expired)
+    def expired(self):
+        self.retries+=1
+        if self.retries>5:
+            self.finish('timed out')
+            return
+        self.transport.sendto(*self.last)
+        self.arm()
+    def ack(self,block):
+        self.in_window=0
+        self.send(struct.pack('!HH',ACK,block&0xffff),self.peer)
+    def datagram_received(self,packet,addr):
+        if self.done.done(): return
+        op=struct.unpack('!H',packet[:2])[0]
+        if self.peer is None:
+            self.peer=addr
+        if op==ERROR:
+            self.finish(packet[4:].rstrip(b'\0').decode(errors='replace'))
+        elif op==OACK:
+            fields=packet[2:].split(b'\0')
+            accepted={fields[i].decode():int(fields[i+1]) for i in range(0,len(fields)-1,2)}
+            self.blksize=accepted.get('blksize',512)
+            self.windowsize=accepted.get('windowsize',1)
+            self.retries=0
+            self.ack(0)
+        elif op==DATA:
+            if random.random()<self.loss:
+                return
+            self.retries=0
+            number=struct.unpack('!H',packet[2:4])[0]
+            if number!=self.expected&0xffff:
+                # Out of order: acknowledge what arrived in order, once per gap.
+                if not self.gap:
+                    self.gap=True
+                    self.ack(self.expected-1)
+                return
+            self.gap=False
+            self.data+=packet[4:]
+            self.expected+=1
+            self.in_window+=1
+            if len(packet)-4<self.blksize:
+                self.ack(self.expected-1)
+                self.finish(None)
+            elif self.in_window>=self.windowsize:
+                self.ack(self.expected-1)
+            else:
+                self.arm()
+    def error_received(self,exc):
+        pass
+    def finish(self,error):
+        if self.timer:
+            self.timer.cancel()
+        self.transport.close()
+        if not self.done.done():
+            self.done.set_result((error,bytes(self.data)))
+
+async def fetch(loop,server,filename,blksize,windowsize,loss,timeout,delay):
+    await asyncio.sleep(delay)
+    done=loop.create_future()
+    start=time.time()
+    await loop.create_datagram_endpoint(lambda: client(server,filename,blksize,windowsize,loss,timeout,done),local_addr=('127.0.0.1',0))
+    error,data=await done
+    return error,data,time.time()-start
+
+def run(loop,server,args,digest,blksize,windowsize):
+    before=dict(server.stats)
+    start=time.time()
+    tasks=[fetch(loop,server.address,'/initramfs-linux.img',blksize,windowsize,args.loss,args.timeout,random.random()*args.stagger)
+           for n in range(args.clients)]
+    results=loop.run_until_complete(asyncio.gather(*tasks))
+    wall=time.time()-start
+    times=sorted(r[2] for r in results)
+    failed=sum(1 for r in results if r[0])
+    corrupt=sum(1 for r in results if not r[0] and hashlib.sha256(r[1]).hexdigest()!=digest)
+    total=sum(len(r[1]) for r in results)
+    print(f"blksize {blksize}, windowsize {windowsize}: {args.clients} clients x {args.size} MiB")
+    print(f"    wall                {wall:10.2f} s")
+    print(f"    aggregate           {total/2**20/wall:10.1f} MiB/s")
+    print(f"    per client          {times[len(times)//2]:10.2f} s median, {times[int(len(times)*0.95)-1]:.2f} s p95, {times[-1]:.2f} s max")
+    print(f"    failed / corrupt    {failed:10d} / {corrupt}")
+    print(f"    server retransmits  {server.stats['retransmits']-before['retransmits']:10d}")
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Load test tftpserv.py on the loopback interface.')
+    parser.add_argument('--clients',type=int,default=200,help='concurrent clients')
+    parser.add_argument('--size',type=int,default=8,help='MiB per file')
+    parser.add_argument('--blksize',type=int,default=1468,help='block size the clients ask for')
+    parser.add_argument('--windowsize',type=int,default=16,help='window size the clients ask for')
+    parser.add_argument('--loss',type=float,default=0.0,help='probability a client drops a received block')
+    parser.add_argument('--timeout',type=float,default=1.0,help='client timeout in seconds')
+    parser.add_argument('--stagger',type=float,default=0.5,help='clients start at random within this many seconds')
+    parser.add_argument('--baseline',action='store_true',help='first run the load with 512 byte blocks and no window')
+    args = parser.parse_args()
+    work=Path(tempfile.mkdtemp(prefix='tftp-bench-'))
+    try:
+        os.makedirs(work/'builds/1/boot')
+        os.makedirs(work/'mounts')
+        with open(work/'mounts/latest','w') as f:
+            f.write('1\n')
+        data=os.urandom(args.size<<20)
+        with open(work/'builds/1/boot/initramfs-linux.img','wb') as f:
+            f.write(data)
+        digest=hashlib.sha256(data).hexdigest()
+        del data
+        loop=asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server,transport=tftpserv.serve(loop,work,'127.0.0.1',0,metrics=str(work/'metrics.jsonl'),quiet=True)
+        server.address=('127.0.0.1',transport.get_extra_info('sockname')[1])
+        if args.baseline:
+            run(loop,server,args,digest,512,1)
+        run(loop,server,args,digest,args.blksize,args.windowsize)
+    finally:
+        shutil.rmtree(work)
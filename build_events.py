@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# The live event stream of a build, and the cgroups its resources are
+# accounted in.
+#
+# build_image.py runs each stage's commands in cgroup v2 leaves of their own,
+# <cgroup2 mount>/netboot-build/<builder pid>/<stage>/cmd-<n>, entered before
+# the command is executed, so that everything the command starts (inside
+# arch-chroot or unshare too) is counted there.  A sampler thread reads the
+# counters of the running stages' cgroups every EVENTS_INTERVAL seconds.
+# Stage and command starts and ends, samples, and snapshot events are
+# appended as JSON lines to .cache/events.jsonl, one write per line, so the
+# variants' builders can share it.  Run this file to follow it:
+#
+#   ./build_events.py -f
+import os
+import re
+import sys
+import json
+import time
+import threading
+import argparse
+from pathlib import Path
+
+def cgroup2_mount():
+    # Where the unified hierarchy is mounted: /sys/fs/cgroup, or
+    # /sys/fs/cgroup/unified on hybrid systems.
+    try:
+        with open('/proc/self/mounts','r') as f:
+            for line in f:
+                fields=line.split()
+                if len(fields)>2 and fields[2]=='cgroup2':
+                    return Path(fields[1])
+    except OSError:
+        pass
+    return None
+
+def read_file(path):
+    try:
+        with open(path,'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def read_stats(path):
+    # The cumulative counters of a cgroup and its descendants.  Memory and
+    # I/O bytes need the memory and io controllers; CPU time and pressure
+    # stall time are always there.
+    stats={}
+    text=read_file(path/'cpu.stat')
+    for line in (text or '').split('\n'):
+        key,_,value=line.partition(' ')
+        if key in ('usage_usec','user_usec','system_usec'):
+            stats['cpu_'+key]=int(value)
+    for key,name in (('mem','memory.current'),('mem_peak','memory.peak'),('procs','pids.current')):
+        text=read_file(path/name)
+        if text and text.strip().isdigit():
+            stats[key]=int(text)
+    text=read_file(path/'io.stat')
+    if text is not None:
+        stats['io_read']=sum(int(v) for v in re.findall(r'rbytes=(\d+)',text))
+        stats['io_write']=sum(int(v) for v in re.findall(r'wbytes=(\d+)',text))
+    for resource in ('cpu','memory','io'):
+        text=read_file(path/f'{resource}.pressure')
+        for line in (text or '').split('\n'):
+            if line.startswith('some '):
+                fields=dict(f.split('=') for f in line.split()[1:])
+                stats[f'{resource}_some_avg10']=float(fields['avg10'])
+                stats[f'{resource}_some_usec']=int(fields['total'])
+    return stats
+
+def totals(after,before):
+    # What a stage or command used between two read_stats(): CPU seconds,
+    # bytes read and written, seconds some task was stalled on each
+    # resource, and the peak memory (of the cgroup's lifetime).
+    result={}
+    for key,name,scale in (('cpu_usage_usec','cpu',1e6),('cpu_user_usec','cpu_user',1e6),('cpu_system_usec','cpu_system',1e6),
+                           ('io_read','io_read',1),('io_write','io_write',1),
+                           ('cpu_some_usec','cpu_stall',1e6),('memory_some_usec','mem_stall',1e6),('io_some_usec','io_stall',1e6)):
+        if key in after:
+            value=(after[key]-before.get(key,0))/scale
+            result[name]=round(value,3) if scale>1 else value
+    if 'mem_peak' in after:
+        result['mem_peak']=after['mem_peak']
+    return result
+
+class eventstream():
+    # Appends events to a JSON lines file.  The file is opened with O_APPEND
+    # and each event written with a single write, so lines from several
+    # processes never interleave.
+    def __init__(self,path):
+        self.path=Path(path)
+        self.fd=None
+        self.lock=threading.Lock()
+    def reset(self):
+        # A new build starts a new stream; the last one is kept.
+        with self.lock:
+            self._close()
+            if self.path.exists():
+                os.replace(self.path,self.path.with_suffix('.prev.jsonl'))
+    def emit(self,type,**fields):
+        record=dict(time=round(time.time(),3),type=type,**fields)
+        line=(json.dumps(record)+'\n').encode()
+        with self.lock:
+            if self.fd is None:
+                self.path.parent.mkdir(parents=True,exist_ok=True)
+                self.fd=os.open(self.path,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+            os.write(self.fd,line)
+    def close(self):
+        with self.lock:
+            self._close()
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd=None
+
+class cgrouptree():
+    # The cgroups of one builder process: a node per stage under
+    # <mount>/netboot-build/<pid>, and a leaf per command under its stage.
+    # Only leaves hold processes, so the cpu, memory, io and pids controllers
+    # can be enabled on every node above them where the parent has them.
+    controllers=['cpu','memory','io','pids']
+    def __init__(self,name='netboot-build'):
+        self.mount=cgroup2_mount()
+        self.base=self.mount/name/str(os.getpid()) if self.mount else None
+        self.ready=None
+        self.count=0
+        self.lock=threading.Lock()
+    def open(self):
+        # Whether cgroups can be used here: cgroup v2 mounted and writable.
+        with self.lock:
+            if self.ready is None:
+                self.ready=False
+                if self.base is not None:
+                    try:
+                        self.enable(self.mount)
+                        self.base.parent.mkdir(exist_ok=True)
+                        self.enable(self.base.parent)
+                        self.base.mkdir(exist_ok=True)
+                        self.enable(self.base)
+                        self.ready=True
+                    except OSError as e:
+                        print(f"    No cgroup accounting: {e}",file=sys.stderr)
+            return self.ready
+    def enable(self,path):
+        available=(read_file(path/'cgroup.controllers') or '').split()
+        enabled=(read_file(path/'cgroup.subtree_control') or '').split()
+        for c in self.controllers:
+            if c in available and c not in enabled:
+                try:
+                    with open(path/'cgroup.subtree_control','w') as f:
+                        f.write(f'+{c}')
+                except OSError:
+                    # Busy (the cgroup has processes of its own) or not
+                    # delegated; the counters that need it are left out.
+                    pass
+    def node(self,name):
+        path=self.base/re.sub('[^A-Za-z0-9_.:-]','_',name)[:200]
+        path.mkdir(exist_ok=True)
+        self.enable(path)
+        return path
+    def leaf(self,node):
+        with self.lock:
+            self.count+=1
+            path=node/f'cmd-{self.count}'
+        path.mkdir()
+        return path
+    def remove(self,path):
+        # Fails while anything the command left running is still alive.
+        try:
+            path.rmdir()
+            return True
+        except OSError:
+            return False
+    def close(self):
+        # Whatever is still running in a leaf is moved to the root cgroup, so
+        # the whole tree can go.
+        if not self.ready: return
+        for path in sorted(self.base.glob('*/cmd-*'),reverse=True)+sorted(self.base.glob('*'),reverse=True)+[self.base]:
+            for pid in (read_file(path/'cgroup.procs') or '').split():
+                try:
+                    with open(self.mount/'cgroup.procs','w') as f:
+                        f.write(pid)
+                except OSError:
+                    pass
+            self.remove(path)
+        self.remove(self.base.parent)
+        self.ready=None
+
+def join(path):
+    # Run in the child between fork and exec: moves it into the cgroup.
+    try:
+        fd=os.open(os.path.join(path,'cgroup.procs'),os.O_WRONLY)
+        try:
+            os.write(fd,b'0')
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+class sampler():
+    # Every interval seconds, reads the counters of the watched cgroups and
+    # emits a sample event for each: CPU in cores, memory in use, I/O bytes
+    # per second, and the share of time some task was stalled on CPU, memory
+    # or I/O over the last 10 seconds.  That is a few small reads per running
+    # stage per interval.
+    def __init__(self,stream,interval):
+        self.stream=stream
+        self.interval=interval
+        self.watched={}
+        self.lock=threading.Lock()
+        self.thread=None
+    def watch(self,path,**fields):
+        with self.lock:
+            self.watched[path]=(fields,read_stats(path),time.time())
+            if self.thread is None:
+                self.thread=threading.Thread(target=self.run,daemon=True)
+                self.thread.start()
+    def unwatch(self,path):
+        with self.lock:
+            self.watched.pop(path,None)
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                watched=list(self.watched.items())
+            for path,(fields,last,then) in watched:
+                stats=read_stats(path)
+                now=time.time()
+                elapsed=max(now-then,1e-3)
+                sample=dict(fields)
+                if 'cpu_usage_usec' in stats:
+                    sample['cpu']=round((stats['cpu_usage_usec']-last.get('cpu_usage_usec',0))/1e6/elapsed,2)
+                for key in ('mem','procs'):
+                    if key in stats:
+                        sample[key]=stats[key]
+                for key in ('io_read','io_write'):
+                    if key in stats:
+                        sample[key+'_rate']=int((stats[key]-last.get(key,0))/elapsed)
+                for resource in ('cpu','memory','io'):
+                    if f'{resource}_some_avg10' in stats:
+                        sample[f'{resource}_pressure']=stats[f'{resource}_some_avg10']
+                with self.lock:
+                    if path not in self.watched: continue
+                    self.watched[path]=(fields,stats,now)
+                self.stream.emit('sample',**sample)
+
+def state(event):
+    # A guess at what a stage is waiting on, from a sample.
+    if event.get('cpu',0)>=0.5:
+        return 'cpu'
+    if event.get('io_pressure',0)>=10 or event.get('memory_pressure',0)>=10:
+        return 'io' if event.get('io_pressure',0)>=event.get('memory_pressure',0) else 'memory'
+    return 'idle'
+
+def mib(n):
+    return f'{n/2**20:.0f} MiB'
+
+def describe(event):
+    kind=event['type']
+    fields=[]
+    if kind=='sample':
+        fields.append(f"[{state(event)}]")
+        if 'cpu' in event: fields.append(f"cpu {event['cpu']:.2f}")
+        if 'mem' in event: fields.append(f"mem {mib(event['mem'])}")
+        if 'io_read_rate' in event: fields.append(f"io r {mib(event['io_read_rate'])}/s w {mib(event['io_write_rate'])}/s")
+        pressure=[f"{r} {event[r+'_pressure']:.0f}%" for r in ('cpu','memory','io') if r+'_pressure' in event]
+        if pressure: fields.append('stalled '+' '.join(pressure))
+    elif kind in ('cmd_start','cmd_end'):
+        fields.append(f"#{event.get('id')}")
+        if kind=='cmd_end':
+            fields.append(f"rc {event.get('rc')} {event.get('wall',0):.1f}s")
+            if 'cpu' in event: fields.append(f"cpu {event['cpu']:.1f}s")
+            if 'io_stall' in event: fields.append(f"io stall {event['io_stall']:.1f}s")
+            if 'mem_peak' in event: fields.append(f"peak {mib(event['mem_peak'])}")
+            if event.get('lingering'): fields.append(f"{event['lingering']} left running")
+        else:
+            fields.append(event.get('cmd','')[:120])
+    elif kind=='stage_end':
+        fields.append('ok' if event.get('ok') else 'FAILED')
+        fields.append(f"{event.get('wall',0):.1f}s")
+        if 'cpu' in event: fields.append(f"cpu {event['cpu']:.1f}s")
+    else:
+        fields.extend(f'{k} {len(v) if isinstance(v,list) else v}' for k,v in event.items() if k not in ('time','type','stage','variant'))
+    stage=event.get('stage','')
+    if event.get('variant'):
+        stage=f"[{event['variant']}] {stage}"
+    return f"{time.strftime('%H:%M:%S',time.localtime(event['time']))} {stage[:28]:28s} {kind:11s} {' '.join(fields)}"
+
+def follow(path,show,poll=0.5):
+    # Like tail -F: waits for the file to appear, and starts over when a new
+    # build replaces it.
+    f=None
+    ino=None
+    partial=''
+    while True:
+        if f is None:
+            try:
+                f=open(path,'r')
+                ino=os.fstat(f.fileno()).st_ino
+                partial=''
+            except FileNotFoundError:
+                time.sleep(poll)
+                continue
+        data=f.read()
+        if data:
+            lines=(partial+data).split('\n')
+            partial=lines.pop()
+            for line in lines:
+                show(line)
+            continue
+        try:
+            st=os.stat(path)
+            if st.st_ino!=ino or st.st_size<f.tell():
+                f.close()
+                f=None
+                continue
+        except FileNotFoundError:
+            pass
+        time.sleep(poll)
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Show the event stream of a build.')
+    parser.add_argument('file',nargs='?',default='.cache/events.jsonl',help='event file (default: .cache/events.jsonl)')
+    parser.add_argument('-f','--follow',action='store_true',help='keep reading as events are appended')
+    parser.add_argument('--type',action='append',help='show only events of this type (may be given more than once)')
+    parser.add_argument('--stage',help='show only events of stages whose name contains this')
+    parser.add_argument('--no-samples',action='store_true',help='leave out resource samples')
+    parser.add_argument('--json',action='store_true',help='print the events as they are stored')
+    args = parser.parse_args()
+    def show(line):
+        try:
+            event=json.loads(line)
+        except ValueError:
+            return
+        if args.type and event.get('type') not in args.type: return
+        if args.no_samples and event.get('type')=='sample': return
+        if args.stage and args.stage not in str(event.get('stage','')): return
+        print(line if args.json else describe(event),flush=True)
+    try:
+        if args.follow:
+            follow(args.file,show)
+        else:
+            if not os.path.exists(args.file):
+                sys.exit(f'No events in {args.file}')
+            with open(args.file,'r') as f:
+                for line in f:
+                    show(line)
+    except (KeyboardInterrupt,BrokenPipeError):
+        pass
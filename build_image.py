@@ -7,31 +7,211 @@ import glob
 import subprocess
 import time
 import shlex
-import io
 import selectors
 import signal
+import threading
+import argparse
+import concurrent.futures
+import json
+import re
+import urllib.request
+import urllib.parse
+import atexit
+import tempfile
+import collections
+import hashlib
+import pacdb
+import manifest
+import build_events
+import slim
+
+# Defaults for the optional build_config.py settings.
+PACKAGE_BATCH=True
+AUR_WORKERS=0
+PKG_CACHE_DIR=None
+PKG_CACHE_MAX_GB=50
+PKG_CACHE_KEEP_VERSIONS=3
+PKG_CACHE_MAX_AGE_DAYS=180
+CHROOT_SESSION=True
+SSH_COMMAND='ssh'
+REMOTE_TRANSPORT='ssh'
+PUBLISH_METHOD='rsync'
+PUBLISH_COMPRESS=None
+PUBLISH_RETRIES=3
+PUBLISH_INCREMENTAL=True
+PUBLISH_VERIFY=False
+IMAGE_FORMAT='squashfs'
+IMAGE_OPTIONS=None
+IMAGE_PROFILE='boot-profile.txt'
+CAPTURE_TAIL_LINES=200
+LOG_COMPRESS=False
+LAYER_CACHE=True
+LAYER_CACHE_MAX_GB=100
+CHECKPOINT_POLICY='auto'
+CHECKPOINT_ITEMS=10
+CHECKPOINT_SECONDS=600
+PREFETCH=True
+PREFETCH_CONNECTIONS=8
+AUR_URL='https://aur.archlinux.org'
+INITRAMFS_FALLBACK=False
+INITRAMFS_COMPRESSION='zstd'
+INITRAMFS_COMPRESSION_OPTIONS='-T0 -19'
+INITRAMFS_CACHE=True
+HOSTNAME='icarus-nfs'
+PACKAGE_LISTS=[]
+SERVICES=['sshd','docker','bumblebeed']
+EXTRA_GROUPS=['uucp','docker','bumblebee','plugdev','realtime','audio']
+MOUNT_POINTERS=['latest','c85b761a2c47']
+VARIANTS={}
+CGROUPS=True
+EVENTS_INTERVAL=2
+CCACHE=True
+CCACHE_DIR=None
+CCACHE_MAX_GB=20
+BUILD_TMPFS_GB=8
+MAKE_JOBS=None
+KEYS_DIR='keys'
+KEYSERVER='https://keyserver.ubuntu.com'
+SLIM_RULES='slim.txt'
+SLIM_DEDUP='hardlink'
+SLIM_DEDUP_MIN_SIZE=4096
 
 from build_config import *
 
-echo=False
-cur_stage="NONE"
+# The settings a variant may override; everything else is shared, so that
+# the stages up to extra-rootfs-files are built once for all variants (see
+# run_variants).  A variant is built in a process of its own, started with
+# BUILD_VARIANT set, with its settings in place of the base ones.
+variant_settings = ['HOSTNAME','PACKAGE_LISTS','SERVICES','EXTRA_GROUPS','MOUNT_POINTERS']
+for _name,_settings in VARIANTS.items():
+    if not set(_settings)<=set(variant_settings):
+        sys.exit(f"VARIANTS['{_name}'] sets {', '.join(sorted(set(_settings)-set(variant_settings)))}; variants can only set {', '.join(variant_settings)}")
+VARIANT=os.environ.get('BUILD_VARIANT')
+if VARIANT:
+    if VARIANT not in VARIANTS:
+        sys.exit(f'Unknown variant: {VARIANT}')
+    globals().update(VARIANTS[VARIANT])
+    # Layers are of the shared root only.
+    LAYER_CACHE=False
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def take_snapshot():
-    if cur_stage in ['makerootfs'] or cur_stage.startswith('packages-') or cur_stage.startswith('file: '): return
-    print(f"    Snapshot: {cur_stage}")
-    assert(os.system(f'zfs snapshot {ZFS_CWD}/.install@{cur_stage}')==0)
+echo=False
 
-def rollback_snapshot():
-    if cur_stage in ['makerootfs'] or cur_stage.startswith('packages-') or cur_stage.startswith('file: '): return
-    print(f"    Rollback: {cur_stage}")
-    assert(os.system(f'zfs rollback {ZFS_CWD}/.install@{cur_stage}')==0)
-    assert(os.system(f'zfs destroy {ZFS_CWD}/.install@{cur_stage}')==0)
+# The name of the stage (or package) being worked on is tracked per thread,
+# since independent stages may be executing concurrently.
+_stage_local = threading.local()
+
+def get_stage():
+    return getattr(_stage_local,'name',"NONE")
+
+def set_stage(name):
+    _stage_local.name = name
+
+# Worker threads of a stage share its totals.
+_usage_lock = threading.Lock()
+
+def add_stage_usage(usage):
+    # Totals of the commands run by the current thread's stage.
+    totals = getattr(_stage_local,'usage',None)
+    if totals is None: return
+    with _usage_lock:
+        for k,v in usage.items():
+            if k=='maxrss':
+                totals[k]=max(totals.get(k,0),v)
+            elif k!='wall':
+                totals[k]=totals.get(k,0)+v
+
+# Every subprocess started through capture_subprocess_output, so that a hard
+# interrupt can take down the process groups of all running stages.
+_children = set()
+_children_lock = threading.Lock()
+
+def kill_children():
+    with _children_lock:
+        for p in _children:
+            try:
+                os.killpg(p.pid,signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
-def commit_snapshot():
-    cur_time = time.time()
-    if cur_stage in ['makerootfs'] or cur_stage.startswith('packages-') or cur_stage.startswith('file: '): return
-    print(f"    Commit: {cur_stage}")
-    assert(os.system(f'zfs destroy {ZFS_CWD}/.install@{cur_stage}')==0)
+def skip_snapshot(name):
+    return name in ['makerootfs','prefetch'] or name.startswith('packages-') or name.startswith('file: ')
+
+def take_snapshot(name=None):
+    name = name or get_stage()
+    if skip_snapshot(name): return
+    print(f"    Snapshot: {name}")
+    with _destroy_lock:
+        pending = name in _destroy_queue or name in _destroying
+    if pending:
+        # Waits for a destroy already running, too.
+        flush_snapshots()
+    start = time.time()
+    assert(os.system(f'zfs snapshot {dataset}@{shlex.quote(name)}')==0)
+    record_metric(dict(type='snapshot',stage=get_stage(),name=name,wall=round(time.time()-start,3)))
+    emit_event('snapshot',name=name,wall=round(time.time()-start,3))
+
+def rollback_snapshot(name=None):
+    name = name or get_stage()
+    if skip_snapshot(name): return
+    print(f"    Rollback: {name}")
+    # Snapshots waiting to be destroyed may be newer than this one.
+    flush_snapshots()
+    assert(os.system(f'zfs rollback {dataset}@{shlex.quote(name)}')==0)
+    assert(os.system(f'zfs destroy {dataset}@{shlex.quote(name)}')==0)
+    emit_event('rollback',name=name)
+
+def commit_snapshot(name=None):
+    name = name or get_stage()
+    if skip_snapshot(name): return
+    print(f"    Commit: {name}")
+    emit_event('commit',name=name)
+    with _destroy_lock:
+        _destroy_queue.append(name)
+    _destroy_wake.set()
+    global _destroy_thread
+    if _destroy_thread is None:
+        _destroy_thread = threading.Thread(target=_destroyer,daemon=True)
+        _destroy_thread.start()
+
+# Committed snapshots are destroyed in the background, many per zfs command,
+# instead of each commit waiting for its own destroy (and txg sync).
+_destroy_queue = []
+# Taken off the queue, until their zfs destroy returns.
+_destroying = set()
+_destroy_lock = threading.Lock()
+_destroy_wake = threading.Event()
+_destroy_thread = None
+_flush_lock = threading.Lock()
+
+def flush_snapshots():
+    with _flush_lock:
+        with _destroy_lock:
+            names = _destroy_queue[:]
+            _destroy_queue.clear()
+            _destroying.update(names)
+        try:
+            for n in range(0,len(names),100):
+                batch = names[n:n+100]
+                if os.system(f'zfs destroy {dataset}@{",".join(shlex.quote(x) for x in batch)}')!=0:
+                    # Destroy what can be, one at a time.
+                    for x in batch:
+                        os.system(f'zfs destroy {dataset}@{shlex.quote(x)}')
+        finally:
+            with _destroy_lock:
+                _destroying.difference_update(names)
+
+def _destroyer():
+    while True:
+        _destroy_wake.wait()
+        # Let a few more commits arrive before destroying.
+        time.sleep(2)
+        _destroy_wake.clear()
+        flush_snapshots()
 
 class GracefulInterruptHandler(object):
 
@@ -68,143 +248,790 @@ class GracefulInterruptHandler(object):
 
         return True
 
-# This script must be run as root!
-if not os.geteuid()==0:
-    sys.exit('This script must be run as root!')
-
 cwd = Path(os.getcwd())
-root = cwd / '.install'
+root = cwd / '.variants' / VARIANT if VARIANT else cwd / '.install'
+dataset = f'{ZFS_CWD}/.variants/{VARIANT}' if VARIANT else f'{ZFS_CWD}/.install'
+# Host-side state that outlives the install root (see clean_image.py).
+cache = cwd / '.cache'
+
+# Packages downloaded by any build are kept here and bind-mounted over the
+# target's /var/cache/pacman/pkg, so they survive clean_image.py and
+# stageCleanup and are never part of a snapshot or the published image.
+pkgcache = Path(PKG_CACHE_DIR) if PKG_CACHE_DIR else cache / 'pkg'
+_pkgcache_lock = threading.Lock()
+
+def mount_pkgcache(target=None):
+    target = target or root
+    with _pkgcache_lock:
+        mountpoint = target/'var/cache/pacman/pkg'
+        if os.path.ismount(mountpoint): return
+        pkgcache.mkdir(parents=True,exist_ok=True)
+        os.makedirs(mountpoint,exist_ok=True)
+        assert(os.system(f'mount --bind {shlex.quote(str(pkgcache))} {shlex.quote(str(mountpoint))}')==0)
+
+def umount_pkgcache(target=None):
+    target = target or root
+    with _pkgcache_lock:
+        mountpoint = target/'var/cache/pacman/pkg'
+        if os.path.ismount(mountpoint):
+            assert(os.system(f'umount {shlex.quote(str(mountpoint))}')==0)
+
+def pkgcache_files():
+    # Package files in the cache, by package name.
+    files={}
+    if not pkgcache.is_dir(): return files
+    for f in pkgcache.iterdir():
+        if '.pkg.tar' not in f.name or f.name.endswith('.sig') or f.name.endswith('.part'): continue
+        files.setdefault(f.name.rsplit('-',3)[0],[]).append(f)
+    return files
+
+def evict_pkgcache():
+    # Drop package versions older than PKG_CACHE_MAX_AGE_DAYS and all but the
+    # newest PKG_CACHE_KEEP_VERSIONS of each package, then the oldest files
+    # until the cache fits in PKG_CACHE_MAX_GB.
+    # Variant builds evict at the same time, so a file may be gone by the time
+    # it is looked at.
+    now=time.time()
+    stats={}
+    keep=[]
+    evict=[]
+    for name,files in pkgcache_files().items():
+        for f in files:
+            try:
+                stats[f]=f.stat()
+            except FileNotFoundError:
+                pass
+        files=[f for f in files if f in stats]
+        files.sort(key=lambda f: stats[f].st_mtime,reverse=True)
+        for n,f in enumerate(files):
+            if n>=PKG_CACHE_KEEP_VERSIONS or now-stats[f].st_mtime>PKG_CACHE_MAX_AGE_DAYS*86400:
+                evict.append(f)
+            else:
+                keep.append(f)
+    keep.sort(key=lambda f: stats[f].st_mtime)
+    size=sum(stats[f].st_size for f in keep)
+    while keep and size>PKG_CACHE_MAX_GB*2**30:
+        f=keep.pop(0)
+        size-=stats[f].st_size
+        evict.append(f)
+    freed=0
+    for f in evict:
+        freed+=stats[f].st_size
+        f.unlink(missing_ok=True)
+        Path(str(f)+'.sig').unlink(missing_ok=True)
+    if evict:
+        print(f"Package cache: evicted {len(evict)} files ({freed/2**20:.0f} MiB), {size/2**30:.1f} GiB in use")
+
+def pkgcache_report(before):
+    # Files that were already cached and are installed in the target count as
+    # hits; files downloaded during this run count as misses.
+    installed=set(os.listdir(root/'var/lib/pacman/local')) if (root/'var/lib/pacman/local').is_dir() else set()
+    hits=[]
+    misses=[]
+    for files in pkgcache_files().values():
+        for f in files:
+            try:
+                size=f.stat().st_size
+            except FileNotFoundError:
+                continue
+            if f.name not in before:
+                misses.append((f,size))
+            elif f.name.rsplit('-',1)[0] in installed:
+                hits.append((f,size))
+    report=(f"Package cache: {len(hits)} hits ({sum(s for f,s in hits)/2**20:.0f} MiB), "
+            f"{len(misses)} misses ({sum(s for f,s in misses)/2**20:.0f} MiB downloaded)")
+    print(report)
+    if (root/'.install').is_dir():
+        with open(root/'.install/pkgcache.report','a') as f:
+            f.write(f"{int(time.time())} {report}\n")
+            for m,_ in misses:
+                f.write(f"    miss {m.name}\n")
+
+# Package builds share a compiler cache, .cache/ccache (or CCACHE_DIR),
+# bind-mounted over the target's /var/cache/ccache, so it survives
+# clean_image.py and serves every build and variant.  makepkg builds in a
+# tmpfs of BUILD_TMPFS_GB mounted at /var/tmp/makepkg; packages that did not
+# fit are listed in .cache/builddir-disk and built on disk from then on.
+ccache = Path(CCACHE_DIR) if CCACHE_DIR else cache / 'ccache'
+disk_builds = cache / 'builddir-disk'
+_buildcache_lock = threading.Lock()
+
+def mount_buildcache(target=None,tmpfs_gb=None):
+    target = target or root
+    tmpfs_gb = BUILD_TMPFS_GB if tmpfs_gb is None else tmpfs_gb
+    with _buildcache_lock:
+        mountpoint = target/'var/cache/ccache'
+        if CCACHE and not os.path.ismount(mountpoint):
+            # Written by INNER_USER inside the target.
+            (ccache/'stats').mkdir(parents=True,exist_ok=True)
+            os.chmod(ccache,0o1777)
+            os.chmod(ccache/'stats',0o1777)
+            os.makedirs(mountpoint,exist_ok=True)
+            assert(os.system(f'mount --bind {shlex.quote(str(ccache))} {shlex.quote(str(mountpoint))}')==0)
+        mountpoint = target/'var/tmp/makepkg'
+        if tmpfs_gb and not os.path.ismount(mountpoint):
+            os.makedirs(mountpoint,exist_ok=True)
+            assert(os.system(f'mount -t tmpfs -o size={int(tmpfs_gb*1024)}M,mode=1777 tmpfs {shlex.quote(str(mountpoint))}')==0)
+
+def umount_buildcache(target=None):
+    target = target or root
+    with _buildcache_lock:
+        for mountpoint in [target/'var/cache/ccache',target/'var/tmp/makepkg']:
+            if os.path.ismount(mountpoint):
+                assert(os.system(f'umount {shlex.quote(str(mountpoint))}')==0)
+
+def built_on_disk():
+    if not disk_builds.exists(): return set()
+    with open(disk_builds,'r') as f:
+        return {l.strip() for l in f if l.strip()}
+
+def ccache_log(name):
+    return re.sub('[^A-Za-z0-9_.:-]','_',name)+'.log'
+
+def build_env(name,target,disk,jobs=None):
+    # Variables for env(1) that makepkg, run directly or by trizen, builds
+    # package name with: the configuration written by the build-cache stage,
+    # the tmpfs unless disk, and ccache with a statistics log of its own.
+    if not (target/'etc/makepkg.build.conf').exists():
+        return ''
+    env=['MAKEPKG_CONF=/etc/makepkg.build.conf']
+    if jobs:
+        env.append(f'MAKEFLAGS=-j{jobs}')
+    if not disk:
+        env.append('BUILDDIR=/var/tmp/makepkg')
+    if CCACHE:
+        # Sources unpack into versioned directories, so paths are hashed
+        # relative to the build directory and the directory itself is not.
+        basedir='/var/tmp/makepkg' if not disk else f'/home/{INNER_USER}'
+        env+=['CCACHE_DIR=/var/cache/ccache',f'CCACHE_MAXSIZE={CCACHE_MAX_GB}G',
+              f'CCACHE_BASEDIR={basedir}','CCACHE_NOHASHDIR=1',
+              'CCACHE_SLOPPINESS=file_macro,time_macros,include_file_ctime,include_file_mtime',
+              f'CCACHE_STATSLOG=/var/cache/ccache/stats/{ccache_log(name)}']
+    return ' '.join(env)
+
+def ccache_stats(name):
+    # Hits and misses in the statistics log of one build, which is removed.
+    log=ccache/'stats'/ccache_log(name)
+    if not log.exists(): return None
+    hits=misses=0
+    with open(log,'r',errors='replace') as f:
+        for line in f:
+            line=line.strip()
+            if line.endswith('_cache_hit'):
+                hits+=1
+            elif line=='cache_miss':
+                misses+=1
+    log.unlink()
+    return hits,misses
+
+class chrootsession():
+    # Sets up the API filesystems arch-chroot would mount (proc, sys, dev,
+    # run, tmp and resolv.conf) once, and keeps them mounted until close(), so
+    # each command only costs an unshare+chroot.  Like arch-chroot, commands
+    # run in their own PID namespace, so daemons they leave behind are killed
+    # when they exit.
+    mounts = [
+        ('proc','proc','-t proc -o nosuid,noexec,nodev'),
+        ('sys','sys','-t sysfs -o nosuid,noexec,nodev,ro'),
+        ('udev','dev','-t devtmpfs -o mode=0755,nosuid'),
+        ('devpts','dev/pts','-t devpts -o mode=0620,gid=5,nosuid,noexec'),
+        ('shm','dev/shm','-t tmpfs -o mode=1777,nosuid,nodev'),
+        ('run','run','-t tmpfs -o nosuid,nodev,mode=0755'),
+        ('tmp','tmp','-t tmpfs -o mode=1777,strictatime,nodev,nosuid'),
+    ]
+    def __init__(self,target):
+        self.target=target
+        self.mounted=[]
+        self.lock=threading.Lock()
+    def open(self):
+        # Returns whether the session is usable; it can only be set up once
+        # pacstrap has populated the target.
+        with self.lock:
+            if self.mounted:
+                return True
+            if not (self.target/'usr/bin/bash').exists():
+                return False
+            try:
+                for source,path,options in self.mounts:
+                    self.mount(f'{options} {source}',path)
+                resolv=self.target/'etc/resolv.conf'
+                if os.path.exists('/etc/resolv.conf') and not resolv.is_symlink():
+                    self.mount('--bind /etc/resolv.conf','etc/resolv.conf',file=True)
+            except:
+                self._umount()
+                raise
+            return True
+    def mount(self,args,path,file=False):
+        # A file is bind-mounted over a file, which is created if missing.
+        if file:
+            (self.target/path).touch()
+        else:
+            os.makedirs(self.target/path,exist_ok=True)
+        assert(os.system(f'mount {args} {shlex.quote(str(self.target/path))}')==0)
+        self.mounted.append(self.target/path)
+    def close(self):
+        with self.lock:
+            self._umount()
+    def _umount(self):
+        # A mount still in use by something left running is detached lazily,
+        # so the target is never left with API filesystems mounted.
+        while self.mounted:
+            path=shlex.quote(str(self.mounted.pop()))
+            if os.system(f'umount {path}')!=0:
+                os.system(f'umount -l {path}')
+    def prefix(self):
+        return f'SHELL=/bin/bash unshare --fork --pid chroot "{self.target}"'
+
+session = chrootsession(root)
+atexit.register(session.close)
+
+# Every command and stage appends a record to the metrics store of the current
+# build, .cache/metrics/current.jsonl.  It is copied into the image's .install
+# when the build is published and then archived under the build's timestamp;
+# build_report.py reads it.  A variant build has a store of its own,
+# current-<variant>.jsonl.
+metrics = cache / 'metrics'
+current_metrics = metrics / (f'current-{VARIANT}.jsonl' if VARIANT else 'current.jsonl')
+_metrics_lock = threading.Lock()
+
+def record_metric(record):
+    record['time']=round(time.time(),3)
+    with _metrics_lock:
+        metrics.mkdir(parents=True,exist_ok=True)
+        with open(current_metrics,'a') as f:
+            f.write(json.dumps(record)+'\n')
+
+def archive_metrics(published=False):
+    # Called when a new build starts: the previous build's store is kept as
+    # <build>.jsonl if it was published, or unpublished-<time>.jsonl.  With
+    # published, an unpublished store is left in place to be continued.
+    current=current_metrics
+    if not current.exists(): return
+    name=None
+    with open(current,'r') as f:
+        for line in f:
+            try:
+                record=json.loads(line)
+            except ValueError:
+                continue
+            if record.get('type')=='build':
+                name=build_name(record['timestamp'])
+    if name is None:
+        if published: return
+        name=f'unpublished-{int(current.stat().st_mtime)}'+(f'-{VARIANT}' if VARIANT else '')
+    os.replace(current,metrics/f'{name}.jsonl')
+
+# Stages and commands run in cgroups of their own when cgroup v2 can be used,
+# and their starts and ends, resource samples and snapshot events are
+# streamed to .cache/events.jsonl (see build_events.py).
+events = build_events.eventstream(cache/'events.jsonl')
+cgroups = build_events.cgrouptree()
+sampler = build_events.sampler(events,EVENTS_INTERVAL)
+atexit.register(cgroups.close)
+
+def emit_event(type,**fields):
+    fields.setdefault('stage',get_stage())
+    if VARIANT:
+        fields['variant']=VARIANT
+    events.emit(type,**fields)
+
+def stage_cgroup(name):
+    return cgroups.node(name) if CGROUPS and cgroups.open() else None
+
+def rusage_record(ru,wall):
+    return {
+        'wall':round(wall,3),
+        'user':round(ru.ru_utime,3),
+        'sys':round(ru.ru_stime,3),
+        'maxrss':ru.ru_maxrss,
+        'inblock':ru.ru_inblock,
+        'oublock':ru.ru_oublock,
+        'majflt':ru.ru_majflt,
+        'minflt':ru.ru_minflt,
+    }
+
+def write_timefile(path,usage):
+    # The format the builder used to have /usr/bin/time write:
+    # '%U %S %e %E %P %X %D %M %I %O %F %R %W'
+    wall=usage['wall']
+    h,rem=divmod(wall,3600)
+    m,sec=divmod(rem,60)
+    elapsed=f'{int(h)}:{int(m):02d}:{int(sec):02d}' if h else f'{int(m)}:{sec:05.2f}'
+    cpu=f"{int(100*(usage['user']+usage['sys'])/wall)}%" if wall else '?%'
+    with open(path,'w') as f:
+        f.write(f"{usage['user']:.2f} {usage['sys']:.2f} {wall:.2f} {elapsed} {cpu} 0 0 {usage['maxrss']} {usage['inblock']} {usage['oublock']} {usage['majflt']} {usage['minflt']} 0\n")
+
+# Content hashes of host files, cached by path and stat in .cache/hashes.json,
+# so the stage fingerprints don't re-read files that have not changed.
+hashes = cache / 'hashes.json'
+_hashes = None
+_hashes_lock = threading.Lock()
+
+def file_digest(path):
+    global _hashes
+    st=os.stat(path)
+    stamp=[st.st_size,st.st_mtime_ns,st.st_ino]
+    key=os.path.abspath(path)
+    with _hashes_lock:
+        if _hashes is None:
+            try:
+                with open(hashes,'r') as f:
+                    _hashes=json.load(f)
+            except (FileNotFoundError,ValueError):
+                _hashes={}
+        entry=_hashes.get(key)
+        if entry and entry[:3]==stamp:
+            return entry[3]
+    h=hashlib.sha256()
+    with open(path,'rb') as f:
+        while chunk:=f.read(1<<20):
+            h.update(chunk)
+    digest=h.hexdigest()
+    # A file modified within the mtime granularity of its last hash could
+    # keep the same stat, so only settled files are cached.
+    if time.time()-st.st_mtime>2:
+        with _hashes_lock:
+            _hashes[key]=stamp+[digest]
+    return digest
+
+def path_digest(path):
+    # A file's hash, or for a directory the hash of its tree: names, modes,
+    # symlink targets and file contents.
+    if not os.path.lexists(path):
+        return 'missing'
+    if not os.path.isdir(path):
+        return file_digest(path)
+    h=hashlib.sha256()
+    for dirpath,dirnames,filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(dirnames+filenames):
+            p=os.path.join(dirpath,name)
+            rel=os.path.relpath(p,path)
+            mode=os.lstat(p).st_mode
+            if os.path.islink(p):
+                h.update(f'L {rel} {os.readlink(p)}\n'.encode())
+            elif os.path.isdir(p):
+                h.update(f'D {rel} {mode:o}\n'.encode())
+            else:
+                h.update(f'F {rel} {mode:o} {file_digest(p)}\n'.encode())
+    return h.hexdigest()
+
+def save_hashes():
+    with _hashes_lock:
+        if _hashes is None: return
+        cache.mkdir(parents=True,exist_ok=True)
+        # Variant builds save theirs at the same time.
+        tmp=f'{hashes}.{os.getpid()}.tmp'
+        with open(tmp,'w') as f:
+            json.dump(_hashes,f)
+        os.replace(tmp,hashes)
+
+# Fingerprint of each stage class: its name, declared inputs and the
+# fingerprints of its dependencies.  Computed once per run, so a stage is
+# marked complete with the fingerprint it was planned with.
+_fingerprints = {}
+_fingerprints_lock = threading.RLock()
+
+def stage_fingerprint(cls):
+    with _fingerprints_lock:
+        if cls not in _fingerprints:
+            s=cls()
+            h=hashlib.sha256(f'stage {s.stagename()}\n'.encode())
+            for kind,value in s.inputs():
+                if kind=='file':
+                    h.update(f'file {value} {path_digest(value)}\n'.encode())
+                elif kind=='config':
+                    h.update(f'config {value} {globals().get(value)!r}\n'.encode())
+                else:
+                    assert(kind=='text')
+                    h.update(f'text {value}\n'.encode())
+            for dep in s.deps():
+                h.update(f'dep {stage_fingerprint(dep)}\n'.encode())
+            _fingerprints[cls]=h.hexdigest()
+        return _fingerprints[cls]
+
+def load_item_history():
+    # Outcomes and install times of checkpointed items, and snapshot times,
+    # over the last five builds with a metrics store.
+    items=[]
+    snapshots=[]
+    files=sorted(metrics.glob('*.jsonl'),key=lambda f: f.stat().st_mtime)[-5:] if metrics.is_dir() else []
+    for path in files:
+        with open(path,'r') as f:
+            for line in f:
+                try:
+                    record=json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type')=='item':
+                    items.append(record)
+                elif record.get('type')=='snapshot':
+                    snapshots.append(record['wall'])
+    return items,snapshots
+
+class checkpoints():
+    # Decides which items of a long list (packages.txt entries) get a
+    # snapshot before them.  A failed item rolls back to the last checkpoint,
+    # so the items installed since then lose their markers and are installed
+    # again when the build is resumed.  CHECKPOINT_POLICY is 'item' (a
+    # snapshot before every item), 'count' (every CHECKPOINT_ITEMS items),
+    # 'time' (when CHECKPOINT_SECONDS have passed since the last one) or
+    # 'auto', which picks the item count from past failure rates, install
+    # times and snapshot times, within the time limit.
+    def __init__(self,prefix):
+        self.prefix=prefix
+        self.last=None
+        self.since=0
+        self.taken=0
+        self.every=1
+        self.seconds=None
+        if CHECKPOINT_POLICY=='count':
+            self.every=CHECKPOINT_ITEMS
+        elif CHECKPOINT_POLICY=='time':
+            self.every=None
+            self.seconds=CHECKPOINT_SECONDS
+        elif CHECKPOINT_POLICY=='auto':
+            self.every=self.auto()
+            self.seconds=CHECKPOINT_SECONDS
+        else:
+            assert(CHECKPOINT_POLICY=='item')
+    def auto(self):
+        # Minimise snapshot cost per item plus the expected reinstall work
+        # after a failure: c/N + p*N*d/2, so N = sqrt(2c/(p*d)).
+        items,snapshots=load_item_history()
+        if not items:
+            return 1
+        p=sum(1 for i in items if not i['ok'])/len(items)
+        ok=[i['wall'] for i in items if i['ok']]
+        d=sum(ok)/len(ok) if ok else 0
+        c=sum(snapshots)/len(snapshots) if snapshots else 1
+        every=int((2*c/(p*d))**0.5) if p and d else 100
+        every=max(1,min(100,every))
+        print(f"\tCheckpoint every {every} items (failure rate {p:.3f}, {d:.1f}s per item, {c:.2f}s per snapshot)")
+        return every
+    def before(self,item):
+        due=self.last is None or (self.every and self.since>=self.every) or (self.seconds and time.time()-self.taken>=self.seconds)
+        if due:
+            name=self.prefix+item
+            take_snapshot(name)
+            if self.last:
+                commit_snapshot(self.last)
+            self.last=name
+            self.since=0
+            self.taken=time.time()
+        self.start=time.time()
+    def done(self,item):
+        self.since+=1
+        record_metric(dict(type='item',stage=self.prefix+item,ok=True,wall=round(time.time()-self.start,3)))
+    def failed(self,item):
+        record_metric(dict(type='item',stage=self.prefix+item,ok=False,wall=round(time.time()-self.start,3)))
+        if self.last:
+            rollback_snapshot(self.last)
+        self.last=None
+    def finish(self):
+        if self.last:
+            commit_snapshot(self.last)
+        self.last=None
+
+def open_log(log):
+    # Command logs are written as they are produced; with LOG_COMPRESS they
+    # are zstd-compressed on the fly and get a .zst suffix.
+    global LOG_COMPRESS
+    if LOG_COMPRESS and zstandard:
+        return zstandard.ZstdCompressor().stream_writer(open(f'{log}.zst','wb'))
+    if LOG_COMPRESS:
+        print("    LOG_COMPRESS needs the zstandard module; writing plain logs.")
+        LOG_COMPRESS=False
+    return open(log,'wb')
+
+class remotesession():
+    # Runs commands on the NAS over one multiplexed SSH connection, opened on
+    # first use and closed at the end of the build, instead of a full login
+    # per command.  With REMOTE_TRANSPORT='local' the "remote" commands and
+    # paths are run and used on this machine, which is how the publishing
+    # code can be exercised without a NAS.
+    def __init__(self,user,host):
+        self.target=f'{user}@{host}'
+        self.control=None
+        self.lock=threading.Lock()
+    def local(self):
+        return REMOTE_TRANSPORT=='local'
+    def ssh(self):
+        with self.lock:
+            if self.control is None:
+                self.control=os.path.join(tempfile.mkdtemp(prefix='netboot-ssh-'),'control')
+                rc=os.system(f'{SSH_COMMAND} -M -N -f -o ControlPersist=yes -o ControlPath={self.control} -o ForwardX11=no {self.target}')
+                if rc!=0:
+                    print("    Could not open a shared SSH connection; connecting per command.")
+                    self.control=''
+        if not self.control:
+            return f'{SSH_COMMAND} -o ForwardX11=no'
+        return f'{SSH_COMMAND} -o ControlPath={self.control} -o ForwardX11=no'
+    def command(self,cmd,stdin=True,tty=True):
+        if self.local():
+            return f'bash -c {shlex.quote(cmd)}'
+        return f'{self.ssh()} {"" if stdin else "-n "}{"-t " if tty else ""}{self.target} {shlex.quote(cmd)}'
+    def path(self,path):
+        # An rsync destination on the NAS.
+        if self.local():
+            return path
+        return f'{self.target}:{path}'
+    def rsync_shell(self):
+        if self.local():
+            return ''
+        return f'-e {shlex.quote(self.ssh())}'
+    def close(self):
+        with self.lock:
+            if self.control:
+                os.system(f'{SSH_COMMAND} -O exit -o ControlPath={self.control} {self.target} 2>/dev/null')
+                shutil.rmtree(os.path.dirname(self.control),ignore_errors=True)
+            self.control=None
+
+remote = remotesession(NAS_USER,NAS_IP)
+atexit.register(remote.close)
 
 class buildstage():
     def stagename(self):
         assert(False)
     def deps(self):
         return []
+    def resources(self):
+        # Named resources the stage needs exclusively; stages sharing one are
+        # never run at the same time.
+        return []
+    def exclusive(self):
+        # Whether the stage takes and rolls back snapshots of its own while
+        # it runs.  Those cover the whole root, so the stage runs alone.
+        return False
     def execute(self,handler=None):
         assert(False)
-    def test(self):
+    def inputs(self):
+        # What the stage's result depends on besides its dependencies, as
+        # ('file', host path), ('config', build_config setting) or
+        # ('text', string) pairs.
+        return []
+    def fingerprint(self):
+        return stage_fingerprint(type(self))
+    def marker_path(self):
+        return root/'.install/stages'/self.stagename().replace('/','_')
+    def recorded(self):
+        # The fingerprint in the stage's completion marker; '' for a stage
+        # completed before fingerprints were recorded, None if it is not.
+        try:
+            with open(self.marker_path(),'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return '' if self.legacy_complete() else None
+    def legacy_complete(self):
+        # How older builders found the stage complete: an empty marker
+        # directly in .install.
         return os.path.isfile(root/'.install'/self.stagename())
-
-    def capture_subprocess_output(self,subprocess_args,shell,print_out=True,print_err=True):
-        
+    def test(self):
+        recorded=self.recorded()
+        if recorded is None: return False
+        # Legacy markers are trusted once, and given the current fingerprint
+        # by buildplan.adopt().
+        return recorded=='' or recorded==self.fingerprint()
+    def stale(self):
+        # Complete once, but with inputs or dependencies that have changed.
+        recorded=self.recorded()
+        return bool(recorded) and recorded!=self.fingerprint()
+
+    def capture_subprocess_output(self,subprocess_args,shell,print_out=True,print_err=True,log=None,timefile=None):
+        # Output is read in large chunks as it arrives and written straight to
+        # the log, one write per chunk, with each line prefixed by the stream
+        # it came from.  Only the last CAPTURE_TAIL_LINES lines are kept in
+        # memory, for reporting errors.
         if echo: print(subprocess_args)
-        # Start subprocess
-        # bufsize = 1 means output is line buffered
-        # universal_newlines = True is required for line buffering
+        # The command and everything it starts are accounted in a cgroup leaf
+        # of their own under the stage's.
+        node = getattr(self,'cgroup',None) or stage_cgroup('other')
+        leaf = cgroups.leaf(node) if node else None
+        def preexec():
+            os.setpgrp()
+            if leaf:
+                build_events.join(str(leaf))
+        start = time.time()
         process = subprocess.Popen(subprocess_args,
                                    shell=shell,
-                                   bufsize=1,
-                                   preexec_fn=os.setpgrp,
+                                   preexec_fn=preexec,
                                    stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE,
-                                   universal_newlines=True,
-                                   errors='ignore')
-
-        # Create callback function for process output
-        buf = io.StringIO()
-        def handle_stdout(stream, mask):
-            nonlocal print_out
-            # Because the process' output is line buffered, there's only ever one
-            # line to read when this function is called
-            line = stream.readline()
-            if line:
-                buf.write("O: "+line)
-            if line and print_out:
-                sys.stdout.write(f'    {cur_stage:20s} | {line}')
-
-        def handle_stderr(stream, mask):
-            nonlocal print_err
-            # Because the process' output is line buffered, there's only ever one
-            # line to read when this function is called
-            line = stream.readline()
-            if line:
-                buf.write("E: "+line)
-            if line and print_err:
-                sys.stderr.write(f'    {cur_stage:20s} > {line}')
-
-        # Register callback for an "available for read" event from subprocess' stdout stream
-        selector = selectors.DefaultSelector()
-        selector.register(process.stdout, selectors.EVENT_READ, handle_stdout)
-        selector.register(process.stderr, selectors.EVENT_READ, handle_stderr)
-
-        # Loop until subprocess is terminated
-        while process.poll() is None:
-            # Wait for events and handle them with their registered callbacks
-            events = selector.select()
-            for key, mask in events:
-                callback = key.data
-                callback(key.fileobj, mask)
+                                   stderr=subprocess.PIPE)
+        with _children_lock:
+            _children.add(process)
+        cmd = subprocess_args if len(subprocess_args)<500 else subprocess_args[:500]+'...'
+        command_id = leaf.name[4:] if leaf else str(process.pid)
+        emit_event('cmd_start',id=command_id,pid=process.pid,cmd=cmd)
+
+        tail = collections.deque(maxlen=CAPTURE_TAIL_LINES)
+        logfile = open_log(log) if log else None
+        stage = get_stage()
+        streams = {
+            process.stdout.fileno(): (b'O: ', sys.stdout, '|', print_out),
+            process.stderr.fileno(): (b'E: ', sys.stderr, '>', print_err),
+        }
+        partial = {fd: b'' for fd in streams}
+
+        def handle(fd,lines):
+            tag,console,sep,echo_lines = streams[fd]
+            if logfile:
+                logfile.write(b''.join(tag+line+b'\n' for line in lines))
+            text = [line.decode(errors='ignore') for line in lines]
+            tail.extend(tag.decode()+line for line in text)
+            if echo_lines:
+                console.write(''.join(f'    {stage:20s} {sep} {line}\n' for line in text))
+                console.flush()
 
-        # Get process return code
-        return_code = process.wait()
-        selector.close()
-
-        # Store buffered output
-        output = buf.getvalue()
-        buf.close()
-
-        return (return_code, output)
-
-    def run_cmd(self,cmd,test=False,quiet=False,silent=False,log=None):
+        selector = selectors.DefaultSelector()
+        for fd in streams:
+            selector.register(fd, selectors.EVENT_READ)
+        try:
+            # Read until both pipes are at EOF, not just until the process
+            # exits, so no trailing output is lost.
+            while selector.get_map():
+                for key, mask in selector.select():
+                    fd = key.fd
+                    data = os.read(fd, 65536)
+                    if not data:
+                        selector.unregister(fd)
+                        if partial[fd]:
+                            handle(fd,[partial[fd]])
+                        continue
+                    lines = (partial[fd]+data).split(b'\n')
+                    partial[fd] = lines.pop()
+                    if lines:
+                        handle(fd,lines)
+        finally:
+            selector.close()
+            if logfile:
+                logfile.close()
+            process.stdout.close()
+            process.stderr.close()
+
+        # Get process return code and resource usage; the usage covers every
+        # descendant that was waited for, including those inside a chroot.
+        _, status, ru = os.wait4(process.pid, 0)
+        return_code = process.returncode = os.waitstatus_to_exitcode(status)
+        with _children_lock:
+            _children.discard(process)
+        usage = rusage_record(ru, time.time()-start)
+        if timefile:
+            write_timefile(timefile, usage)
+        add_stage_usage(usage)
+        record_metric(dict(type='cmd', stage=stage, cmd=cmd, rc=return_code, **usage))
+        accounted = build_events.totals(build_events.read_stats(leaf),{}) if leaf else {}
+        # Anything the command left running keeps its leaf until the end of
+        # the build.
+        lingering = len((build_events.read_file(leaf/'cgroup.procs') or '').split()) if leaf and not cgroups.remove(leaf) else 0
+        emit_event('cmd_end',stage=stage,id=command_id,rc=return_code,lingering=lingering,**dict(usage,**accounted))
+
+        return (return_code, '\n'.join(tail))
+
+    def run_cmd(self,cmd,test=False,quiet=False,silent=False,log=None,timefile=None):
         #print(cmd)
         so=not (quiet or silent)
         se=not silent
         #print(cmd)
-        rc,output = self.capture_subprocess_output(cmd, shell=True, print_out = so, print_err = se)
-        if log:
-            with open(log,'w') as f:
-                f.write(output)
+        rc,tail = self.capture_subprocess_output(cmd, shell=True, print_out = so, print_err = se, log = log, timefile = timefile)
+        if rc!=0 and not test:
+            print(f"    Command failed ({rc}): {cmd}",file=sys.stderr)
+            if not so:
+                print(tail,file=sys.stderr)
         if not test: assert(rc==0)
         return rc
-    def run_chroot(self,cmd,test=False,quiet=False,silent=False,log=None):
-        return self.run_cmd('arch-chroot "%s" bash -c %s'%(root,shlex.quote(cmd)),test,quiet,silent,log)
+    def chroot_prefix(self):
+        if CHROOT_SESSION and session.open():
+            return session.prefix()
+        return f'arch-chroot "{root}"'
+    def run_chroot(self,cmd,test=False,quiet=False,silent=False,log=None,timefile=None):
+        return self.run_cmd('%s bash -c %s'%(self.chroot_prefix(),shlex.quote(cmd)),test,quiet,silent,log,timefile)
+    def build_package(self,name,command,target=None,chroot=None,jobs=None,log=None,timefile=None):
+        # Runs command(env), the chroot command line of a makepkg or trizen
+        # run building package name, with env from build_env.  If the build
+        # fails with the build tmpfs full, it is run again on disk and name
+        # is added to disk_builds.  Records the package's ccache hit rate.
+        target = target or root
+        chroot = chroot or (lambda cmd: '%s bash -c %s'%(self.chroot_prefix(),shlex.quote(cmd)))
+        tmpfs = target/'var/tmp/makepkg'
+        disk = not os.path.ismount(tmpfs) or name in built_on_disk()
+        (ccache/'stats'/ccache_log(name)).unlink(missing_ok=True)
+        cmd = chroot(command(build_env(name,target,disk,jobs)))
+        rc = self.run_cmd(cmd,test=True,log=log,timefile=timefile)
+        if rc!=0 and not disk:
+            st=os.statvfs(tmpfs)
+            if st.f_bavail<st.f_blocks//50:
+                print(f"\t{name} does not fit in the {BUILD_TMPFS_GB} GiB build tmpfs, building it on disk")
+                with _buildcache_lock:
+                    with open(disk_builds,'a') as f:
+                        f.write(name+'\n')
+                self.run_cmd(f'find {shlex.quote(str(tmpfs))} -mindepth 1 -delete')
+                cmd = chroot(command(build_env(name,target,True,jobs)))
+                rc = self.run_cmd(cmd,test=True,log=log,timefile=timefile)
+        if os.path.ismount(tmpfs):
+            self.run_cmd(f'find {shlex.quote(str(tmpfs))} -mindepth 1 -delete')
+        stats = ccache_stats(name)
+        if stats and sum(stats):
+            hits,misses = stats
+            print(f"\tccache: {hits} hits, {misses} misses ({100*hits/(hits+misses):.0f}%) for {name}")
+            record_metric(dict(type='ccache',stage=get_stage(),package=name,hits=hits,misses=misses))
+        if rc!=0:
+            print(f"    Command failed ({rc}): {cmd}",file=sys.stderr)
+        assert(rc==0)
     def run_remote(self,cmd,test=False,quiet=False,silent=False,log=None):
-        cmd_quoted=shlex.quote(cmd)
-        return self.run_cmd(f'ssh -n -o ForwardX11=no -t {NAS_USER}@{NAS_IP} {cmd_quoted}',test,quiet,silent,log)
+        return self.run_cmd(remote.command(cmd,stdin=False),test,quiet,silent,log)
     def capture_cmd(self,cmd,test=False,silent=False):
         #print(cmd)
         #assert(False)
-        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL if silent else None)
+        start = time.time()
+        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL if silent else None)
+        with process.stdout:
+            out = process.stdout.read().decode()
+        _, status, ru = os.wait4(process.pid, 0)
+        return_code = process.returncode = os.waitstatus_to_exitcode(status)
+        usage = rusage_record(ru, time.time()-start)
+        add_stage_usage(usage)
+        record_metric(dict(type='cmd', stage=get_stage(), cmd=cmd if len(cmd)<500 else cmd[:500]+'...', rc=return_code, **usage))
         if test:
-            return result.stdout.decode(),result.returncode
+            return out,return_code
         else:
-            assert(result.returncode==0)
-            return result.stdout.decode()
+            assert(return_code==0)
+            return out
     def capture_chroot(self,cmd,test=False,silent=False):
-        return self.capture_cmd('arch-chroot "%s" %s'%(root,cmd),test)
+        return self.capture_cmd('%s %s'%(self.chroot_prefix(),cmd),test)
     def capture_remote(self,cmd,test=False,silent=False):
-        cmd_quoted=shlex.quote(cmd)
-        return self.capture_cmd(f'ssh -o ForwardX11=no -t {NAS_USER}@{NAS_IP} {cmd_quoted}',test,silent)
-    def test_equal(self,a,b):
-        with open(a,'rb') as f:
-            ca=f.read()
-        try:
-            with open(b,'rb') as f:
-                cb=f.read()
-        except:
-            return False
-        return ca==cb
+        return self.capture_cmd(remote.command(cmd),test,silent)
     def mark_complete(self):
-        with open(root/'.install'/self.stagename(),'w'):
-            pass
+        os.makedirs(self.marker_path().parent,exist_ok=True)
+        with open(self.marker_path(),'w') as f:
+            f.write(self.fingerprint()+'\n')
 
 class stageInstallFile(buildstage):
     def stagename(self):
         return "file: "+self.toInstall()[1]
-    def test(self):
+    def inputs(self):
+        f,t = self.toInstall()
+        return [('file',f),('text',t)]
+    def legacy_complete(self):
         f,t = self.toInstall()
         t=t.lstrip('/')
-        return self.test_equal(f,root/t)
+        try:
+            return filecmp.cmp(f,root/t,shallow=False)
+        except FileNotFoundError:
+            return False
     def execute(self,handler):
         f,t = self.toInstall()
         t=t.lstrip('/')
         shutil.copy(f,root/t)
+        self.mark_complete()
 
 class stageRootFS(buildstage):
     def stagename(self):
         return 'makerootfs'
+    def inputs(self):
+        return [('config','ZFS_CWD')]
     def execute(self,handler):
-        self.run_cmd(f"zfs create {ZFS_CWD}/.install")
+        archive_metrics()
+        self.run_cmd(f"zfs create {dataset}")
         self.run_cmd("mkdir %s"%(root/".install"))
         self.mark_complete()
 
@@ -213,8 +1040,12 @@ class stagePacstrap(buildstage):
         return 'pacstrap'
     def deps(self):
         return [stageRootFS]
+    def resources(self):
+        return ['pacman']
+    def inputs(self):
+        return [('file','pacman.conf')]
     def execute(self,handler):
-        self.run_cmd(f"/usr/bin/time -f '%U %S %e %E %P %X %D %M %I %O %F %R %W' -o {root}/.install/pacstrap.time pacstrap -C ./pacman.conf -d {root} base linux linux-headers linux-firmware mkinitcpio-nfs-utils nfs-utils wget zsh grub sudo sshfs base-devel git time", log=root/".install/pacstrap.log")
+        self.run_cmd(f"pacstrap -C ./pacman.conf -d {root} base linux linux-headers linux-firmware mkinitcpio-nfs-utils nfs-utils wget zsh grub sudo sshfs base-devel git time", timefile=root/".install/pacstrap.time", log=root/".install/pacstrap.log")
         self.mark_complete()
 
 class stageSublimeKey(buildstage):
@@ -222,6 +1053,8 @@ class stageSublimeKey(buildstage):
         return 'sublime-key'
     def deps(self):
         return [stagePacstrap]
+    def resources(self):
+        return ['pacman']
     def execute(self,handler):
         self.run_chroot('wget https://download.sublimetext.com/sublimehq-pub.gpg')
         self.run_chroot('pacman-key --add sublimehq-pub.gpg')
@@ -240,13 +1073,29 @@ class stageInitramfs(buildstage):
         return 'initramfs'
     def deps(self):
         return [stagePacstrap]
+    def resources(self):
+        return ['pacman']
+    def inputs(self):
+        return [('file','packages/overlayroot-0.2-2-any.pkg.tar.zst')]
     def execute(self,handler):
         self.run_chroot('sed s/nfsmount/mount.nfs4/ "/usr/lib/initcpio/hooks/net" > "/usr/lib/initcpio/hooks/netnfs4"')
         self.run_chroot('cp /usr/lib/initcpio/install/net{,nfs4}')
         file='packages/overlayroot-0.2-2-any.pkg.tar.zst'
-        self.run_cmd(f'/usr/bin/time -f \'%U %S %e %E %P %X %D %M %I %O %F %R %W\' -o {root}/.install/initramfs.overlayroot.time pacman --noconfirm --needed --root "{root}" --dbpath "{root}/var/lib/pacman" -U {file}', log=root/".install/initramfs.overlayroot.log")
+        self.run_cmd(f'pacman --noconfirm --needed --root "{root}" --dbpath "{root}/var/lib/pacman" --cachedir "{pkgcache}" -U {file}', timefile=root/".install/initramfs.overlayroot.time", log=root/".install/initramfs.overlayroot.log")
         self.mark_complete()
 
+class stageNetsquashHook(stageInstallFile):
+    def deps(self):
+        return [stageInitramfs]
+    def toInstall(self):
+        return 'initcpio/hooks/netsquash','/usr/lib/initcpio/hooks/netsquash'
+
+class stageNetsquashInstall(stageInstallFile):
+    def deps(self):
+        return [stageInitramfs]
+    def toInstall(self):
+        return 'initcpio/install/netsquash','/usr/lib/initcpio/install/netsquash'
+
 class stageMkinitcpioConf(stageInstallFile):
     def deps(self):
         return [stageInitramfs]
@@ -258,6 +1107,8 @@ class stageUpdate1(buildstage):
         return 'update1'
     def deps(self):
         return [stagePacstrap,stageSublimeKey,stagePacmanConf]
+    def resources(self):
+        return ['pacman']
     def execute(self,handler):
         self.run_chroot("pacman -Syu")
         self.mark_complete()
@@ -269,7 +1120,7 @@ class stageGrub(buildstage):
         return [stagePacstrap]
     def execute(self,handler):
         self.run_chroot('grub-mknetdir --net-directory=/boot --subdir=grub')
-        self.mark_complete
+        self.mark_complete()
 
 class stageFstab(stageInstallFile):
     def deps(self):
@@ -289,11 +1140,8 @@ class stageSystemSetup(buildstage):
         self.run_chroot('echo "en_US.UTF-8 UTF-8">  /etc/locale.gen')
         self.run_chroot('locale-gen')
         self.run_chroot('echo "LANG=en_US.UTF-8" >  /etc/locale.conf')
-        self.run_chroot('echo "icarus-nfs" > /etc/hostname')
-        self.run_chroot('echo "127.0.0.1    localhost" >   /etc/hosts')
-        self.run_chroot('echo "::1    localhost" >>  /etc/hosts')
-        self.run_chroot('echo "127.0.1.1    icarus-nfs" >> /etc/hosts')
         self.run_chroot('echo "blacklist pcspkr" | tee /etc/modprobe.d/nobeep.conf')
+        self.mark_complete()
 
 class stageSudoers(stageInstallFile):
     def deps(self):
@@ -306,9 +1154,12 @@ class stageUser(buildstage):
         return 'user'
     def deps(self):
         return [stageSudoers,stageSystemSetup]
+    def inputs(self):
+        return [('config','INNER_USER'),('config','ROOT_PASSWORD'),('config','INNER_PASSWORD')]
     def execute(self,handler):
-        self.run_chroot('groupadd sudo')
-        self.run_chroot(f'useradd -m -G sudo {INNER_USER}')
+        # Rerun when the settings change, so the group and user may exist.
+        self.run_chroot('groupadd -f sudo')
+        self.run_chroot(f'id -u {INNER_USER} >/dev/null 2>&1 || useradd -m -G sudo {INNER_USER}')
         with open(root/'password.file','w') as f:
             f.write(f'root:{ROOT_PASSWORD}\n')
             f.write(f'{INNER_USER}:{INNER_PASSWORD}\n')
@@ -323,15 +1174,46 @@ class stageMakepkgConf(stageInstallFile):
     def toInstall(self):
         return 'makepkg1.conf','/etc/makepkg.conf'
 
+class stageBuildCache(buildstage):
+    # Installs ccache and writes /etc/makepkg.build.conf, the makepkg.conf
+    # package builds run with (see build_env): MAKEFLAGS for the host's cores,
+    # unless a build sets its own, and ccache in BUILDENV.  It is removed by
+    # the cleanup stage.
+    def stagename(self):
+        return 'build-cache'
+    def deps(self):
+        return [stageMakepkgConf]
+    def resources(self):
+        return ['pacman']
+    def inputs(self):
+        return [('config','CCACHE'),('config','MAKE_JOBS'),('text',str(os.cpu_count()))]
+    def execute(self,handler):
+        if CCACHE:
+            self.run_chroot('pacman --noconfirm --needed -S ccache', timefile=root/".install/ccache.time", log=root/".install/ccache.log")
+        with open(root/'etc/makepkg.conf','r') as f:
+            conf=f.read()
+        conf+='\n# Package builds of build_image.py\n'
+        conf+=f'MAKEFLAGS="${{MAKEFLAGS:--j{MAKE_JOBS or os.cpu_count()}}}"\n'
+        if CCACHE:
+            conf+='BUILDENV=("${BUILDENV[@]/#!ccache/ccache}")\n'
+        with open(root/'etc/makepkg.build.conf','w') as f:
+            f.write(conf)
+        self.mark_complete()
+
 class stageTrizen(buildstage):
     def stagename(self):
         return 'trizen'
     def deps(self):
-        return [stageMakepkgConf]
+        return [stageBuildCache]
+    def resources(self):
+        return ['pacman']
+    def inputs(self):
+        return [('config','INNER_USER')]
     def execute(self,handler):
         self.run_chroot(f'sudo -u {INNER_USER} mkdir -p /home/{INNER_USER}/build')
+        self.run_chroot(f'rm -rf /home/{INNER_USER}/build/trizen')
         self.run_chroot(f'cd /home/{INNER_USER}/build; sudo -u {INNER_USER} git clone https://aur.archlinux.org/trizen.git')
-        self.run_chroot(f'/usr/bin/time -f \'%U %S %e %E %P %X %D %M %I %O %F %R %W\' -o /.install/trizen.time bash -c "cd /home/{INNER_USER}/build/trizen; sudo -u {INNER_USER} makepkg --noconfirm -si"', log=root/".install/trizen.log")
+        self.build_package('trizen',lambda env: f'cd /home/{INNER_USER}/build/trizen; sudo -u {INNER_USER} env {env} makepkg --noconfirm -si', timefile=root/".install/trizen.time", log=root/".install/trizen.log")
         self.run_chroot(f'mkdir -p /home/{INNER_USER}/.config/trizen/')
         self.mark_complete()
 
@@ -346,170 +1228,713 @@ class stageMountpoints(buildstage):
         return 'mountpoints'
     def deps(self):
         return [stagePacstrap]
-    def test(self):
+    def inputs(self):
+        return [('config','INNER_USER')]
+    def legacy_complete(self):
         return os.path.isdir(root/'tank')
     def execute(self,handler):
-        self.run_chroot('mkdir /tank')
-        self.run_chroot('mkdir /depot')
-        self.run_chroot('mkdir /athena')
+        self.run_chroot('mkdir -p /tank')
+        self.run_chroot('mkdir -p /depot')
+        self.run_chroot('mkdir -p /athena')
         self.run_chroot(f'chown {INNER_USER}:{INNER_USER} /tank')
         self.run_chroot(f'chown {INNER_USER}:{INNER_USER} /depot')
         self.run_chroot(f'chown {INNER_USER}:{INNER_USER} /athena')
+        self.mark_complete()
+
+# Keys from keys.txt are imported from KEYS_DIR (<key>.asc, for keys kept
+# with the configuration) or the host-side cache .cache/keys, and only fetched
+# from KEYSERVER, into the cache, when neither has them, so rebuilding the
+# keyring needs no network.
+keycache = cache / 'keys'
+
+def key_file(key):
+    for d in [Path(KEYS_DIR),keycache]:
+        for f in [d/f'{key}.asc',d/f'{key.lower()}.asc']:
+            if f.is_file():
+                return f
+    return None
+
+def fetch_key(key):
+    # Returns the cached file, or None if the keyserver has no such key.
+    url=f'{KEYSERVER}/pks/lookup?op=get&options=mr&search=0x{key}'
+    try:
+        with urllib.request.urlopen(url,timeout=60) as r:
+            data=r.read()
+    except OSError as e:
+        print(f"\tKey {key}: {e}",file=sys.stderr)
+        return None
+    if b'BEGIN PGP PUBLIC KEY BLOCK' not in data:
+        return None
+    keycache.mkdir(parents=True,exist_ok=True)
+    with open(keycache/f'{key}.asc.part','wb') as f:
+        f.write(data)
+    os.replace(keycache/f'{key}.asc.part',keycache/f'{key}.asc')
+    return keycache/f'{key}.asc'
 
 class stagePackageKeys(buildstage):
     def stagename(self):
         return 'packages-keys'
     def deps(self):
         return [stageTrizenConf]
-    def execute(self,handler):
+    def exclusive(self):
+        return True
+    def inputs(self):
+        return [('file','keys.txt'),('file',KEYS_DIR),('config','INNER_USER')]
+    def keys(self):
+        keys=[]
         with open('keys.txt','r') as f:
             for line in f:
-                line=line.strip()
-                if not line: continue
-                if self.run_chroot(f"sudo -u {INNER_USER} gpg --export -a {line} | grep 'BEGIN PGP PUBLIC KEY BLOCK'",test=True,quiet=True)!=0:
-                    print("\tInstalling key",line)
-                    cur_stage=f'PK-{line}'
-                    take_snapshot()
-                    try:
-                        self.run_chroot(f"sudo -u {INNER_USER} gpg --recv-keys --keyserver keys.gnupg.net {line}")
-                    except:
-                        rollback_snapshot()
-                        raise
-                    else:
-                        commit_snapshot()
-
+                line=line.strip().upper()
+                if not line or line[0]=='#': continue
+                keys.append(line[2:] if line.startswith('0X') else line)
+        return keys
+    def missing(self,keys):
+        # One listing of INNER_USER's keyring, matching key IDs and
+        # fingerprints of primary keys and subkeys.
+        out,_=self.capture_chroot(f'sudo -u {INNER_USER} gpg --batch --with-colons --fingerprint --list-keys',test=True)
+        have=set()
+        for line in out.split('\n'):
+            f=line.split(':')
+            if f[0] in ('pub','sub') and len(f)>4:
+                have.add(f[4].upper())
+            elif f[0]=='fpr' and len(f)>9:
+                have.add(f[9].upper())
+        return [k for k in keys if not any(h.endswith(k) or k.endswith(h) for h in have if h)]
+    def execute(self,handler):
+        keys=self.keys()
+        missing=self.missing(keys)
+        if missing:
+            files={k:key_file(k) for k in missing}
+            fetch=[k for k in missing if files[k] is None]
+            if fetch:
+                print(f"\tFetching {len(fetch)} keys from {KEYSERVER}")
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(fetch),PREFETCH_CONNECTIONS)) as pool:
+                    files.update(zip(fetch,pool.map(fetch_key,fetch)))
+            unavailable=[k for k in missing if files[k] is None]
+            if unavailable:
+                print("\tKeys not found:",' '.join(unavailable),file=sys.stderr)
+            assert(not unavailable)
+            print(f"\tInstalling {len(missing)} keys:",' '.join(missing))
+            with open(root/'.install/keys.asc','wb') as out:
+                for k in missing:
+                    with open(files[k],'rb') as f:
+                        out.write(f.read().rstrip(b'\n')+b'\n')
+            os.chmod(root/'.install/keys.asc',0o644)
+            set_stage('PK-import')
+            take_snapshot()
+            try:
+                self.run_chroot(f"sudo -u {INNER_USER} gpg --batch --import /.install/keys.asc", timefile=root/".install/keys.time", log=root/".install/keys.log")
+                missing=self.missing(missing)
+                if missing:
+                    print("\tKeys not in the keyring after importing them:",' '.join(missing),file=sys.stderr)
+                assert(not missing)
+            except:
+                rollback_snapshot()
+                raise
+            else:
+                commit_snapshot()
+            finally:
+                os.unlink(root/'.install/keys.asc')
+                set_stage(self.stagename())
+        if not handler.interrupted:
+            self.mark_complete()
 
 class stagePackagesEarly(buildstage):
     def stagename(self):
         return 'packages-early'
     def deps(self):
         return [stagePackageKeys]
+    def resources(self):
+        return ['pacman']
+    def inputs(self):
+        return [('file',i) for i in sorted(glob.glob('packages/E*'))]
     def execute(self,handler):
         self.run_chroot('mkdir -p /.install/packages/complete/early')
         self.run_chroot('mkdir -p /.install/packages/logs/early')
         self.run_chroot('mkdir -p /.install/packages/times/early')
         for i in sorted(glob.glob('packages/E*')):
             _,fn = os.path.split(i)
-            cur_stage=f'PE-{i}'
+            set_stage(f'PE-{fn}')
             if os.path.isfile(root/".install/packages/complete/early"/fn):
                 continue
-            self.run_cmd(f'/usr/bin/time -f \'%U %S %e %E %P %X %D %M %I %O %F %R %W\' -o "{root}/.install/packages/times/early/{fn}" pacman --noconfirm --needed --root "{root}" --dbpath "{root}/var/lib/pacman" -U {i}', log=root/".install/packages/logs/early"/fn)
+            self.run_cmd(f'pacman --noconfirm --needed --root "{root}" --dbpath "{root}/var/lib/pacman" --cachedir "{pkgcache}" -U {i}', timefile=root/".install/packages/times/early"/fn, log=root/".install/packages/logs/early"/fn)
             with open(root/".install/packages/complete/early"/fn,'w'):
                 pass
+        set_stage(self.stagename())
+        self.mark_complete()
+
+aurrepo = cache / 'aur'
+_aurrepo_lock = threading.Lock()
+
+def aur_info(names):
+    # Look packages up through the AUR RPC interface, a hundred at a time.
+    info={}
+    names=sorted(names)
+    for n in range(0,len(names),100):
+        query=urllib.parse.urlencode([('arg[]',name) for name in names[n:n+100]])
+        with urllib.request.urlopen(f'{AUR_URL}/rpc/v5/info?{query}',timeout=60) as r:
+            for result in json.load(r)['results']:
+                info[result['Name']]=result
+    return info
+
+def aur_depends(pkg):
+    deps=pkg.get('Depends',[])+pkg.get('MakeDepends',[])+pkg.get('CheckDepends',[])
+    return {re.split('[<>=]',dep)[0] for dep in deps}
+
+def aur_resolve(targets,known):
+    # The AUR packages among targets and the AUR-only dependency closure;
+    # dependencies in known (the repositories, the local AUR repository) are
+    # left to makepkg -s.
+    info={}
+    queried=set()
+    wanted=set(targets)
+    while wanted:
+        queried|=wanted
+        found=aur_info(wanted)
+        info.update(found)
+        wanted={dep for pkg in found.values() for dep in aur_depends(pkg)}-known-queried
+    return info
+
+def aurrepo_packages():
+    # The packages in the local AUR repository, with their newest version.
+    versions={}
+    for f in glob.glob(str(aurrepo/'*.pkg.tar.*')):
+        if f.endswith('.sig'): continue
+        name,ver,rel,_=os.path.basename(f).rsplit('-',3)
+        if name not in versions or pacdb.vercmp(f'{ver}-{rel}',versions[name])>0:
+            versions[name]=f'{ver}-{rel}'
+    return versions
+
+def aurrepo_conf(path,alone=False):
+    # A copy of the target's pacman.conf with the local AUR repository added.
+    # With alone, the other repositories are left out: refreshing with it
+    # updates the local repository's database and no other, so the target
+    # is never installed into from sync databases newer than its upgrade.
+    with open(path,'r') as f:
+        conf=f.read()
+    if alone:
+        kept=[]
+        section=None
+        for line in conf.split('\n'):
+            if line.strip().startswith('['):
+                section=line.strip()
+            if section in (None,'[options]'):
+                kept.append(line)
+        conf='\n'.join(kept)
+    return conf+'\n[aurlocal]\nSigLevel = Optional TrustAll\nServer = file:///var/cache/aurlocal\n'
+
+def pacman_db():
+    # The target's sync and local package databases, read from disk rather
+    # than queried with pacman in the chroot (see pacdb.py).  The parsed
+    # databases are cached in .cache/pacdb until they change.
+    return pacdb.pacmandb(root,cache/'pacdb')
+
+# Downloads made ahead of the stages that need them (see stagePrefetch): AUR
+# git repositories are mirrored into .cache/aur-git, and the source files
+# their PKGBUILDs list into .cache/srcdest, which the AUR build roots use as
+# makepkg's SRCDEST.
+aurgit = cache / 'aur-git'
+srcdest = cache / 'srcdest'
+
+class prefetcher():
+    # Fetches files into the host caches on PREFETCH_CONNECTIONS threads, in
+    # the order they were queued, while the build goes on.  A file is written
+    # under a .part name and renamed when complete, so pacman and makepkg only
+    # ever see whole files.  Failures are reported and left for the
+    # installing stage to download again.
+    def __init__(self):
+        self.pool=None
+        self.futures=[]
+        self.lock=threading.Lock()
+        self.start=None
+        self.files=0
+        self.bytes=0
+        self.failed=0
+    def submit(self,fn,*args):
+        with self.lock:
+            if self.pool is None:
+                self.pool=concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_CONNECTIONS)
+                self.start=time.time()
+            self.futures.append(self.pool.submit(self.guard,fn,*args))
+    def guard(self,fn,*args):
+        try:
+            fn(*args)
+        except Exception as e:
+            with self.lock:
+                self.failed+=1
+            print(f"    Prefetch failed: {args[0]}: {e}",file=sys.stderr)
+    def fetch(self,url,dest):
+        if not dest.exists():
+            self.submit(self.download,url,dest)
+    def download(self,url,dest):
+        if dest.exists(): return
+        tmp=dest.parent/f'{dest.name}.prefetch.part'
+        try:
+            with urllib.request.urlopen(url,timeout=60) as r, open(tmp,'wb') as f:
+                shutil.copyfileobj(r,f,1<<20)
+                size=f.tell()
+            os.replace(tmp,dest)
+        finally:
+            tmp.unlink(missing_ok=True)
+        with self.lock:
+            self.files+=1
+            self.bytes+=size
+    def mirror(self,base):
+        # Mirror an AUR package's git repository, then queue its sources.
+        dest=aurgit/f'{base}.git'
+        if dest.is_dir():
+            assert(os.system(f'git --git-dir={shlex.quote(str(dest))} fetch -q --prune')==0)
+        else:
+            tmp=aurgit/f'{base}.git.part'
+            shutil.rmtree(tmp,ignore_errors=True)
+            assert(os.system(f'git clone -q --mirror {shlex.quote(f"{AUR_URL}/{base}.git")} {shlex.quote(str(tmp))}')==0)
+            os.replace(tmp,dest)
+        srcinfo=subprocess.run(['git',f'--git-dir={dest}','show','HEAD:.SRCINFO'],stdout=subprocess.PIPE,stderr=subprocess.DEVNULL).stdout.decode(errors='ignore')
+        for line in srcinfo.split('\n'):
+            key,_,value=line.strip().partition(' = ')
+            if key not in ('source','source_x86_64'): continue
+            name,_,url=value.rpartition('::')
+            # Version control sources are left to makepkg, which keeps its
+            # own clones of them in SRCDEST.
+            if not re.match('(https?|ftp)://',url): continue
+            self.fetch(url,srcdest/(name or os.path.basename(urllib.parse.urlparse(url).path)))
+    def aur(self,targets,known):
+        aurgit.mkdir(parents=True,exist_ok=True)
+        srcdest.mkdir(parents=True,exist_ok=True)
+        os.chmod(srcdest,0o1777)
+        for base in sorted({pkg['PackageBase'] for pkg in aur_resolve(targets,known).values()}):
+            self.submit(self.mirror,base)
+    def wait(self):
+        # Until everything queued so far, and anything it queued, is done.
+        while True:
+            with self.lock:
+                pending=[f for f in self.futures if not f.done()]
+            if not pending: return
+            concurrent.futures.wait(pending)
+    def close(self):
+        # Drop what has not started and wait for the rest.
+        with self.lock:
+            pool=self.pool
+            self.pool=None
+        if pool is None: return
+        pool.shutdown(wait=True,cancel_futures=True)
+        wall=time.time()-self.start
+        print(f"Prefetch: {self.files} files ({self.bytes/2**20:.0f} MiB) in {wall:.0f}s, {self.failed} failed")
+        record_metric(dict(type='prefetch',files=self.files,bytes=self.bytes,failed=self.failed,wall=round(wall,3)))
+        self.futures=[]
+
+prefetch = prefetcher()
+
+class stagePrefetch(buildstage):
+    # Resolves everything packages-main will install from the repositories
+    # (with dependencies, and groups expanded) and the AUR packages it will
+    # build, queues their downloads and returns.  The downloads go on in the
+    # background while the following stages run; packages-main waits for
+    # them before its pacman transaction.  It writes only to the host caches,
+    # so it has no snapshot and no completion marker.
+    def stagename(self):
+        return 'prefetch'
+    def deps(self):
+        return [stageUpdate1]
+    def resources(self):
+        return ['pacman']
+    def test(self):
+        return not PREFETCH
+    def execute(self,handler):
+        pm=stagePackagesMain()
+        todo=[e for e in pm.entries() if not os.path.isfile(pm.marker(e))]
+        if not todo: return
+        db=pacman_db()
+        targets=[e[2:] if e.startswith('g:') else e for e in todo if e.startswith('g:') or e in db.sync]
+        # What pacman -S --needed would download, with dependencies; targets
+        # that cannot be resolved are skipped here and fail in packages-main.
+        needed,_=db.closure(targets)
+        urls=[u for u in map(db.url,(p['name'] for p in needed)) if u and '://' in u and not u.startswith('file://')]
+        print(f"\tQueued {len(urls)} package downloads")
+        pkgcache.mkdir(parents=True,exist_ok=True)
+        for url in urls:
+            prefetch.fetch(url,pkgcache/urllib.parse.unquote(os.path.basename(urllib.parse.urlparse(url).path)))
+        aur=[e for e in todo if not e.startswith('g:') and e not in db.sync]
+        if aur:
+            prefetch.submit(prefetch.aur,aur,set(db.sync)|set(db.local)|set(aurrepo_packages()))
+
+class stageAURFarm(buildstage):
+    # Builds the AUR packages from packages.txt, and the AUR packages they
+    # depend on, ahead of packages-main.  Every package base is built in its
+    # own ZFS clone of the install root, AUR_WORKERS at a time, in dependency
+    # order.  The results are collected in a local repository (.cache/aur),
+    # which the build roots resolve AUR dependencies from and which
+    # packages-main installs from in one transaction.
+    def stagename(self):
+        return 'packages-aur'
+    def deps(self):
+        return [stagePackagesEarly,stagePrefetch]
+    def resources(self):
+        return ['pacman']
+    def inputs(self):
+        return [('text',e) for e in stagePackagesMain().entries() if not e.startswith('g:')]
+    def execute(self,handler):
+        self.run_chroot('mkdir -p /.install/packages/logs/aur')
+        self.run_chroot('mkdir -p /.install/packages/times/aur')
+        aurrepo.mkdir(parents=True,exist_ok=True)
+        pm=stagePackagesMain()
+        targets=[e for e in pm.entries() if not e.startswith('g:') and not os.path.isfile(pm.marker(e))]
+        db=pacman_db()
+        available=set(db.sync)|set(db.local)
+        targets={e for e in targets if e not in available}
+        info=aur_resolve(targets,available)
+        missing=targets-set(info)
+        if missing:
+            print("\tNot found in AUR, left to trizen:",' '.join(sorted(missing)))
+        # What the local repository has in the AUR's version or newer is not
+        # rebuilt; a base is rebuilt when any of its packages is outdated.
+        built=aurrepo_packages()
+        current={n for n,pkg in info.items() if n in built and pacdb.vercmp(pkg['Version'],built[n])<=0}
+        outdated={pkg['PackageBase'] for n,pkg in info.items() if n not in current}
+        newer=sorted({pkg['PackageBase'] for n,pkg in info.items() if n in built and n not in current})
+        if newer:
+            print("\tNewer in the AUR than in the local repository:",' '.join(newer))
+        info={n:pkg for n,pkg in info.items() if pkg['PackageBase'] in outdated}
+        base_of={pkg['Name']:pkg['PackageBase'] for pkg in info.values()}
+        needs={base:set() for base in base_of.values()}
+        for pkg in info.values():
+            for dep in aur_depends(pkg):
+                if dep in base_of and base_of[dep]!=pkg['PackageBase']:
+                    needs[pkg['PackageBase']].add(base_of[dep])
+        if not needs:
+            self.mark_complete()
+            return
+        print(f"\tBuilding {len(needs)} AUR package bases with {AUR_WORKERS} workers")
+        # Any snapshot left by an interrupted run goes, with its clones.
+        os.system(f'zfs destroy -R {dataset}@aurfarm 2>/dev/null')
+        assert(os.system(f'zfs snapshot {dataset}@aurfarm')==0)
+        try:
+            self.build_all(needs,handler)
+        finally:
+            assert(os.system(f'zfs destroy -R {dataset}@aurfarm')==0)
+        if handler.interrupted:
+            return
+        self.mark_complete()
+    def build_all(self,needs,handler):
+        usage=_stage_local.usage
+        waiting={base:set(n) for base,n in needs.items()}
+        running={}
+        errors=[]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=AUR_WORKERS) as pool:
+            while waiting or running:
+                if not (errors or handler.interrupted):
+                    for base in sorted(waiting):
+                        if len(running)>=AUR_WORKERS: break
+                        if waiting[base]: continue
+                        del waiting[base]
+                        running[pool.submit(self.build,base,usage)]=base
+                if not running:
+                    break
+                done,_=concurrent.futures.wait(running,return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    base=running.pop(fut)
+                    if fut.exception() is not None:
+                        errors.append(fut.exception())
+                        continue
+                    for w in waiting.values():
+                        w.discard(base)
+        if errors:
+            raise errors[0]
+    def build(self,base,usage):
+        set_stage(f'PA-{base}')
+        # The commands count towards the stage's totals.
+        _stage_local.usage=usage
+        name=re.sub('[^A-Za-z0-9_.:-]','_',base)
+        ds=f'{ZFS_CWD}/.aurbuild-{name}'
+        broot=cwd/f'.aurbuild-{name}'
+        builddir=f'/home/{INNER_USER}/build/{base}'
+        def chroot(cmd):
+            return 'arch-chroot "%s" bash -c %s'%(broot,shlex.quote(cmd))
+        self.run_cmd(f'zfs clone {dataset}@aurfarm {ds}')
+        try:
+            with open(broot/'etc/pacman.conf','w') as f:
+                f.write(aurrepo_conf(root/'etc/pacman.conf'))
+            with open(broot/'etc/pacman.aurlocal.conf','w') as f:
+                f.write(aurrepo_conf(root/'etc/pacman.conf',alone=True))
+            os.makedirs(broot/'var/cache/aurlocal',exist_ok=True)
+            self.run_cmd(f'mount --bind {aurrepo} {broot}/var/cache/aurlocal')
+            # Sources and git repositories fetched by the prefetch stage.
+            srcdest.mkdir(parents=True,exist_ok=True)
+            os.chmod(srcdest,0o1777)
+            os.makedirs(broot/'var/cache/srcdest',exist_ok=True)
+            self.run_cmd(f'mount --bind {srcdest} {broot}/var/cache/srcdest')
+            mirrored=(aurgit/f'{base}.git').is_dir()
+            if mirrored:
+                os.makedirs(broot/'var/cache/aurgit',exist_ok=True)
+                self.run_cmd(f'mount --bind -o ro {aurgit} {broot}/var/cache/aurgit')
+            mount_pkgcache(broot)
+            # The workers' tmpfs builds share BUILD_TMPFS_GB between them.
+            mount_buildcache(broot,BUILD_TMPFS_GB/AUR_WORKERS)
+            try:
+                self.run_cmd(chroot('pacman --config /etc/pacman.aurlocal.conf -Sy'),quiet=True)
+                url=f'/var/cache/aurgit/{base}.git' if mirrored else f'{AUR_URL}/{base}.git'
+                self.run_cmd(chroot(f'sudo -u {INNER_USER} git clone {url} {builddir}'),quiet=True)
+                # The host's cores are shared by AUR_WORKERS builds.
+                jobs=MAKE_JOBS or max(1,os.cpu_count()//AUR_WORKERS)
+                self.build_package(base,lambda env: f'cd {builddir}; sudo -u {INNER_USER} env SRCDEST=/var/cache/srcdest {env} makepkg --noconfirm -s', broot, chroot, jobs, timefile=root/".install/packages/times/aur"/base, log=root/".install/packages/logs/aur"/base)
+                files=self.capture_cmd(chroot(f'cd {builddir}; sudo -u {INNER_USER} makepkg --packagelist')).split()
+            finally:
+                umount_buildcache(broot)
+                umount_pkgcache(broot)
+                if mirrored:
+                    self.run_cmd(f'umount {broot}/var/cache/aurgit')
+                self.run_cmd(f'umount {broot}/var/cache/srcdest')
+                self.run_cmd(f'umount {broot}/var/cache/aurlocal')
+            with _aurrepo_lock:
+                for f in files:
+                    shutil.copy(broot/f.lstrip('/'),aurrepo)
+                self.run_cmd(f'repo-add -R {aurrepo}/aurlocal.db.tar.gz '+' '.join(str(aurrepo/os.path.basename(f)) for f in files),quiet=True)
+        finally:
+            self.run_cmd(f'zfs destroy {ds}')
 
 class stagePackagesMain(buildstage):
     def stagename(self):
         return 'packages-main'
     def deps(self):
-        return [stagePackagesEarly]
+        if AUR_WORKERS and PACKAGE_BATCH:
+            return [stagePrefetch,stagePackagesEarly,stageAURFarm]
+        return [stagePrefetch,stagePackagesEarly]
+    def resources(self):
+        return ['pacman']
+    def exclusive(self):
+        return True
+    def inputs(self):
+        return [('text',e) for e in self.entries()]
     def execute(self,handler):
-        global cur_stage
         #assert(False)
-        self.run_chroot('mkdir -p /.install/packages/complete/main')
-        self.run_chroot('mkdir -p /.install/packages/logs/main')
-        self.run_chroot('mkdir -p /.install/packages/times/main')
-        self.run_chroot('mkdir -p /.install/packagegroups/complete/main')
-        self.run_chroot('mkdir -p /.install/packagegroups/logs/main')
-        self.run_chroot('mkdir -p /.install/packagegroups/times/main')
+        for what in ['complete','logs','times']:
+            self.run_chroot(f'mkdir -p /.install/packages/{what}/{self.listname()}')
+            self.run_chroot(f'mkdir -p /.install/packagegroups/{what}/{self.listname()}')
         #assert(False)
-        with open('packages.txt','r') as f:
-            for line in f:
+        if PACKAGE_BATCH:
+            self.install_batched(handler)
+        else:
+            self.install_each(handler)
+        set_stage(self.stagename())
+        if not handler.interrupted:
+            self.mark_complete()
+    def listname(self):
+        return 'main'
+    def listfiles(self):
+        return ['packages.txt']
+    def entries(self):
+        entries=[]
+        for listfile in self.listfiles():
+            with open(listfile,'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line: continue
+                    if line[0]=='#': continue
+                    entries.append(line)
+        return entries
+    def entry_path(self,entry,what):
+        # Completion marker, log or time file of a packages.txt entry.
+        if entry.startswith('g:'):
+            return root/".install/packagegroups"/what/self.listname()/entry[2:]
+        return root/".install/packages"/what/self.listname()/entry
+    def marker(self,entry):
+        return self.entry_path(entry,'complete')
+    def mark_entry(self,entry):
+        with open(self.marker(entry),'w'):
+            pass
+    def install_trizen(self,entry,packages,ckpt):
+        # Install a single packages.txt entry through trizen.
+        set_stage(f'PM-{entry}')
+        pl=' '.join(packages)
+        ckpt.before(entry)
+        try:
+            self.build_package(entry,lambda env: f"sudo -u {INNER_USER} env {env} trizen --noconfirm --needed -S {pl}", timefile=self.entry_path(entry,'times'), log=self.entry_path(entry,'logs'))
+            self.mark_entry(entry)
+        except:
+            ckpt.failed(entry)
+            raise
+        ckpt.done(entry)
+    def install_each(self,handler):
+        ckpt=checkpoints('PM-')
+        try:
+            self.install_each_entry(handler,ckpt)
+        finally:
+            ckpt.finish()
+    def install_each_entry(self,handler,ckpt):
+        db=pacman_db()
+        for line in self.entries():
+            if handler.interrupted:
+                return
+            if os.path.isfile(self.marker(line)):
+                continue
+            set_stage(f'PM-{line}')
+            if line.startswith('g:'):
+                print("\tTrying group",line[2:])
+                packages=db.group(line[2:])
+                if not packages:
+                    sys.exit(f'Group not found: {line[2:]}')
+            else:
+                print("\tTrying package",line)
+                packages=[line]
+            if not packages or not all(db.installed(p) for p in packages):
+                self.install_trizen(line,packages,ckpt)
+                db=pacman_db()
+            else:
+                self.mark_entry(line)
+    def install_batched(self,handler):
+        # Read the installed and available package sets and expand all groups
+        # up front, so each entry can be classified without a chroot
+        # round-trip of its own.
+        todo=[e for e in self.entries() if not os.path.isfile(self.marker(e))]
+        if not todo: return
+        db=pacman_db()
+        packages={e:db.group(e[2:]) if e.startswith('g:') else [e] for e in todo}
+        # Groups are only looked up in the sync repositories, not the AUR.
+        unknown=[e[2:] for e in todo if e.startswith('g:') and not packages[e]]
+        if unknown:
+            sys.exit(f"Group not found: {' '.join(unknown)}")
+        repo=[]
+        aur=[]
+        for e in todo:
+            if packages[e] and all(db.installed(p) for p in packages[e]):
+                self.mark_entry(e)
+            elif packages[e] and all(p in db.sync for p in packages[e]):
+                repo.append(e)
+            else:
+                aur.append(e)
+        print(f"\t{len(todo)-len(repo)-len(aur)} already installed, {len(repo)} from repositories, {len(aur)} from AUR")
+        if repo:
+            self.install_repo(repo,packages,handler)
+        local=aurrepo_packages()
+        local=[e for e in aur if e in local]
+        if local:
+            self.install_local(local,packages,handler)
+        aur=[e for e in aur if e not in local]
+        if not aur:
+            return
+        ckpt=checkpoints('PM-')
+        try:
+            for e in aur:
                 if handler.interrupted:
                     return
-                line = line.strip()
-                if not line: continue
-                if line[0]=='#': continue
-                cur_stage=f'PM-{line}'
-                if line.startswith('g:'):
-                    line = line[2:]
-                    if os.path.isfile(root/".install/packagegroups/complete/main"/line):
-                        continue
-                    print("\tTrying group",line)
-                    packages=[]
-                    for pkg in self.capture_chroot("pacman -Sg %s"%line).split('\n'):
-                        if pkg.strip():
-                            packages.append(pkg.split(' ')[1].strip())
-                    if self.run_chroot("pacman -Qi %s"%' '.join(packages),test=True,silent=True)!=0:
-                        pl=' '.join(packages)
-                        take_snapshot()
-                        try:
-                            self.run_chroot(f"/usr/bin/time -f '%U %S %e %E %P %X %D %M %I %O %F %R %W' -o /.install/packagegroups/times/main/{line} sudo -u {INNER_USER} trizen --noconfirm --needed -S {pl}", log=root/".install/packagegroups/logs/main"/line)
-                            with open(root/".install/packagegroups/complete/main"/line,'w'):
-                                pass
-                        except:
-                            rollback_snapshot()
-                            raise
-                        else:
-                            commit_snapshot()
-                    else:
-                        with open(root/".install/packagegroups/complete/main"/line,'w'):
-                            pass
-                else:
-                    if os.path.isfile(root/".install/packages/complete/main"/line):
-                        continue
-                    print("\tTrying package",line)
-                    #assert(self.run_chroot("pacman -Sg %s"%line,test=True)!=0)
-                    if self.run_chroot("pacman -Qi %s"%line,test=True,silent=True)!=0:
-                        take_snapshot()
-                        try:
-                            self.run_chroot(f"/usr/bin/time -f '%U %S %e %E %P %X %D %M %I %O %F %R %W' -o /.install/packages/times/main/{line} sudo -u {INNER_USER} trizen --noconfirm --needed -S {line}", log=root/".install/packages/logs/main"/line)
-                            with open(root/".install/packages/complete/main"/line,'w'):
-                                pass
-                        except:
-                            rollback_snapshot()
-                            raise
-                        else:
-                            commit_snapshot()
-                    else:
-                        with open(root/".install/packages/complete/main"/line,'w'):
-                            pass
-        cur_stage = self.stagename()
+                print("\tTrying","group" if e.startswith('g:') else "package",e)
+                self.install_trizen(e,packages[e],ckpt)
+        finally:
+            ckpt.finish()
+    def install_local(self,entries,packages,handler):
+        # Install entries built by packages-aur from the local repository.
+        with open(root/'etc/pacman.aurlocal.conf','w') as f:
+            f.write(aurrepo_conf(root/'etc/pacman.conf'))
+        with open(root/'etc/pacman.aurlocal-sync.conf','w') as f:
+            f.write(aurrepo_conf(root/'etc/pacman.conf',alone=True))
+        os.makedirs(root/'var/cache/aurlocal',exist_ok=True)
+        self.run_cmd(f'mount --bind {aurrepo} {root}/var/cache/aurlocal')
+        try:
+            self.run_chroot('pacman --config /etc/pacman.aurlocal-sync.conf -Sy',quiet=True)
+            self.install_repo(entries,packages,handler,pacman='pacman --config /etc/pacman.aurlocal.conf')
+        finally:
+            self.run_cmd(f'umount {root}/var/cache/aurlocal')
+            os.remove(root/'etc/pacman.aurlocal.conf')
+            os.remove(root/'etc/pacman.aurlocal-sync.conf')
+    def install_repo(self,entries,packages,handler,pacman='pacman'):
+        # Install entries from the sync repositories in one pacman transaction.
+        # If the transaction fails it is rolled back and split in half, down to
+        # single entries, so a bad entry fails on its own as it would when
+        # installed one at a time.
+        if handler.interrupted:
+            return
+        name=entries[0] if len(entries)==1 else f'batch-{len(entries)}-{entries[0]}'
+        set_stage(f'PM-{name}')
+        print(f"\tInstalling {len(entries)} entries:",' '.join(entries))
+        pl=' '.join(sorted({p for e in entries for p in packages[e]}))
+        prefetch.wait()
+        take_snapshot()
+        try:
+            rc=self.run_chroot(f"{pacman} --noconfirm --needed -S {pl}", test=len(entries)>1, timefile=self.entry_path(name,'times'), log=self.entry_path(name,'logs'))
+            if rc==0:
+                for e in entries:
+                    self.mark_entry(e)
+        except:
+            rollback_snapshot()
+            raise
+        if rc!=0:
+            rollback_snapshot()
+            half=len(entries)//2
+            self.install_repo(entries[:half],packages,handler,pacman)
+            self.install_repo(entries[half:],packages,handler,pacman)
+        else:
+            commit_snapshot()
+
+class stagePackagesVariant(stagePackagesMain):
+    # The entries of the PACKAGE_LISTS files, installed on top of the shared
+    # root as packages-main installs packages.txt; AUR entries go through
+    # trizen.
+    def stagename(self):
+        return 'packages-variant'
+    def deps(self):
+        return [stageExtraRootFiles]
+    def listname(self):
+        return 'variant'
+    def listfiles(self):
+        return PACKAGE_LISTS
+    def inputs(self):
+        return [('text',e) for e in self.entries()]
 
 class stagePackagesLate(buildstage):
     def stagename(self):
         return 'packages-late'
     def deps(self):
         return [stagePackagesMain]
+    def resources(self):
+        return ['pacman']
+    def inputs(self):
+        return [('file',i) for i in sorted(glob.glob('packages/L*'))]
     def execute(self,handler):
         self.run_chroot('mkdir -p /.install/packages/complete/late')
         self.run_chroot('mkdir -p /.install/packages/logs/late')
         self.run_chroot('mkdir -p /.install/packages/times/late')
         for i in sorted(glob.glob('packages/L*')):
             _,fn = os.path.split(i)
-            cur_stage=f'PL-{i}'
+            set_stage(f'PL-{fn}')
             if os.path.isfile(root/".install/packages/complete/late"/fn):
                 continue
-            self.run_cmd(f'/usr/bin/time -f \'%U %S %e %E %P %X %D %M %I %O %F %R %W\' -o "{root}/.install/packages/times/late/{fn}" pacman --noconfirm --needed --root "{root}" --dbpath "{root}/var/lib/pacman" -U {i}', log=root/".install/packages/logs/late"/fn)
+            self.run_cmd(f'pacman --noconfirm --needed --root "{root}" --dbpath "{root}/var/lib/pacman" --cachedir "{pkgcache}" -U {i}', timefile=root/".install/packages/times/late"/fn, log=root/".install/packages/logs/late"/fn)
             with open(root/".install/packages/complete/late"/fn,'w'):
                 pass
+        set_stage(self.stagename())
+        self.mark_complete()
 
 class stagePackages(buildstage):
     def stagename(self):
         return 'packages'
     def deps(self):
-        return [stageUpdate1,stageTrizenConf,stageMountpoints,stagePackagesLate]
+        # Prefetch right after update1, so the downloads overlap the stages
+        # leading up to packages-main.
+        return [stageUpdate1,stagePrefetch,stageTrizenConf,stageMountpoints,stagePackagesLate]
     def execute(self,handler):
-        pass
+        self.mark_complete()
 
 class stageModFuse(buildstage):
     def stagename(self):
         return 'mod-fuse'
     def deps(self):
         return [stagePacstrap]
-    def test(self):
+    def legacy_complete(self):
         return os.path.isfile(root/'etc/modules-load.d/fuse.conf')
     def execute(self,handler):
         self.run_chroot('echo fuse > /etc/modules-load.d/fuse.conf')
+        self.mark_complete()
 
 class stageModZFS(buildstage):
     def stagename(self):
         return 'mod-zfs'
     def deps(self):
         return [stagePacstrap]
-    def test(self):
+    def legacy_complete(self):
         return os.path.isfile(root/'etc/modules-load.d/zfs.conf')
     def execute(self,handler):
         self.run_chroot('echo zfs > /etc/modules-load.d/zfs.conf')
+        self.mark_complete()
 
 class stageZpoolCache(stageInstallFile):
     def deps(self):
@@ -521,104 +1946,917 @@ class stageServices(buildstage):
     def stagename(self):
         return 'services'
     def deps(self):
-        return [stagePackages]
+        return [stagePackagesVariant]
+    def inputs(self):
+        return [('config','SERVICES')]
     def execute(self,handler):
-        self.run_chroot('systemctl enable sshd')
-        self.run_chroot('systemctl enable docker')
-        self.run_chroot('systemctl enable bumblebeed')
+        for service in SERVICES:
+            self.run_chroot(f'systemctl enable {service}')
         self.mark_complete()
 
 class stageGroups(buildstage):
     def stagename(self):
         return 'groups'
     def deps(self):
-        return [stagePackages]
+        return [stagePackagesVariant]
+    def inputs(self):
+        return [('config','INNER_USER'),('config','EXTRA_GROUPS')]
     def execute(self,handler):
-        self.run_chroot(f'usermod -a -G uucp {INNER_USER}')
-        self.run_chroot(f'usermod -a -G docker {INNER_USER}')
-        self.run_chroot(f'usermod -a -G bumblebee {INNER_USER}')
-        self.run_chroot(f'usermod -a -G plugdev {INNER_USER}')
-        self.run_chroot(f'usermod -a -G realtime {INNER_USER}')
-        self.run_chroot(f'usermod -a -G audio {INNER_USER}')
+        for group in EXTRA_GROUPS:
+            self.run_chroot(f'usermod -a -G {group} {INNER_USER}')
         self.mark_complete()
 
+class stageHostname(buildstage):
+    def stagename(self):
+        return 'hostname'
+    def deps(self):
+        return [stageExtraRootFiles]
+    def inputs(self):
+        return [('config','HOSTNAME')]
+    def execute(self,handler):
+        self.run_chroot(f'echo "{HOSTNAME}" > /etc/hostname')
+        self.run_chroot('echo "127.0.0.1    localhost" >   /etc/hosts')
+        self.run_chroot('echo "::1    localhost" >>  /etc/hosts')
+        self.run_chroot(f'echo "127.0.1.1    {HOSTNAME}" >> /etc/hosts')
+        self.mark_complete()
+
+# Initramfs images built before, by the hash of what went into them (see
+# stageInitCpio), and the packages whose files the images are made of besides
+# the kernel's modules and the initcpio hooks.
+initramfs_cache = cache / 'initramfs'
+initramfs_packages = ['mkinitcpio','mkinitcpio-busybox','mkinitcpio-nfs-utils','nfs-utils','systemd','kmod','util-linux','glibc']
+
 class stageInitCpio(buildstage):
+    # Builds the initramfs of the linux kernel in the root.  A netboot client
+    # only loads the default image, so the fallback image is only built with
+    # INITRAMFS_FALLBACK, and the image is compressed with
+    # INITRAMFS_COMPRESSION on all cores.  Images are cached by the kernel
+    # version, mkinitcpio.conf, the compression settings, the initcpio hooks,
+    # the kernel's module tree and the versions of initramfs_packages, so an
+    # unchanged image is copied in instead of rebuilt.
     def stagename(self):
         return 'initcpio'
     def deps(self):
-        return [stagePackages]
+        return [stagePackages,stageMkinitcpioConf,stageNetsquashHook,stageNetsquashInstall]
+    def inputs(self):
+        return [('config','INITRAMFS_FALLBACK'),('config','INITRAMFS_COMPRESSION'),('config','INITRAMFS_COMPRESSION_OPTIONS')]
+    def kernel(self):
+        # The version the linux package's modules are installed under.
+        for pkgbase in sorted(glob.glob(str(root/'usr/lib/modules/*/pkgbase'))):
+            with open(pkgbase,'r') as f:
+                if f.read().strip()=='linux':
+                    return os.path.basename(os.path.dirname(pkgbase))
+        assert(False)
+    def images(self):
+        images=[('initramfs-linux.img','')]
+        if INITRAMFS_FALLBACK:
+            images.append(('initramfs-linux-fallback.img','-S autodetect'))
+        return images
+    def conf(self):
+        # mkinitcpio.conf with the compression settings appended, which win
+        # when mkinitcpio sources it.
+        with open(root/'etc/mkinitcpio.conf','r') as f:
+            conf=f.read()
+        return conf+f'\nCOMPRESSION="{INITRAMFS_COMPRESSION}"\nCOMPRESSION_OPTIONS=({INITRAMFS_COMPRESSION_OPTIONS})\n'
+    def key(self,kver,conf):
+        h=hashlib.sha256(f'kernel {kver}\n{conf}\n'.encode())
+        for image,options in self.images():
+            h.update(f'image {image} {options}\n'.encode())
+        for path in ['usr/lib/initcpio','etc/initcpio',f'usr/lib/modules/{kver}']:
+            h.update(f'{path} {path_digest(root/path)}\n'.encode())
+        save_hashes()
+        local=pacman_db().local
+        for pkg in initramfs_packages:
+            h.update(f"package {pkg} {local.get(pkg,{}).get('version')}\n".encode())
+        return h.hexdigest()[:32]
     def execute(self,handler):
-        self.run_chroot('mkinitcpio -p linux')
+        kver=self.kernel()
+        conf=self.conf()
+        key=self.key(kver,conf)
+        entry=initramfs_cache/key
+        cached=INITRAMFS_CACHE and all((entry/image).is_file() for image,_ in self.images())
+        if cached:
+            print('\tUsing cached initramfs',key)
+            for image,_ in self.images():
+                shutil.copy2(entry/image,root/'boot'/image)
+            os.utime(entry)
+        else:
+            with open(root/'etc/mkinitcpio.netboot.conf','w') as f:
+                f.write(conf)
+            try:
+                for image,options in self.images():
+                    self.run_chroot(f'mkinitcpio -c /etc/mkinitcpio.netboot.conf -k {kver} -g /boot/{image} {options}', timefile=root/f".install/initcpio.{image}.time", log=root/f".install/initcpio.{image}.log")
+            finally:
+                os.remove(root/'etc/mkinitcpio.netboot.conf')
+            if INITRAMFS_CACHE:
+                self.store(entry)
+        if not INITRAMFS_FALLBACK and os.path.isfile(root/'boot/initramfs-linux-fallback.img'):
+            os.remove(root/'boot/initramfs-linux-fallback.img')
+        self.measure(kver,key,cached)
         self.mark_complete()
+    def store(self,entry):
+        # Keeps the newest few images; each is tens of MiB.
+        tmp=Path(f'{entry}.{os.getpid()}.tmp')
+        shutil.rmtree(tmp,ignore_errors=True)
+        tmp.mkdir(parents=True)
+        for image,_ in self.images():
+            shutil.copy2(root/'boot'/image,tmp/image)
+        shutil.rmtree(entry,ignore_errors=True)
+        os.rename(tmp,entry)
+        entries=sorted((e for e in initramfs_cache.iterdir() if e.is_dir() and not e.name.endswith('.tmp')),key=lambda e: e.stat().st_mtime,reverse=True)
+        for old in entries[5:]:
+            shutil.rmtree(old,ignore_errors=True)
+    def measure(self,kver,key,cached):
+        # The image is fetched over TFTP and unpacked on every boot, so its
+        # size and unpack time are recorded.
+        size=os.path.getsize(root/'boot/initramfs-linux.img')
+        out=self.capture_chroot('bash -c '+shlex.quote('TIMEFORMAT=%R; { time lsinitcpio /boot/initramfs-linux.img >/dev/null; } 2>&1'))
+        unpack=float(out.split()[-1])
+        print(f'\tinitramfs-linux.img: {size/2**20:.1f} MiB, unpacks in {unpack:.2f} s')
+        record_metric(dict(type='initramfs',kernel=kver,key=key,cached=bool(cached),compression=INITRAMFS_COMPRESSION,size=size,unpack=unpack))
 
 
 class stageExtraRootFiles(buildstage):
     def stagename(self):
         return 'extra-rootfs-files'
     def deps(self):
-        return [stagePackages]
+        # The last stage shared by all variants.
+        return [stagePackages,stageModFuse,stageModZFS,stageZpoolCache,stageInitCpio]
+    def inputs(self):
+        return [('file','root_files')]
     def execute(self,handler):
         self.run_cmd('rsync -av root_files/ %s/'%(root))
+        self.mark_complete()
 
 class stageCleanup(buildstage):
     def stagename(self):
         return 'cleanup'
     def deps(self):
-        return [stagePackages,stageModFuse,stageModZFS,stageServices,stageZpoolCache,stageGroups,stageInitCpio,stageExtraRootFiles]
+        return [stageExtraRootFiles,stagePackagesVariant,stageServices,stageGroups,stageHostname]
+    def inputs(self):
+        return [('config','INNER_USER')]
     def execute(self,handler):
         self.run_chroot('rm -v /etc/machine-id',test=True,silent=True)
         self.run_chroot(f'rm -rf /home/{INNER_USER}/.cache')
         self.run_chroot(f'rm -rf /home/{INNER_USER}/.trizensources')
+        # The shared package cache is unmounted rather than emptied; this only
+        # clears whatever was downloaded while it was not mounted.
+        umount_pkgcache()
         self.run_chroot('rm -rf /var/cache/pacman/pkg/*')
+        umount_buildcache()
+        self.run_chroot('rm -rf /etc/makepkg.build.conf /var/cache/ccache /var/tmp/makepkg')
+        self.mark_complete()
+
+class stageSlim(buildstage):
+    # Removes what SLIM_RULES select, listing it in .install/slim-removed.tsv
+    # with the owning packages, and links duplicate files (see slim.py).
+    def stagename(self):
+        return 'slim'
+    def deps(self):
+        return [stageCleanup]
+    def inputs(self):
+        return [('file',SLIM_RULES),('config','SLIM_DEDUP'),('config','SLIM_DEDUP_MIN_SIZE')]
+    def execute(self,handler):
+        rules=slim.read_rules(SLIM_RULES) if os.path.isfile(SLIM_RULES) else []
+        removed,counts=slim.slim(root,rules,SLIM_DEDUP,SLIM_DEDUP_MIN_SIZE)
+        slim.write_removed(removed,root/'.install/slim-removed.tsv')
+        slim.report(counts)
+        record_metric(dict(type='slim',dedup=SLIM_DEDUP,**counts))
+        self.mark_complete()
+
+def build_name(timestamp):
+    # The name a build is published under in builds/ and the mounts/ pointers.
+    return f'{timestamp}-{VARIANT}' if VARIANT else str(timestamp)
+
+# Images exported by PUBLISH_METHOD='image', and the sort file built from
+# IMAGE_PROFILE for mksquashfs.
+images = cache / 'images'
+
+def write_sortfile(path):
+    # mksquashfs places files with higher priorities first; the profile lists
+    # paths in the order they were read.  Returns the number of files placed.
+    if not IMAGE_PROFILE or not os.path.isfile(IMAGE_PROFILE):
+        return 0
+    with open(IMAGE_PROFILE,'r') as f:
+        paths=[l.strip().lstrip('/') for l in f]
+    seen=set()
+    lines=[]
+    for p in paths:
+        # Paths mksquashfs would split, or that are not in this root, are
+        # left to the default order.
+        if not p or p in seen or any(c.isspace() for c in p) or not (root/p).is_file():
+            continue
+        seen.add(p)
+        lines.append(f'{p} {max(32767-len(lines),1)}\n')
+    with open(path,'w') as f:
+        f.write(''.join(lines))
+    return len(lines)
+
+# The manifest of every published build (see manifest.py), as written into its
+# .install/manifest.tsv, named like the build.
+manifests = cache / 'manifests'
 
 class stageFinish(buildstage):
     def stagename(self):
         return 'finish'
     def deps(self):
-        return [stageCleanup]
+        return [stageSlim]
     def execute(self,handler):
         global echo
         timestamp=int(time.time())
         print('Timestamp:',timestamp)
-        parentimage = max(self.capture_remote(f'ls {NAS_IMAGE_PATH}/builds',silent=True).strip().split())
-        print('Parent:',parentimage)
         #echo=True
         self.run_chroot(f'echo {timestamp} > /.install/version')
-        self.run_remote(f'sudo zfs snapshot {ZFS_NAS_IMAGE_PATH}/builds/{parentimage}@{timestamp}')
-        self.run_remote(f'sudo zfs clone {ZFS_NAS_IMAGE_PATH}/builds/{parentimage}@{timestamp} {ZFS_NAS_IMAGE_PATH}/builds/{timestamp}')
-        self.run_remote(f'sudo zfs promote {ZFS_NAS_IMAGE_PATH}/builds/{timestamp}')
-        self.run_cmd(f'rsync -ahxXSAHv --delete --rsync-path="sudo rsync" {root}/ {NAS_USER}@{NAS_IP}:{NAS_IMAGE_PATH}/builds/{timestamp}/ 2>&1 | tee rsync.log')
-        self.run_cmd(f'rsync -v --rsync-path="sudo rsync" {cwd}/rsync.log {NAS_USER}@{NAS_IP}:{NAS_IMAGE_PATH}/builds/{timestamp}/.install/rsync.log')
-        self.run_remote(f'echo {timestamp} > {NAS_IMAGE_PATH}/mounts/latest')
-        self.run_remote(f'echo {timestamp} > {NAS_IMAGE_PATH}/mounts/c85b761a2c47')
+        # Nothing but the image itself may be mounted under the root while it
+        # is copied.
+        session.close()
+        record_metric(dict(type='build',timestamp=timestamp,variant=VARIANT))
+        # A variant's copy starts with the records of the shared stages.
+        with open(root/'.install/metrics.jsonl','wb') as f:
+            for store in [metrics/'current.jsonl',current_metrics] if VARIANT else [current_metrics]:
+                if store.exists():
+                    with open(store,'rb') as s:
+                        shutil.copyfileobj(s,f)
+        self.write_manifest(timestamp)
+        published=[]
+        if PUBLISH_METHOD=='zfs':
+            published=self.publish_zfs(timestamp)
+        elif PUBLISH_METHOD=='image':
+            self.publish_image(timestamp)
+        else:
+            self.publish_rsync(timestamp)
+        pointed=False
+        try:
+            if PUBLISH_VERIFY:
+                assert(self.verify(build_name(timestamp),root/'.install/manifest.tsv'))
+            # Only a published build's manifest is kept, for the next build to
+            # publish its changes against.
+            manifests.mkdir(parents=True,exist_ok=True)
+            shutil.copy(root/'.install/manifest.tsv',manifests/f'{build_name(timestamp)}.tsv')
+            for pointer in MOUNT_POINTERS:
+                self.run_remote(f'echo {build_name(timestamp)} > {NAS_IMAGE_PATH}/mounts/{pointer}')
+                pointed=True
+        except:
+            if PUBLISH_METHOD=='zfs':
+                self.unpublish_zfs(timestamp,pointed)
+            raise
+        # The previous publish snapshots go once this one is in use.
+        for prev in published:
+            self.run_cmd(f'zfs destroy {dataset}@publish-{prev}')
         #echo=False
-
-def run_build(stage):
-    global cur_stage
-    s=stage()
-    print("Running stage",s.stagename())
-    if s.test():
-        print("\tAlready complete!")
-        return
-    for dep in s.deps():
-        run_build(dep)
+    def publish_rsync(self,timestamp):
+        name=build_name(timestamp)
+        log=f'rsync-{VARIANT}.log' if VARIANT else 'rsync.log'
+        builds=self.capture_remote(f'ls {NAS_IMAGE_PATH}/builds',silent=True).strip().split()
+        # A variant's builds are cloned from its own last build, if any.
+        parentimage = max([b for b in builds if VARIANT and b.endswith(f'-{VARIANT}')] or builds)
+        print('Parent:',parentimage)
+        self.run_remote(f'sudo zfs snapshot {ZFS_NAS_IMAGE_PATH}/builds/{parentimage}@{name}')
+        self.run_remote(f'sudo zfs clone {ZFS_NAS_IMAGE_PATH}/builds/{parentimage}@{name} {ZFS_NAS_IMAGE_PATH}/builds/{name}')
+        self.run_remote(f'sudo zfs promote {ZFS_NAS_IMAGE_PATH}/builds/{name}')
+        if PUBLISH_INCREMENTAL and self.known_parent(parentimage):
+            self.publish_changes(parentimage,name,log)
+        else:
+            self.run_cmd(f'rsync -ahxXSAHv --delete --exclude="/var/cache/pacman/pkg/*" --rsync-path="sudo rsync" {remote.rsync_shell()} {root}/ {remote.path(f"{NAS_IMAGE_PATH}/builds/{name}/")} 2>&1 | tee {log}')
+        self.run_cmd(f'rsync -v --rsync-path="sudo rsync" {remote.rsync_shell()} {cwd}/{log} {remote.path(f"{NAS_IMAGE_PATH}/builds/{name}/.install/rsync.log")}')
+    def known_parent(self,parentimage):
+        # Whether the parent on the NAS is the tree its cached manifest
+        # describes: a build a mount pointer names was published in full,
+        # otherwise the manifest it was published with must be the same.
+        cached=manifests/f'{parentimage}.tsv'
+        if not cached.is_file():
+            return False
+        pointed=self.capture_remote(f'cat {NAS_IMAGE_PATH}/mounts/*',test=True,silent=True)[0].split()
+        if parentimage in pointed:
+            return True
+        published,rc=self.capture_remote(f'sha256sum {NAS_IMAGE_PATH}/builds/{parentimage}/.install/manifest.tsv',test=True,silent=True)
+        with open(cached,'rb') as f:
+            digest=hashlib.sha256(f.read()).hexdigest()
+        if rc==0 and published.split()[:1]==[digest]:
+            return True
+        print(f'Manifest of {parentimage} differs from the published one, copying in full')
+        return False
+    def publish_changes(self,parentimage,name,log):
+        # The clone of the parent holds the parent's manifest; the paths that
+        # differ from this build's are removed from it and copied over it, so
+        # neither side walks the whole tree.  A new hard link to an unchanged
+        # file arrives as a copy.
+        added,removed,changed=manifest.diff(manifest.read(manifests/f'{parentimage}.tsv'),manifest.read(root/'.install/manifest.tsv'))
+        print(f'Changes since {parentimage}: {len(added)} added, {len(removed)} removed, {len(changed)} changed')
+        files=cwd/(f'publish-{VARIANT}' if VARIANT else 'publish')
+        # Removed paths go first, deepest first, so that a directory replaced
+        # by a file is empty by the time the file is copied.
+        with open(f'{files}.removed','wb') as f:
+            f.write(b''.join(manifest.unquote(p).lstrip(b'/')+b'\0' for p in sorted(removed,reverse=True)))
+        with open(f'{files}.changed','wb') as f:
+            f.write(b''.join((manifest.unquote(p).lstrip(b'/') or b'.')+b'\0' for p in added+[c[0] for c in changed]))
+        self.run_cmd(f'{remote.command(f"cd {NAS_IMAGE_PATH}/builds/{name} && sudo xargs -0 -r rm -rf --",tty=False)} < {files}.removed')
+        self.run_cmd(f'rsync -ahxXSAHv --from0 --files-from={files}.changed --rsync-path="sudo rsync" {remote.rsync_shell()} {root}/ {remote.path(f"{NAS_IMAGE_PATH}/builds/{name}/")} 2>&1 | tee {log}')
+    def publish_image(self,timestamp):
+        # The root as one compressed read-only image, images/<build>.<format>
+        # on the NAS, which the netsquash hook loop-mounts, and its /boot as
+        # builds/<build>/boot, which tftpserv.py serves.
+        name=build_name(timestamp)
+        image=self.export_image(name)
+        self.run_remote(f'sudo mkdir -p {NAS_IMAGE_PATH}/images {NAS_IMAGE_PATH}/builds/{name}')
+        log=f'rsync-{VARIANT}.log' if VARIANT else 'rsync.log'
+        self.run_cmd(f'rsync -ahv --partial --rsync-path="sudo rsync" {remote.rsync_shell()} {image} {remote.path(f"{NAS_IMAGE_PATH}/images/{image.name}")} 2>&1 | tee {log}')
+        self.run_cmd(f'rsync -ahxXSAHv --delete --rsync-path="sudo rsync" {remote.rsync_shell()} {root}/boot/ {remote.path(f"{NAS_IMAGE_PATH}/builds/{name}/boot/")} 2>&1 | tee -a {log}')
+        self.prune_images()
+    def export_image(self,name):
+        # mksquashfs or mkfs.erofs on all cores.  With a boot profile, squashfs
+        # images get the files a client reads while booting first, in the order
+        # it reads them, so those reads are sequential; mkfs.erofs has no
+        # equivalent of -sort.
+        images.mkdir(parents=True,exist_ok=True)
+        image=images/f'{name}.{IMAGE_FORMAT}'
+        part=Path(f'{image}.part')
+        part.unlink(missing_ok=True)
+        start=time.time()
+        profiled=0
+        if IMAGE_FORMAT=='squashfs':
+            options=IMAGE_OPTIONS or '-comp zstd -Xcompression-level 15 -b 256K'
+            cmd=f'mksquashfs {root} {part} -noappend -xattrs -processors {os.cpu_count()} {options} -wildcards -e "var/cache/pacman/pkg/*"'
+            profiled=write_sortfile(images/'sort.txt')
+            if profiled:
+                cmd+=f' -sort {images/"sort.txt"}'
+        elif IMAGE_FORMAT=='erofs':
+            options=IMAGE_OPTIONS or '-zlz4hc,12'
+            cmd=f'mkfs.erofs --workers={os.cpu_count()} {options} --exclude-regex="^var/cache/pacman/pkg/." {part} {root}'
+        else:
+            sys.exit(f'Unknown IMAGE_FORMAT: {IMAGE_FORMAT}')
+        self.run_cmd(cmd,log=cwd/'image.log')
+        os.replace(part,image)
+        size=image.stat().st_size
+        record_metric(dict(type='image',format=IMAGE_FORMAT,size=size,profiled=profiled,wall=round(time.time()-start,3)))
+        print(f'Image: {image.name}, {size/2**20:.0f} MiB in {time.time()-start:.0f} s{f", {profiled} files in boot order" if profiled else ""}')
+        return image
+    def prune_images(self):
+        # The images of this variant's (or the base's) last two builds are
+        # kept; <timestamp>-<variant> names a variant's builds.
+        own=[f for f in images.glob(f'*.{IMAGE_FORMAT}') if f.stem.partition('-')[2]==(VARIANT or '')]
+        for old in sorted(own,key=lambda f: f.stat().st_mtime)[:-2]:
+            old.unlink()
+    def record_profile(self,name):
+        # The files of a published tree read since it was published, in the
+        # order they were first read, from their access times on the NAS: so
+        # boot a client from the tree once (with atime on for the dataset)
+        # and record the profile before anything else reads the tree.
+        tree=f'{NAS_IMAGE_PATH}/builds/{name}'
+        text=self.capture_remote(f'cd {tree} && sudo find . -xdev -type f -anewer .install/rsync.log ! -path "./.install/*" -printf "%A@ %P\\n"')
+        accessed=sorted((float(t),p) for t,_,p in (l.partition(' ') for l in text.split('\n')) if p)
+        with open(IMAGE_PROFILE,'w') as f:
+            f.write(''.join(f'/{p}\n' for _,p in accessed))
+        print(f'Recorded {len(accessed)} files read since {name} was published into {IMAGE_PROFILE}')
+    def write_manifest(self,timestamp):
+        # Files unchanged since the last manifest (same path, inode, size and
+        # mtime) keep its hashes, so only what the build changed is read.
+        start=time.time()
+        previous=sorted(manifests.glob('*.tsv'),key=lambda f: f.stat().st_mtime)[-1:] if manifests.is_dir() else []
+        entries,hashed=manifest.generate(root,manifest.read(previous[0]) if previous else None)
+        manifest.write(entries,root/'.install/manifest.tsv')
+        record_metric(dict(type='manifest',entries=len(entries),hashed=hashed,wall=round(time.time()-start,3)))
+        print(f'Manifest: {len(entries)} entries, {hashed} files hashed in {time.time()-start:.1f} s')
+    def verify(self,name,expected=None):
+        # Hashes the published copy on the NAS, running manifest.py there on
+        # all of its cores, and compares it with the build's manifest (its
+        # cached copy unless given).  An exported image is compared with the
+        # local copy instead.
+        expected=expected or manifests/f'{name}.tsv'
+        image=images/f'{name}.{IMAGE_FORMAT}'
+        if image.is_file():
+            published=self.capture_remote(f'sha256sum {NAS_IMAGE_PATH}/images/{image.name}').split()[0]
+            h=hashlib.sha256()
+            with open(image,'rb') as f:
+                for chunk in iter(lambda: f.read(1<<20),b''):
+                    h.update(chunk)
+            print(f"Verifying {image.name} on the NAS: {'ok' if published==h.hexdigest() else 'differs'}")
+            return published==h.hexdigest()
+        if not expected.is_file():
+            sys.exit(f'No manifest for build {name}')
+        text=self.capture_cmd(f"{remote.command(f'sudo python3 - generate {NAS_IMAGE_PATH}/builds/{name} -o -',tty=False)} < {manifest.__file__}")
+        result=manifest.diff(manifest.read(expected),manifest.parse(text))
+        print(f'Verifying {name} on the NAS:')
+        manifest.show_diff(*result,limit=100)
+        return not any(result)
+    def publish_zfs(self,timestamp):
+        # Send the install root as a ZFS stream, received on the NAS as
+        # builds/<timestamp>.  When the previously published snapshot of this
+        # root still exists on both sides, only the changes since then are
+        # sent, and the new build is received as a clone of the previous one.
+        umount_pkgcache()
+        umount_buildcache()
+        snap=f'{dataset}@publish-{timestamp}'
+        target=f'{ZFS_NAS_IMAGE_PATH}/builds/{build_name(timestamp)}'
+        published=[l.split('@publish-')[1] for l in self.capture_cmd(f'zfs list -H -t snapshot -o name -s creation -d 1 {dataset}').split() if '@publish-' in l]
+        self.run_cmd(f'zfs snapshot {snap}')
+        try:
+            self.send_snapshot(snap,target,published)
+        except:
+            # Left behind, the snapshot would be taken for a published one
+            # by the next build's incremental send.
+            self.run_cmd(f'zfs destroy {snap}',test=True)
+            raise
+        return published
+    def unpublish_zfs(self,timestamp,pointed):
+        # After a failure past the send: the new publish snapshot is newer
+        # than @finish, which could not be rolled back to with it in place.
+        # The received build goes too, unless a mount pointer names it.
+        self.run_cmd(f'zfs destroy {dataset}@publish-{timestamp}',test=True)
+        if not pointed:
+            self.run_remote(f'sudo zfs destroy -r {ZFS_NAS_IMAGE_PATH}/builds/{build_name(timestamp)}',test=True)
+    def send_snapshot(self,snap,target,published):
+        send=f'zfs send -c {snap}'
+        receive=f'sudo zfs receive -s {target}'
+        if published:
+            prev=published[-1]
+            origin=f'{ZFS_NAS_IMAGE_PATH}/builds/{build_name(prev)}@publish-{prev}'
+            if self.capture_remote(f'zfs list -H -o name {origin}',test=True,silent=True)[1]==0:
+                print('Incremental from:',prev)
+                send=f'zfs send -c -i @publish-{prev} {snap}'
+                receive=f'sudo zfs receive -s -o origin={origin} {target}'
+        first=(send,receive)
+        for attempt in range(PUBLISH_RETRIES):
+            if self.run_cmd(self.send_pipeline(send,receive),test=True,log=cwd/(f'zfs-send-{VARIANT}.log' if VARIANT else 'zfs-send.log'))==0:
+                return
+            # Pick an interrupted receive up where it stopped.
+            token,rc=self.capture_remote(f'zfs get -H -o value receive_resume_token {target}',test=True,silent=True)
+            token=token.strip()
+            if rc==0 and token and token!='-':
+                print('Resuming receive')
+                send=f'zfs send -t {token}'
+                receive=f'sudo zfs receive -s {target}'
+                continue
+            # Nothing to resume: whatever was received is discarded and the
+            # stream sent again from the start.
+            self.run_remote(f'sudo zfs receive -A {target}',test=True,silent=True)
+            if self.capture_remote(f'zfs list -H -o name {target}',test=True,silent=True)[1]==0:
+                self.run_remote(f'sudo zfs destroy -r {target}')
+            send,receive=first
+        assert(False)
+    def send_pipeline(self,send,receive):
+        if PUBLISH_COMPRESS=='zstd':
+            send=f'{send} | zstd -T0 -c'
+            receive=f'zstd -d -c | {receive}'
+        return f'set -o pipefail; {send} | {remote.command(receive,tty=False)}'
+
+def load_stage_times():
+    # Wall times of each stage in the last five builds with a metrics store.
+    times={}
+    files=sorted(metrics.glob('*.jsonl'),key=lambda f: f.stat().st_mtime)[-5:] if metrics.is_dir() else []
+    for path in files:
+        with open(path,'r') as f:
+            for line in f:
+                try:
+                    record=json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('type')=='stage' and record.get('ok'):
+                    times.setdefault(record['name'],[]).append(record['wall'])
+    return times
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds=int(seconds)
+    return f'{seconds//3600}:{seconds//60%60:02d}:{seconds%60:02d}'
+
+class buildplan():
+    # Each stage class reachable from the target is instantiated and tested
+    # exactly once.  A stage that is already complete satisfies its dependents
+    # without its own dependencies being visited, as in a depth-first build.
+    def __init__(self,target):
+        self.target=target
+        self.instances={}
+        self.complete={}
+        self.order=[]
+        self._visit(target)
+        save_hashes()
+    def _visit(self,cls):
+        if cls in self.complete: return
+        s=cls()
+        self.instances[cls]=s
+        self.complete[cls]=s.test()
+        if self.complete[cls]: return
+        for dep in s.deps():
+            self._visit(dep)
+        self.order.append(cls)
+    def adopt(self):
+        # Give the completion markers of stages found complete by an older
+        # builder the current fingerprint, so later changes are noticed.
+        for cls,c in self.complete.items():
+            s=self.instances[cls]
+            if c and s.recorded()=='':
+                s.mark_complete()
+    def stages(self):
+        # The stages that need to run, in the order a serial build runs them.
+        return [self.instances[cls] for cls in self.order]
+    def pending_deps(self,cls):
+        return [d for d in self.instances[cls].deps() if not self.complete[d]]
+    def levels(self):
+        level={}
+        for cls in self.order:
+            level[cls]=max([level[d]+1 for d in self.pending_deps(cls)],default=0)
+        levels=[[] for _ in range(max(level.values(),default=-1)+1)]
+        for cls in self.order:
+            levels[level[cls]].append(self.instances[cls])
+        return levels
+    def estimate(self,s,times):
+        past=times.get(s.stagename())
+        if not past: return None
+        return sum(past)/len(past)
+    def show(self):
+        times=load_stage_times()
+        done=[self.instances[cls] for cls,c in self.complete.items() if c]
+        print(f"Build plan for {self.instances[self.target].stagename()}: {len(self.order)} to run, {len(done)} already complete")
+        for s in done:
+            print(f"    done  {s.stagename()}")
+        finish={}
+        for n,level in enumerate(self.levels()):
+            print(f"  Level {n}:")
+            for s in level:
+                est=self.estimate(s,times)
+                finish[type(s)]=(est or 0)+max([finish[d] for d in self.pending_deps(type(s))],default=0)
+                print(f"    run   {s.stagename():30s} ~{format_duration(est)}{'  (changed)' if s.stale() else ''}")
+        unknown=[s.stagename() for s in self.stages() if self.estimate(s,times) is None]
+        total=sum(self.estimate(s,times) or 0 for s in self.stages())
+        print(f"  Estimated: {format_duration(total)} serial, {format_duration(max(finish.values(),default=0))} critical path")
+        if unknown:
+            print(f"  No past timings for: {', '.join(unknown)}")
+
+# Cached layers: whenever a stage completes and no other stage is running,
+# the install root is snapshotted as @layer-<key>, the key being a hash of
+# the names and fingerprints of every stage complete at that point.  A fresh
+# build clones the deepest layer whose stages all still have the same
+# fingerprints instead of running them.  clean_image.py moves the root, with
+# its layers, under {ZFS_CWD}/.layers; .cache/layers.json records the stages
+# of each layer and when it was last used.
+layerindex = cache / 'layers.json'
+
+def load_layers():
+    try:
+        with open(layerindex,'r') as f:
+            return json.load(f)
+    except (FileNotFoundError,ValueError):
+        return {}
+
+def save_layers(layers):
+    cache.mkdir(parents=True,exist_ok=True)
+    with open(f'{layerindex}.tmp','w') as f:
+        json.dump(layers,f,indent=1)
+    os.replace(f'{layerindex}.tmp',layerindex)
+
+def layer_snapshots():
+    # Layer snapshots by key, leaving out those already evicted but kept
+    # alive by a clone.
+    result=subprocess.run(f'zfs list -H -t snapshot -o name,defer_destroy -r {ZFS_CWD}',shell=True,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
+    snaps={}
+    for line in result.stdout.decode().split('\n'):
+        fields=line.split('\t')
+        if '@layer-' in fields[0] and fields[-1]!='on':
+            snaps[fields[0].split('@layer-')[1]]=fields[0]
+    return snaps
+
+def dataset_space(ds,prop='used'):
+    result=subprocess.run(f'zfs get -Hp -o value {prop} {ds}',shell=True,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
+    try:
+        return int(result.stdout.decode().strip())
+    except ValueError:
+        return 0
+
+def layers_used():
+    # The old roots under {ZFS_CWD}/.layers, and the space held by the
+    # snapshots of any other dataset with layer snapshots: the live root and
+    # the roots restored from a layer.
+    others={snap.split('@')[0] for snap in layer_snapshots().values()}
+    others={ds for ds in others if not ds.startswith(f'{ZFS_CWD}/.layers/')}
+    return dataset_space(f'{ZFS_CWD}/.layers')+sum(dataset_space(ds,'usedbysnapshots') for ds in sorted(others))
+
+def all_stages(target):
+    # The target and every stage class it depends on.
+    found=[]
+    def visit(cls):
+        if cls in found: return
+        found.append(cls)
+        for dep in cls().deps():
+            visit(dep)
+    visit(target)
+    return found
+
+def take_layer(target):
+    stages={s.stagename():s.fingerprint() for s in (cls() for cls in all_stages(target)) if s.test()}
+    if not stages: return
+    key=hashlib.sha256(''.join(f'{n} {fp}\n' for n,fp in sorted(stages.items())).encode()).hexdigest()[:32]
+    layers=load_layers()
+    if key not in layer_snapshots():
+        print(f"    Layer: {len(stages)} stages complete")
+        assert(os.system(f'zfs snapshot {dataset}@layer-{key}')==0)
+        layers[key]={'stages':stages,'created':int(time.time())}
+    layers.setdefault(key,{'stages':stages,'created':int(time.time())})['used']=int(time.time())
+    save_layers(layers)
+
+def find_layer(target,no_cache_from=None):
+    # The usable layer with the most stages: every stage in it must still
+    # have the fingerprint it had, and with no_cache_from neither that stage
+    # nor anything depending on it may be in it.
+    classes=all_stages(target)
+    current={cls().stagename():stage_fingerprint(cls) for cls in classes}
+    excluded=set()
+    if no_cache_from:
+        if no_cache_from not in current:
+            sys.exit(f'Unknown stage: {no_cache_from}')
+        for cls in classes:
+            if no_cache_from in [d().stagename() for d in all_stages(cls)]:
+                excluded.add(cls().stagename())
+    snaps=layer_snapshots()
+    best=None
+    for key,layer in load_layers().items():
+        stages=layer['stages']
+        if key not in snaps or excluded & set(stages): continue
+        if any(current.get(n)!=fp for n,fp in stages.items()): continue
+        if best is None or (len(stages),layer['used'])>(len(best[1]['stages']),best[1]['used']):
+            best=(key,layer)
+    if best is None:
+        return None
+    return best[0],snaps[best[0]],best[1]
+
+def restore_layer(target,no_cache_from=None):
+    # Start a fresh build from the deepest usable layer.
+    if os.system(f'zfs list {dataset} >/dev/null 2>&1')==0:
+        return False
+    found=find_layer(target,no_cache_from)
+    if not found:
+        return False
+    key,snap,layer=found
+    print(f"Starting from cached layer {snap} ({len(layer['stages'])} stages)")
+    archive_metrics()
+    assert(os.system(f'zfs clone {snap} {dataset}')==0)
+    layers=load_layers()
+    layers[key]['used']=int(time.time())
+    save_layers(layers)
+    return True
+
+def evict_layers():
+    # Forget layers whose snapshot is gone, destroy the least recently used
+    # until the layers fit in LAYER_CACHE_MAX_GB (a snapshot something
+    # was cloned from goes when its clones do), then old roots left without
+    # snapshots.
+    layers=load_layers()
+    snaps=layer_snapshots()
+    layers={k:l for k,l in layers.items() if k in snaps}
+    evicted=0
+    for key in sorted(layers,key=lambda k: layers[k]['used']):
+        if layers_used()<=LAYER_CACHE_MAX_GB*2**30: break
+        os.system(f'zfs destroy -d {snaps[key]}')
+        del layers[key]
+        evicted+=1
+    save_layers(layers)
+    result=subprocess.run(f'zfs list -H -o name -t filesystem -r -d 1 {ZFS_CWD}/.layers',shell=True,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
+    for ds in result.stdout.decode().split('\n')[1:]:
+        if not ds.startswith(f'{ZFS_CWD}/.layers/'): continue
+        if not subprocess.run(f'zfs list -H -t snapshot -o name -d 1 {ds}',shell=True,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL).stdout.strip():
+            os.system(f'zfs destroy {ds}')
+    if evicted:
+        print(f"Layer cache: evicted {evicted} layers, {layers_used()/2**30:.1f} GiB in use")
+
+def run_stage(s,handler):
+    set_stage(s.stagename())
     print("Building stage",s.stagename())
-    interrupted=False
+    if 'pacman' in s.resources() and root.is_dir():
+        mount_pkgcache()
+        if (root/'etc/makepkg.build.conf').exists():
+            mount_buildcache()
+    _stage_local.usage={}
+    s.cgroup=stage_cgroup(s.stagename())
+    before=build_events.read_stats(s.cgroup) if s.cgroup else {}
+    if s.cgroup:
+        sampler.watch(s.cgroup,stage=s.stagename(),**({'variant':VARIANT} if VARIANT else {}))
+    emit_event('stage_start')
+    start=time.time()
+    ok=False
     try:
-        cur_stage = s.stagename()
-        take_snapshot()
-        with GracefulInterruptHandler() as h:
-            s.execute(handler=h)
-            if h.interrupted:
-                interrupted=True
-    except:
-        rollback_snapshot()
+        s.execute(handler=handler)
+        ok=True
+    finally:
+        accounted={}
+        if s.cgroup:
+            sampler.unwatch(s.cgroup)
+            accounted=build_events.totals(build_events.read_stats(s.cgroup),before)
+            cgroups.remove(s.cgroup)
+        record_metric(dict(type='stage',name=s.stagename(),ok=ok,wall=round(time.time()-start,3),cgroup=accounted,**_stage_local.usage))
+        emit_event('stage_end',stage=s.stagename(),ok=ok,wall=round(time.time()-start,3),**dict(_stage_local.usage,**accounted))
+        _stage_local.usage=None
+    print("\tDone!")
+
+# Variants: with VARIANTS set, the shared stages are built in .install up to
+# extra-rootfs-files, which is then snapshotted as @variant-base-<fingerprint>.
+# Each variant's root is a ZFS clone of that snapshot under .variants, where a
+# build_image.py process of its own runs the variant's stages and publishes
+# the variant under its own name and mount pointers; the variants are built
+# at the same time.  A clone is kept, with its completed stages, as long as
+# the base it was cloned from does not change.
+variants_dataset = f'{ZFS_CWD}/.variants'
+
+def variant_base():
+    return f'{ZFS_CWD}/.install@variant-base-{stage_fingerprint(stageExtraRootFiles)[:16]}'
+
+def variant_origin(name):
+    # The snapshot a variant's root was cloned from; None if it has none.
+    result=subprocess.run(f'zfs get -H -o value origin {variants_dataset}/{name}',shell=True,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
+    return result.stdout.decode().strip() if result.returncode==0 else None
+
+def clone_variants(names):
+    base=variant_base()
+    snaps=subprocess.run(f'zfs list -H -t snapshot -o name -d 1 {ZFS_CWD}/.install',shell=True,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL).stdout.decode().split()
+    if base not in snaps:
+        assert(os.system(f'zfs snapshot {base}')==0)
+    if os.system(f'zfs list {variants_dataset} >/dev/null 2>&1')!=0:
+        assert(os.system(f'zfs create {variants_dataset}')==0)
+    for name in names:
+        origin=variant_origin(name)
+        if origin==base: continue
+        if origin is not None:
+            assert(os.system(f'zfs destroy -r {variants_dataset}/{name}')==0)
+        print(f"Variant {name}: cloning {base}")
+        assert(os.system(f'zfs clone {base} {variants_dataset}/{name}')==0)
+    # Older bases go once no variant is cloned from them any more.
+    for snap in snaps:
+        if '@variant-base-' in snap and snap!=base:
+            os.system(f'zfs destroy {snap} 2>/dev/null')
+
+def run_variants(names,jobs):
+    clone_variants(names)
+    procs={}
+    for name in names:
+        # build_config.py is looked up in the build directory, as it is here.
+        env=dict(os.environ,BUILD_VARIANT=name,PYTHONUNBUFFERED='1',PYTHONPATH=os.pathsep.join(filter(None,[str(cwd),os.environ.get('PYTHONPATH')])))
+        procs[name]=subprocess.Popen([sys.executable,os.path.abspath(__file__),'--jobs',str(jobs)],env=env,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    def relay(name,stream):
+        for line in stream:
+            sys.stdout.write(f'[{name}] {line.decode(errors="ignore")}')
+            sys.stdout.flush()
+    relays=[threading.Thread(target=relay,args=(name,p.stdout)) for name,p in procs.items()]
+    for t in relays:
+        t.start()
+    try:
+        failed=[name for name,p in procs.items() if p.wait()!=0]
+    except KeyboardInterrupt:
+        # The variant builds got the ^C too, and stop on their own.
+        for p in procs.values():
+            p.wait()
         raise
+    finally:
+        for t in relays:
+            t.join()
+    if failed:
+        print("Failed variants:",' '.join(failed),file=sys.stderr)
+    assert(not failed)
+
+def run_build(stage,jobs=1,no_cache_from=None,variants=None):
+    if not VARIANT:
+        events.reset()
+    else:
+        # A variant's root outlives its builds; its store is archived once
+        # the build it belongs to has been published.
+        archive_metrics(published=True)
+    if VARIANTS and not VARIANT and stage is stageFinish:
+        build_root(stageExtraRootFiles,jobs,no_cache_from)
+        run_variants(variants or sorted(VARIANTS),jobs)
     else:
-        commit_snapshot()
+        build_root(stage,jobs,no_cache_from)
+
+def build_root(stage,jobs=1,no_cache_from=None):
+    plan=buildplan(stage)
+    if LAYER_CACHE and stageRootFS in plan.order and restore_layer(stage,no_cache_from):
+        plan=buildplan(stage)
+    plan.show()
+    plan.adopt()
+    cached={f.name for files in pkgcache_files().values() for f in files}
+    emit_event('build_start',target=stage().stagename(),jobs=jobs,stages=[s.stagename() for s in plan.stages()])
+    ok=False
+    try:
+        execute_plan(plan,jobs)
+        ok=True
+    finally:
+        emit_event('build_end',ok=ok)
+        session.close()
+        remote.close()
+        prefetch.close()
+        umount_buildcache()
+        umount_pkgcache()
+        flush_snapshots()
+        pkgcache_report(cached)
+        evict_pkgcache()
+        if LAYER_CACHE:
+            evict_layers()
+
+def execute_plan(plan,jobs):
+    pending=plan.stages()
+    classes={type(s) for s in pending}
+    waiting={type(s):{d for d in s.deps() if d in classes} for s in pending}
+    running={}
+    held=set()
+    snapshotted=[]
+    failed=[]
+    errors=[]
+    interrupted=False
+    with GracefulInterruptHandler() as h, concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        try:
+            while pending or running:
+                if not (failed or h.interrupted):
+                    # Start ready stages in serial build order, as long as a
+                    # worker is free and their resources are not in use.  An
+                    # exclusive stage waits for the running ones, and no
+                    # later stage starts before it.
+                    for s in list(pending):
+                        if len(running)>=jobs: break
+                        if any(r.exclusive() for r in running.values()): break
+                        if waiting[type(s)] or held & set(s.resources()): continue
+                        if s.exclusive() and running: break
+                        pending.remove(s)
+                        held.update(s.resources())
+                        take_snapshot(s.stagename())
+                        snapshotted.append(s)
+                        running[pool.submit(run_stage,s,h)]=s
+                if not running:
+                    break
+                done,_=concurrent.futures.wait(running,return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    s=running.pop(fut)
+                    held.difference_update(s.resources())
+                    if fut.exception() is not None:
+                        failed.append(s)
+                        errors.append(fut.exception())
+                        continue
+                    commit_snapshot(s.stagename())
+                    snapshotted.remove(s)
+                    for w in waiting.values():
+                        w.discard(type(s))
+                # Layers are only taken between stages, never of a root that
+                # a running stage is changing.
+                if LAYER_CACHE and not running and not failed:
+                    take_layer(plan.target)
+            interrupted=h.interrupted
+        except KeyboardInterrupt:
+            # Second ^C: stop every running command, let the stages unwind,
+            # and roll them all back below.
+            kill_children()
+            concurrent.futures.wait(running)
+            failed.extend(running.values())
+            running.clear()
+            raise
+        finally:
+            # Roll back newest first; a failed stage's rollback also discards
+            # the work of any stage that ran alongside it, whose completion
+            # markers go with it.
+            for s in reversed(snapshotted):
+                if s in failed:
+                    rollback_snapshot(s.stagename())
+    if errors:
+        raise errors[0]
     if interrupted:
         assert(False)
-    print("\tDone!")
 
 if __name__=="__main__":
-    run_build(stageFinish)
+    # This script must be run as root!
+    if not os.geteuid()==0:
+        sys.exit('This script must be run as root!')
+    parser = argparse.ArgumentParser(description='Build the netboot image.')
+    parser.add_argument('-j','--jobs',type=int,default=1,help='number of independent stages to run at once')
+    parser.add_argument('--plan',action='store_true',help='print the stages that would run, with estimated times, and exit')
+    parser.add_argument('--no-cache-from',metavar='STAGE',help='do not start from a cached layer that includes STAGE or anything depending on it')
+    parser.add_argument('--variant',action='append',metavar='NAME',help='build only this variant (may be given more than once)')
+    parser.add_argument('--verify',metavar='BUILD',help="check the NAS copy of a published build against its manifest, and exit")
+    parser.add_argument('--record-profile',metavar='BUILD',help='write IMAGE_PROFILE from the files a client read from a published tree, and exit')
+    args = parser.parse_args()
+    if args.jobs<1:
+        parser.error('--jobs must be at least 1')
+    if args.record_profile:
+        stageFinish().record_profile(args.record_profile)
+        sys.exit(0)
+    if args.verify:
+        sys.exit(0 if stageFinish().verify(args.verify) else 1)
+    for name in args.variant or []:
+        if name not in VARIANTS:
+            sys.exit(f'Unknown variant: {name}')
+    target=stageExtraRootFiles if VARIANTS and not VARIANT else stageFinish
+    if args.plan:
+        plan=buildplan(target)
+        plan.show()
+        found=LAYER_CACHE and stageRootFS in plan.order and find_layer(target,args.no_cache_from)
+        if found:
+            print(f"Would start from cached layer {found[1]} with: {', '.join(sorted(found[2]['stages']))}")
+        if (root/'var/lib/pacman/sync').is_dir():
+            pm=stagePackagesMain()
+            todo=[e for e in pm.entries() if not os.path.isfile(pm.marker(e))]
+            db=pacman_db()
+            targets=[e[2:] if e.startswith('g:') else e for e in todo if e.startswith('g:') or e in db.sync]
+            needed,_=db.closure(targets)
+            cached=sum(1 for p in needed if (pkgcache/p['filename']).exists())
+            print(f"packages-main: {len(todo)} entries left, {len(needed)} repository packages to install ({cached} cached, {sum(p['csize'] for p in needed)/2**20:.0f} MiB), {len(todo)-len(targets)} not in the repositories")
+        if target is not stageFinish:
+            base=variant_base()
+            for name in args.variant or sorted(VARIANTS):
+                print(f"Variant {name}: {'resumes its clone of the current base' if variant_origin(name)==base else 'cloned from the base once it is built'}")
+    else:
+        run_build(stageFinish,jobs=args.jobs,no_cache_from=args.no_cache_from,variants=args.variant)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import argparse
+from pathlib import Path
+
+metrics = Path(os.getcwd()) / '.cache' / 'metrics'
+
+def format_duration(seconds):
+    seconds=int(seconds)
+    return f'{seconds//3600}:{seconds//60%60:02d}:{seconds%60:02d}'
+
+def find(build):
+    # A build is named by its archived name (<timestamp>, or
+    # <timestamp>-<variant>), 'current' or 'current-<variant>', or a path to
+    # a metrics.jsonl (e.g. from a published image's .install).
+    if os.path.isfile(build):
+        return Path(build)
+    path=metrics/f'{build}.jsonl'
+    if not path.is_file():
+        available=sorted(p.stem for p in metrics.glob('*.jsonl')) if metrics.is_dir() else []
+        sys.exit(f'No metrics for build {build}. Available: {" ".join(available) or "none"}')
+    return path
+
+def load(build):
+    # Returns the wall time and totals of every stage, and of every package;
+    # package work is recorded under per-package stage names such as PM-<pkg>.
+    # Also returns the last initramfs record, if any.
+    stages={}
+    packages={}
+    initramfs=None
+    with open(find(build),'r') as f:
+        for line in f:
+            try:
+                record=json.loads(line)
+            except ValueError:
+                continue
+            if record.get('type')=='stage':
+                # A stage that ran several times (resumed builds) counts once
+                # per run.
+                s=stages.setdefault(record['name'],{'wall':0,'user':0,'sys':0,'maxrss':0,'ok':False})
+                for k in ['wall','user','sys']:
+                    s[k]+=record.get(k,0)
+                s['maxrss']=max(s['maxrss'],record.get('maxrss',0))
+                s['ok']=s['ok'] or record.get('ok',False)
+            elif record.get('type')=='cmd' and record.get('stage','')[:3] in ['PM-','PA-','PK-','PE-','PL-']:
+                p=packages.setdefault(record['stage'][3:],{'wall':0,'user':0,'sys':0,'maxrss':0})
+                for k in ['wall','user','sys']:
+                    p[k]+=record.get(k,0)
+                p['maxrss']=max(p['maxrss'],record.get('maxrss',0))
+            elif record.get('type')=='initramfs':
+                initramfs=record
+    return stages,packages,initramfs
+
+def describe_initramfs(record):
+    if not record:
+        return 'not built'
+    return f"{record['size']/2**20:.1f} MiB {record.get('compression')}, unpacks in {record['unpack']:.2f} s{' (cached)' if record.get('cached') else ''}"
+
+def show(title,items,top):
+    print(title)
+    ranked=sorted(items.items(),key=lambda i: i[1]['wall'],reverse=True)[:top]
+    for name,i in ranked:
+        print(f"    {format_duration(i['wall'])}  {name:40s} user {i['user']:8.1f}s  sys {i['sys']:7.1f}s  maxrss {i['maxrss']//1024:6d} MiB")
+    if not ranked:
+        print("    (none)")
+
+def compare(title,old,new,threshold,min_seconds):
+    print(title)
+    found=False
+    for name in sorted(new,key=lambda n: new[n]['wall']-old.get(n,{'wall':0})['wall'],reverse=True):
+        before=old.get(name,{'wall':0})['wall']
+        after=new[name]['wall']
+        if after-before<min_seconds or after<before*(1+threshold):
+            continue
+        found=True
+        change=f"+{100*(after-before)/before:.0f}%" if before else "new"
+        print(f"    {format_duration(before)} -> {format_duration(after)}  {change:>6s}  {name}")
+    if not found:
+        print("    (none)")
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Report on the metrics recorded by build_image.py.')
+    parser.add_argument('build',nargs='?',default='current',help='build to report on (default: current)')
+    parser.add_argument('--compare',nargs=2,metavar=('OLD','NEW'),help='list stages and packages that got slower from OLD to NEW')
+    parser.add_argument('--top',type=int,default=20,help='number of stages and packages to list')
+    parser.add_argument('--threshold',type=float,default=0.2,help='relative slowdown reported as a regression')
+    parser.add_argument('--min-seconds',type=float,default=30,help='absolute slowdown reported as a regression')
+    args = parser.parse_args()
+    if args.compare:
+        old_stages,old_packages,old_initramfs=load(args.compare[0])
+        new_stages,new_packages,new_initramfs=load(args.compare[1])
+        old_total=sum(s['wall'] for s in old_stages.values())
+        new_total=sum(s['wall'] for s in new_stages.values())
+        print(f"Total stage time: {format_duration(old_total)} -> {format_duration(new_total)}")
+        compare("Slower stages:",old_stages,new_stages,args.threshold,args.min_seconds)
+        compare("Slower packages:",old_packages,new_packages,args.threshold,args.min_seconds)
+        print(f"Initramfs: {describe_initramfs(old_initramfs)} -> {describe_initramfs(new_initramfs)}")
+    else:
+        stages,packages,initramfs=load(args.build)
+        print(f"Total stage time: {format_duration(sum(s['wall'] for s in stages.values()))}")
+        show("Slowest stages:",stages,args.top)
+        show("Slowest packages:",packages,args.top)
+        print(f"Initramfs: {describe_initramfs(initramfs)}")
@@ -1,9 +1,27 @@
 #!/usr/bin/env python
 import os
 import sys
+import time
 from build_config import *
 
 if not os.geteuid()==0:
     sys.exit('This script must be run as root!')
 
-os.system(f"zfs destroy -r {ZFS_CWD}/.install")
\ No newline at end of file
+# The shared package cache and the chroot's API filesystems may still be
+# mounted if a build was killed.
+os.system(f"umount -R {os.getcwd()}/.install 2>/dev/null")
+os.system(f"umount -R {os.getcwd()}/.variants/* 2>/dev/null")
+# Variant roots are clones of the shared root, so they go first.
+os.system(f"zfs destroy -r {ZFS_CWD}/.variants 2>/dev/null")
+# A root with cached layers (see build_image.py) is moved under .layers, where
+# later builds can clone them; its other snapshots are dropped.
+snaps=os.popen(f"zfs list -H -t snapshot -o name -d 1 {ZFS_CWD}/.install 2>/dev/null").read().split()
+if any('@layer-' in s for s in snaps):
+    for s in snaps:
+        if '@layer-' not in s:
+            os.system(f"zfs destroy -R {s}")
+    if os.system(f"zfs list {ZFS_CWD}/.layers >/dev/null 2>&1")!=0:
+        os.system(f"zfs create -o mountpoint=none {ZFS_CWD}/.layers")
+    os.system(f"zfs rename {ZFS_CWD}/.install {ZFS_CWD}/.layers/{int(time.time())}")
+else:
+    os.system(f"zfs destroy -r {ZFS_CWD}/.install")
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Manifests of install roots: for everything under the root (on the root's
+# filesystem), its path, type, mode, owner, size, mtime, inode, content hash
+# and extended attributes, one tab-separated line each, sorted by path.
+# Files are hashed (blake2b) on a pool of threads, which hashlib lets run on
+# all cores.  Files whose path, inode, size and mtime match the previous
+# manifest keep its hash without being read.
+#
+# build_image.py writes the manifest of every build into .install/manifest.tsv
+# and keeps a copy in .cache/manifests/<build>.tsv.  To verify a published
+# copy it runs this file on the NAS, with python3 reading it from stdin, so
+# it must keep working with Python 3.6.
+import os
+import sys
+import stat
+import fnmatch
+import hashlib
+import argparse
+import concurrent.futures
+import urllib.parse
+
+FIELDS = ['path','type','mode','owner','size','mtime','inode','hash','xattrs']
+HEADER = '# manifest 1, blake2b-128: '+' '.join(FIELDS)
+# Neither part of the image as published nor stable across copies of it.
+EXCLUDE = ['/var/cache/pacman/pkg/*','/.install/manifest.tsv','/.install/rsync.log']
+
+def quote(name):
+    # Paths and attribute names are bytes; percent-encoding keeps them on one
+    # line whatever they contain.
+    return urllib.parse.quote_from_bytes(name,safe="/~!$&'()*+,;=:@-._")
+
+def unquote(name):
+    return urllib.parse.unquote_to_bytes(name)
+
+def file_hash(path):
+    # Without updating access times where that is allowed, since those can
+    # be a boot profile (see build_image.py --record-profile).
+    h=hashlib.blake2b(digest_size=16)
+    try:
+        try:
+            fd=os.open(path,os.O_RDONLY|os.O_NOATIME)
+        except PermissionError:
+            fd=os.open(path,os.O_RDONLY)
+        with open(fd,'rb') as f:
+            while True:
+                chunk=f.read(1<<20)
+                if not chunk: break
+                h.update(chunk)
+    except OSError:
+        return 'unreadable'
+    return h.hexdigest()
+
+def xattrs(path):
+    try:
+        names=sorted(os.listxattr(path,follow_symlinks=False))
+    except OSError:
+        return '-'
+    values=[]
+    for name in names:
+        try:
+            value=os.getxattr(path,name,follow_symlinks=False)
+        except OSError:
+            continue
+        values.append(quote(name.encode())+'='+value.hex())
+    return ','.join(values) or '-'
+
+def describe(path,full,st):
+    # The entry of one path, with the hash of a regular file left as None.
+    mode=st.st_mode
+    size='0'
+    if stat.S_ISREG(mode):
+        kind,digest,size='f',None,str(st.st_size)
+    elif stat.S_ISDIR(mode):
+        kind,digest='d','-'
+    elif stat.S_ISLNK(mode):
+        kind,digest='l',quote(os.readlink(full))
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        kind,digest='c' if stat.S_ISCHR(mode) else 'b','%d:%d'%(os.major(st.st_rdev),os.minor(st.st_rdev))
+    elif stat.S_ISFIFO(mode):
+        kind,digest='p','-'
+    else:
+        kind,digest='s','-'
+    return [quote(path),kind,'%o'%stat.S_IMODE(mode),'%d:%d'%(st.st_uid,st.st_gid),size,
+            str(st.st_mtime_ns),str(st.st_ino),digest,xattrs(full)]
+
+def excluded(path,exclude):
+    return any(fnmatch.fnmatchcase(path,pattern) for pattern in exclude)
+
+def generate(root,previous=None,workers=None,exclude=EXCLUDE):
+    # Returns the entries of root, by quoted path, and the number of files
+    # that were read.  Paths start at / for the root itself.  Mount points
+    # are listed but not descended into.
+    root=os.fsencode(os.path.abspath(root))
+    previous=previous or {}
+    exclude=[os.fsencode(p) for p in exclude]
+    dev=os.lstat(root).st_dev
+    entries={}
+    pending={}
+    stack=[b'/']
+    while stack:
+        path=stack.pop()
+        full=root+path if path!=b'/' else root
+        st=os.lstat(full)
+        entry=describe(path,full,st)
+        entries[entry[0]]=entry
+        if entry[1]=='f':
+            prev=previous.get(entry[0])
+            if prev and prev[1]=='f' and prev[4:7]==entry[4:7]:
+                entry[7]=prev[7]
+            else:
+                # Hard links are read once.
+                size,first,waiting=pending.setdefault((st.st_dev,st.st_ino),(st.st_size,full,[]))
+                waiting.append(entry)
+        elif entry[1]=='d' and st.st_dev==dev:
+            with os.scandir(full) as it:
+                for child in it:
+                    name=(path if path!=b'/' else b'')+b'/'+child.name
+                    if not excluded(name,exclude):
+                        stack.append(name)
+    # Largest first, so one big file does not finish last on its own.
+    jobs=sorted(pending.values(),key=lambda p: -p[0])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for (size,full,waiting),digest in zip(jobs,pool.map(file_hash,[j[1] for j in jobs])):
+            for entry in waiting:
+                entry[7]=digest
+    return entries,len(jobs)
+
+def format_manifest(entries):
+    return HEADER+'\n'+''.join('\t'.join(entries[p])+'\n' for p in sorted(entries))
+
+def parse(text):
+    entries={}
+    for line in text.split('\n'):
+        if not line or line[0]=='#': continue
+        entry=line.split('\t')
+        if len(entry)==len(FIELDS):
+            entries[entry[0]]=entry
+    return entries
+
+def read(path):
+    with open(path,'r') as f:
+        return parse(f.read())
+
+def write(entries,path):
+    with open('%s.tmp'%path,'w') as f:
+        f.write(format_manifest(entries))
+    os.replace('%s.tmp'%path,path)
+
+def diff(old,new,ignore=('mtime','inode')):
+    # Paths only in new, only in old, and in both but different in a field
+    # not ignored (with the names of those fields).
+    compared=[i for i,f in enumerate(FIELDS) if f not in ignore and f!='path']
+    added=sorted(p for p in new if p not in old)
+    removed=sorted(p for p in old if p not in new)
+    changed=[]
+    for p in sorted(new):
+        if p in old:
+            fields=[FIELDS[i] for i in compared if old[p][i]!=new[p][i]]
+            if fields:
+                changed.append((p,fields))
+    return added,removed,changed
+
+def show_diff(added,removed,changed,limit=None):
+    lines=['+ '+p for p in added]+['- '+p for p in removed]+['M %s (%s)'%(p,','.join(f)) for p,f in changed]
+    for line in lines[:limit]:
+        print(line)
+    if limit is not None and len(lines)>limit:
+        print('... %d more'%(len(lines)-limit))
+    print('%d added, %d removed, %d changed'%(len(added),len(removed),len(changed)))
+
+def find(name):
+    # A manifest file, or the name of a build whose manifest build_image.py
+    # kept in .cache/manifests.
+    if os.path.isfile(name):
+        return name
+    path=os.path.join('.cache','manifests',name+'.tsv')
+    if not os.path.isfile(path):
+        sys.exit('No manifest for build %s'%name)
+    return path
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Write, compare and check manifests of install roots.')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('generate',help='write the manifest of a root')
+    p.add_argument('root')
+    p.add_argument('-o','--output',help='file to write, - for stdout (default: ROOT/.install/manifest.tsv)')
+    p.add_argument('--previous',help='earlier manifest whose hashes of unchanged files are reused')
+    p.add_argument('--jobs',type=int,help='hashing threads (default: one per core)')
+    p = sub.add_parser('diff',help='list what changed between two manifests or builds')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--limit',type=int,help='list at most this many paths')
+    p = sub.add_parser('check',help='hash a root and compare it with a manifest')
+    p.add_argument('root')
+    p.add_argument('manifest')
+    p.add_argument('--jobs',type=int,help='hashing threads (default: one per core)')
+    args = parser.parse_args()
+    if args.command=='generate':
+        entries,hashed=generate(args.root,read(args.previous) if args.previous else None,args.jobs)
+        if args.output=='-':
+            sys.stdout.write(format_manifest(entries))
+        else:
+            write(entries,args.output or os.path.join(args.root,'.install','manifest.tsv'))
+            print('%d entries, %d files hashed'%(len(entries),hashed),file=sys.stderr)
+    elif args.command=='diff':
+        show_diff(*diff(read(find(args.old)),read(find(args.new))),limit=args.limit)
+    elif args.command=='check':
+        entries,_=generate(args.root,None,args.jobs)
+        result=diff(read(find(args.manifest)),entries)
+        show_diff(*result,limit=100)
+        sys.exit(1 if any(result) else 0)
+    else:
+        parser.print_help()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# Reads a root's pacman databases directly: the sync databases
+# (var/lib/pacman/sync/*.db, tar archives) and the local database
+# (var/lib/pacman/local/*/desc).  Group expansion, installed checks and
+# dependency closure become dictionary lookups instead of a pacman run in the
+# chroot each.  The parsed databases are cached on disk as JSON, keyed by
+# each database's mtime and size, so an unchanged database is only parsed
+# once.
+import os
+import io
+import re
+import sys
+import json
+import tarfile
+import hashlib
+import platform
+import subprocess
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def parse_desc(text):
+    # The %SECTION% blocks of a desc file, as lists of lines.
+    fields={}
+    key=None
+    for line in text.split('\n'):
+        if len(line)>2 and line[0]=='%' and line[-1]=='%':
+            key=line[1:-1]
+            fields[key]=[]
+        elif line and key:
+            fields[key].append(line)
+        else:
+            key=None
+    return fields
+
+def depname(dep):
+    # 'foo>=1.2' and 'libfoo.so=1-64' name foo and libfoo.so; version
+    # constraints are not checked.
+    return re.split('[<>=]',dep)[0].strip()
+
+def rpmvercmp(a,b):
+    # pacman's comparison of version strings, segment by segment: numbers
+    # numerically and newer than letters, more separators newer, and a
+    # trailing letter segment older than none (1.0rc < 1.0 < 1.0.a).
+    if a==b: return 0
+    i=j=0
+    while i<len(a) and j<len(b):
+        si,sj=i,j
+        while i<len(a) and not a[i].isalnum(): i+=1
+        while j<len(b) and not b[j].isalnum(): j+=1
+        if i==len(a) or j==len(b): break
+        if i-si!=j-sj:
+            return -1 if i-si<j-sj else 1
+        digits=a[i].isdigit()
+        pattern='[0-9]+' if digits else '[A-Za-z]+'
+        one=re.match(pattern,a[i:])
+        two=re.match(pattern,b[j:])
+        if not one or not two:
+            # A letter segment where the other has a number.
+            return 1 if digits else -1
+        one,two=one.group(),two.group()
+        i+=len(one)
+        j+=len(two)
+        if digits:
+            one,two=int(one),int(two)
+        if one!=two:
+            return -1 if one<two else 1
+    if i>=len(a) and j>=len(b): return 0
+    if (i>=len(a) and not b[j].isalpha()) or (i<len(a) and a[i].isalpha()):
+        return -1
+    return 1
+
+def vercmp(a,b):
+    # Compares [epoch:]pkgver[-pkgrel] versions as pacman's vercmp does.
+    def split(v):
+        epoch,_,v=v.partition(':') if ':' in v else ('0','',v)
+        ver,_,rel=v.rpartition('-') if '-' in v else (v,'','')
+        return epoch,ver,rel
+    (e1,v1,r1),(e2,v2,r2)=split(a),split(b)
+    return rpmvercmp(e1,e2) or rpmvercmp(v1,v2) or (rpmvercmp(r1,r2) if r1 and r2 else 0)
+
+def record(fields):
+    return {
+        'name':fields['NAME'][0],
+        'version':fields.get('VERSION',[''])[0],
+        'groups':fields.get('GROUPS',[]),
+        'provides':[depname(p) for p in fields.get('PROVIDES',[])],
+        'depends':[depname(d) for d in fields.get('DEPENDS',[])],
+        'filename':fields.get('FILENAME',[''])[0],
+        'csize':int(fields.get('CSIZE',['0'])[0]),
+    }
+
+def read_sync(path):
+    with open(path,'rb') as f:
+        data=f.read()
+    if data[:4]==b'\x28\xb5\x2f\xfd':
+        if zstandard:
+            data=zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        else:
+            data=subprocess.run(['zstd','-dcq',str(path)],stdout=subprocess.PIPE,check=True).stdout
+    # Entries are directories of desc (and, in old databases, depends) files.
+    entries={}
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        for member in tar:
+            if not member.isfile(): continue
+            entry,_,name=member.name.rpartition('/')
+            if name not in ('desc','depends'): continue
+            entries.setdefault(entry,{}).update(parse_desc(tar.extractfile(member).read().decode(errors='ignore')))
+    packages={}
+    for fields in entries.values():
+        if 'NAME' in fields:
+            pkg=record(fields)
+            packages[pkg['name']]=pkg
+    return packages
+
+def read_local(path):
+    packages={}
+    for entry in os.listdir(path):
+        try:
+            with open(os.path.join(path,entry,'desc'),'r',errors='ignore') as f:
+                fields=parse_desc(f.read())
+        except (FileNotFoundError,NotADirectoryError):
+            # Not a package, or one being installed or removed right now.
+            continue
+        if 'NAME' in fields:
+            pkg=record(fields)
+            packages[pkg['name']]=pkg
+    return packages
+
+def read_files(path):
+    # The owning package of each path in the local database's file lists
+    # (relative, directories ending in /).  A directory several packages own
+    # is given one of them.
+    owners={}
+    for entry in os.listdir(path):
+        try:
+            with open(os.path.join(path,entry,'desc'),'r',errors='ignore') as f:
+                name=parse_desc(f.read()).get('NAME',[None])[0]
+            with open(os.path.join(path,entry,'files'),'r',encoding='utf-8',errors='surrogateescape') as f:
+                files=parse_desc(f.read()).get('FILES',[])
+        except (FileNotFoundError,NotADirectoryError):
+            continue
+        for p in files:
+            owners[p]=name
+    return owners
+
+class pacmandb():
+    def __init__(self,root,cachedir=None):
+        self.root=Path(root)
+        self.cachedir=Path(cachedir) if cachedir else None
+        self.conf=self.read_conf()
+        syncdir=self.root/'var/lib/pacman/sync'
+        dbs=sorted(f[:-3] for f in os.listdir(syncdir) if f.endswith('.db')) if syncdir.is_dir() else []
+        # pacman.conf order decides which repository wins a name or provides.
+        self.repos=[r for r in self.conf if r in dbs]+[r for r in dbs if r not in self.conf]
+        self.sync={}
+        self.repo={}
+        for repo in self.repos:
+            for name,pkg in self.load(syncdir/f'{repo}.db',read_sync).items():
+                if name not in self.sync:
+                    self.sync[name]=pkg
+                    self.repo[name]=repo
+        localdir=self.root/'var/lib/pacman/local'
+        self.local=self.load(localdir,read_local) if localdir.is_dir() else {}
+        self.groups={}
+        self.providers={}
+        for name,pkg in self.sync.items():
+            for g in pkg['groups']:
+                self.groups.setdefault(g,[]).append(name)
+            for p in pkg['provides']:
+                self.providers.setdefault(p,[]).append(name)
+
+    def read_conf(self):
+        # Repository sections of the root's pacman.conf, in order, with their
+        # servers.
+        conf={}
+        section=None
+        def read(path):
+            nonlocal section
+            try:
+                with open(path,'r') as f:
+                    lines=f.read().split('\n')
+            except FileNotFoundError:
+                return
+            for line in lines:
+                line=line.split('#')[0].strip()
+                if line.startswith('[') and line.endswith(']'):
+                    section=line[1:-1]
+                    if section!='options':
+                        conf.setdefault(section,[])
+                    continue
+                key,_,value=line.partition('=')
+                key=key.strip()
+                value=value.strip()
+                if section in conf and key=='Server':
+                    conf[section].append(value)
+                elif section in conf and key=='Include':
+                    read(self.root/value.lstrip('/'))
+        read(self.root/'etc/pacman.conf')
+        return conf
+
+    def load(self,path,reader):
+        st=os.stat(path)
+        key=[st.st_mtime_ns,st.st_size if path.is_file() else len(os.listdir(path))]
+        cached=None
+        if self.cachedir:
+            cached=self.cachedir/(hashlib.sha256(str(Path(path).resolve()).encode()).hexdigest()[:24]+'.json')
+            try:
+                with open(cached,'r') as f:
+                    data=json.load(f)
+                if data['key']==key:
+                    return data['packages']
+            except (FileNotFoundError,ValueError,KeyError):
+                pass
+        packages=reader(path)
+        if cached:
+            self.cachedir.mkdir(parents=True,exist_ok=True)
+            with open(f'{cached}.tmp','w') as f:
+                json.dump({'path':str(path),'key':key,'packages':packages},f)
+            os.replace(f'{cached}.tmp',cached)
+        return packages
+
+    def installed(self,name):
+        # As pacman -Q: a package that only provides name does not count.
+        return name in self.local
+
+    def group(self,group):
+        # Members of a sync group, as pacman -Sg lists them.
+        return sorted(self.groups.get(group,[]))
+
+    def provider(self,name):
+        if name in self.sync:
+            return name
+        providers=self.providers.get(name)
+        return providers[0] if providers else None
+
+    def closure(self,targets):
+        # The sync packages that installing targets (package or group names)
+        # with --needed would download: targets and their dependencies,
+        # leaving out what is installed in the same version and dependencies
+        # the local database already satisfies.  Returns them in resolution
+        # order, and the names that could not be resolved.
+        queue=[]
+        missing=[]
+        for t in targets:
+            if self.provider(t):
+                queue.append(self.provider(t))
+            elif t in self.groups:
+                queue.extend(self.group(t))
+            else:
+                missing.append(t)
+        result={}
+        while queue:
+            name=queue.pop(0)
+            if name in result: continue
+            pkg=self.sync[name]
+            if self.local.get(name,{}).get('version')==pkg['version']: continue
+            result[name]=pkg
+            for dep in pkg['depends']:
+                if dep in result or self.installed(dep): continue
+                p=self.provider(dep)
+                if p is None:
+                    missing.append(dep)
+                else:
+                    queue.append(p)
+        return list(result.values()),missing
+
+    def url(self,name):
+        # Where pacman would download a sync package from: its repository's
+        # first server.
+        repo=self.repo[name]
+        servers=self.conf.get(repo)
+        if not servers: return None
+        arch=platform.machine()
+        server=servers[0].replace('$repo',repo).replace('$arch',arch)
+        return f"{server}/{self.sync[name]['filename']}"
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Query the pacman databases of a root.')
+    parser.add_argument('root',help='root directory, e.g. .install')
+    parser.add_argument('--group',action='append',default=[],help='list the members of a sync group')
+    parser.add_argument('--installed',action='append',default=[],help='check whether a package is installed')
+    parser.add_argument('--closure',nargs='+',help='list what installing these packages or groups would download')
+    args = parser.parse_args()
+    db=pacmandb(args.root)
+    print(f"{len(db.sync)} sync packages in {', '.join(db.repos) or 'no repositories'}, {len(db.groups)} groups, {len(db.local)} installed")
+    for g in args.group:
+        print(g+':',' '.join(db.group(g)))
+    for p in args.installed:
+        print(p+':','installed' if db.installed(p) else 'not installed')
+    if args.closure:
+        packages,missing=db.closure(args.closure)
+        for pkg in packages:
+            print(f"{db.repo[pkg['name']]}/{pkg['name']} {pkg['version']} {pkg['csize']/2**20:.1f} MiB")
+        print(f"{len(packages)} packages, {sum(p['csize'] for p in packages)/2**20:.1f} MiB")
+        if missing:
+            print("Not found:",' '.join(missing))
+            sys.exit(1)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# Slims an install root before it is published: removes what its rules select
+# (documentation, man pages, unused locales, static libraries, ...), keeping
+# a list of the removed files with the packages that own them, then replaces
+# files with the same content by hard links (or reflinks).  Candidates, files
+# of a size shared with another inode, are hashed on a pool of threads.
+#
+# Rules, one per line: a glob pattern matched against paths from /, in which
+# * also matches /, optionally followed by the names of the packages the rule
+# is limited to.  A pattern starting with ! keeps what it matches.  The last
+# rule matching a path decides; directories are only removed once empty.
+import os
+import sys
+import stat
+import time
+import fcntl
+import fnmatch
+import argparse
+import concurrent.futures
+import pacdb
+import manifest
+
+# Build records and the package cache are left alone.
+SKIP = ['/.install','/var/cache/pacman/pkg']
+FICLONE = 0x40049409
+
+def read_rules(path):
+    rules=[]
+    with open(path,'r') as f:
+        for line in f:
+            words=line.split()
+            if not words or words[0][0]=='#': continue
+            keep=words[0][0]=='!'
+            rules.append((keep,words[0].lstrip('!'),set(words[1:])))
+    return rules
+
+def selected(path,owner,rules):
+    remove=False
+    for keep,pattern,packages in rules:
+        if packages and owner not in packages: continue
+        if fnmatch.fnmatchcase(path,pattern):
+            remove=not keep
+    return remove
+
+def walk(root):
+    # (path from /, lstat) of everything under root on its filesystem.
+    # Mount points are listed but not descended into.
+    dev=os.lstat(root).st_dev
+    stack=['/']
+    while stack:
+        path=stack.pop()
+        st=os.lstat(root+path)
+        yield path,st
+        if stat.S_ISDIR(st.st_mode) and st.st_dev==dev:
+            with os.scandir(root+path) as it:
+                for child in it:
+                    name=path.rstrip('/')+'/'+child.name
+                    if name not in SKIP:
+                        stack.append(name)
+
+def remove(root,entries,rules,owners,dry_run=False):
+    # Removes the files and then the emptied directories the rules select.
+    # Returns the removed paths as (path, owning package or '-', size).
+    dev=entries[0][1].st_dev
+    removed=[]
+    dirs=[]
+    for path,st in entries:
+        if path=='/' or st.st_dev!=dev: continue
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append(path)
+            continue
+        owner=owners.get(path[1:],'-')
+        if selected(path,owner,rules):
+            removed.append((path,owner,st.st_size if stat.S_ISREG(st.st_mode) else 0))
+            if not dry_run:
+                os.unlink(root+path)
+    # Deepest first, so a directory emptied by removing its subdirectories
+    # goes too.
+    for path in sorted(dirs,reverse=True):
+        owner=owners.get(path[1:]+'/','-')
+        if dry_run or not selected(path,owner,rules): continue
+        try:
+            os.rmdir(root+path)
+        except OSError:
+            continue
+        removed.append((path+'/',owner,0))
+    return removed
+
+def duplicates(root,entries,min_size=1,workers=None):
+    # Groups of regular files of at least min_size bytes with the same
+    # content, mode, owner and extended attributes: lists of inodes, each a
+    # sorted list of its paths, the inode to keep first.
+    sizes={}
+    for path,st in entries:
+        if stat.S_ISREG(st.st_mode) and st.st_size>=min_size:
+            key=(st.st_size,stat.S_IMODE(st.st_mode),st.st_uid,st.st_gid)
+            sizes.setdefault(key,{}).setdefault((st.st_dev,st.st_ino),[]).append(path)
+    jobs=[(key,sorted(paths)) for key,inodes in sizes.items() if len(inodes)>1 for paths in inodes.values()]
+    # Largest first, so one big file does not finish last on its own.
+    jobs.sort(key=lambda j: -j[0][0])
+    same={}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for (key,paths),digest in zip(jobs,pool.map(manifest.file_hash,[root+j[1][0] for j in jobs])):
+            if digest=='unreadable': continue
+            same.setdefault((key,digest,manifest.xattrs(root+paths[0])),[]).append(paths)
+    return [sorted(inodes) for inodes in same.values() if len(inodes)>1]
+
+def reflink(source,target):
+    # Shares source's blocks with target, which keeps its inode and times.
+    st=os.lstat(target)
+    with open(source,'rb') as s, open(target,'r+b') as t:
+        fcntl.ioctl(t.fileno(),FICLONE,s.fileno())
+    os.utime(target,ns=(st.st_atime_ns,st.st_mtime_ns))
+
+def link(root,groups,method='hardlink',dry_run=False):
+    # Makes every inode of each group share the first one's content.
+    # Returns the number of files replaced and the bytes that saves.
+    files=saved=0
+    for inodes in groups:
+        keep=root+inodes[0][0]
+        size=os.lstat(keep).st_size
+        for paths in inodes[1:]:
+            try:
+                for path in paths:
+                    if dry_run:
+                        pass
+                    elif method=='reflink':
+                        reflink(keep,root+path)
+                    else:
+                        os.link(keep,root+path+'.slim')
+                        os.replace(root+path+'.slim',root+path)
+                    files+=1
+            except OSError as e:
+                if method=='reflink':
+                    # Not supported by the filesystem; nothing was changed.
+                    print(f'Reflinks: {e}',file=sys.stderr)
+                    return files,saved
+                print(f'{paths[0]}: {e}',file=sys.stderr)
+                continue
+            saved+=size
+    return files,saved
+
+def usage(entries):
+    # Regular files and their bytes, each inode counted once.
+    files=[st for path,st in entries if stat.S_ISREG(st.st_mode)]
+    return len(files),sum({(st.st_dev,st.st_ino):st.st_size for st in files}.values())
+
+def slim(root,rules,method='hardlink',min_size=1,dry_run=False,workers=None):
+    # Returns the removed paths (see remove) and the counts for report().
+    root=os.path.abspath(root)
+    start=time.time()
+    entries=list(walk(root))
+    files,size=usage(entries)
+    local=os.path.join(root,'var/lib/pacman/local')
+    owners=pacdb.read_files(local) if os.path.isdir(local) else {}
+    removed=remove(root,entries,rules,owners,dry_run)
+    gone={p for p,_,_ in removed}
+    entries=[(p,st) for p,st in entries if p not in gone]
+    after_files,after_size=usage(entries)
+    linked=saved=0
+    if method:
+        linked,saved=link(root,duplicates(root,entries,min_size,workers),method,dry_run)
+    counts=dict(files=files,bytes=size,removed=len([r for r in removed if not r[0].endswith('/')]),removed_bytes=size-after_size,
+                linked=linked,linked_bytes=saved,files_after=after_files,bytes_after=after_size-saved,wall=round(time.time()-start,3))
+    return removed,counts
+
+def write_removed(removed,path):
+    with open(path,'w') as f:
+        f.write('# slim 1: path package size\n')
+        for p,owner,size in sorted(removed):
+            f.write('%s\t%s\t%d\n'%(manifest.quote(os.fsencode(p)),owner,size))
+
+def report(counts):
+    mib=lambda n: '%.0f MiB'%(n/2**20)
+    print(f"Slim: {counts['files']} files ({mib(counts['bytes'])}) before, {counts['files_after']} ({mib(counts['bytes_after'])}) after")
+    print(f"    removed {counts['removed']} files ({mib(counts['removed_bytes'])}), "
+          f"linked {counts['linked']} duplicates ({mib(counts['linked_bytes'])}), {counts['wall']:.1f} s")
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Remove what the rules select from a root and link its duplicate files.')
+    parser.add_argument('root')
+    parser.add_argument('--rules',default='slim.txt',help='rules file (default: slim.txt)')
+    parser.add_argument('--dedup',choices=['hardlink','reflink','none'],default='hardlink',help='how duplicates are linked (default: hardlink)')
+    parser.add_argument('--min-size',type=int,default=4096,help='smallest file linked, in bytes (default: 4096)')
+    parser.add_argument('--jobs',type=int,help='hashing threads (default: one per core)')
+    parser.add_argument('--dry-run',action='store_true',help='only list what would be removed and report')
+    args = parser.parse_args()
+    removed,counts=slim(args.root,read_rules(args.rules),None if args.dedup=='none' else args.dedup,args.min_size,args.dry_run,args.jobs)
+    if args.dry_run:
+        for p,owner,size in sorted(removed):
+            print(f'{p}\t{owner}\t{size}')
+    report(counts)
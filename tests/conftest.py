@@ -0,0 +1,28 @@
+# The builder is imported in a scratch directory set up as bench/run_bench.py
+# sets one up, with bench/shim.py standing in for zfs, pacman and the rest.
+import os
+import sys
+import pytest
+from pathlib import Path
+
+repo = Path(__file__).resolve().parent.parent
+sys.path.insert(0,str(repo/'bench'))
+sys.path.insert(0,str(repo))
+import run_bench
+import mirror
+
+@pytest.fixture(scope='session')
+def builder(tmp_path_factory):
+    work=tmp_path_factory.mktemp('bench')
+    args=run_bench.arguments().parse_args(['--packages','10','--aur-percent','0','--output-lines','0'])
+    server,url=mirror.serve(work/'mirror',{'size':1024,'latency':0,'bandwidth':0})
+    run_bench.setup(args,work,server,url)
+    os.environ['BENCH_DIR']=str(work)
+    os.environ['PATH']=f"{work/'bin'}:{os.environ['PATH']}"
+    os.chdir(work)
+    sys.path.insert(0,str(work))
+    import build_image
+    os.system(f'zfs create {build_image.dataset}')
+    (build_image.root/'.install').mkdir(exist_ok=True)
+    yield build_image
+    server.shutdown()
@@ -0,0 +1,42 @@
+import time
+
+def test_stage_with_own_snapshots_runs_alone(builder,monkeypatch):
+    # The first stage rolls the root back to a snapshot of its own; had the
+    # second run alongside it, its file would be rolled back with it.
+    b=builder
+    monkeypatch.setattr(b,'LAYER_CACHE',False)
+    log=[]
+    class stageFirst(b.buildstage):
+        def stagename(self):
+            return 'test-first'
+        def exclusive(self):
+            return True
+        def execute(self,handler):
+            log.append('first start')
+            b.take_snapshot('test-batch')
+            (b.root/'half-done').write_text('')
+            time.sleep(0.5)
+            b.rollback_snapshot('test-batch')
+            log.append('first end')
+            self.mark_complete()
+    class stageSecond(b.buildstage):
+        def stagename(self):
+            return 'test-second'
+        def execute(self,handler):
+            log.append('second start')
+            time.sleep(0.2)
+            (b.root/'second').write_text('')
+            log.append('second end')
+            self.mark_complete()
+    class stageBoth(b.buildstage):
+        def stagename(self):
+            return 'test-both'
+        def deps(self):
+            return [stageFirst,stageSecond]
+        def execute(self,handler):
+            self.mark_complete()
+    b.execute_plan(b.buildplan(stageBoth),2)
+    b.flush_snapshots()
+    assert log==['first start','first end','second start','second end']
+    assert (b.root/'second').exists()
+    assert not (b.root/'half-done').exists()
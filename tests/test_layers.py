@@ -0,0 +1,17 @@
+import os
+import time
+
+def test_eviction_counts_layers_on_the_live_root(builder,monkeypatch):
+    # A layer snapshot of the live root holds its size even with nothing
+    # under .layers, and is evicted once it is over the limit.
+    b=builder
+    with open(b.root/'layer-data','wb') as f:
+        f.write(os.urandom(1<<20))
+    assert os.system(f'zfs snapshot {b.dataset}@layer-testkey')==0
+    b.save_layers({'testkey':{'stages':{},'created':int(time.time()),'used':int(time.time())}})
+    assert b.layers_used()>=1<<20
+    monkeypatch.setattr(b,'LAYER_CACHE_MAX_GB',0.5/1024)
+    b.evict_layers()
+    assert 'testkey' not in b.layer_snapshots()
+    assert b.load_layers()=={}
+    os.remove(b.root/'layer-data')
@@ -0,0 +1,55 @@
+import asyncio
+import mmap
+import socket
+import struct
+import threading
+import tftpserv
+
+def boot_root(tmp_path,size):
+    (tmp_path/'mounts').mkdir()
+    (tmp_path/'mounts'/'latest').write_text('1\n')
+    (tmp_path/'builds'/'1'/'boot').mkdir(parents=True)
+    (tmp_path/'builds'/'1'/'boot'/'file').write_bytes(bytes(range(256))*(size//256))
+    return tmp_path
+
+def test_file_is_unmapped_when_unused(tmp_path):
+    path=str(boot_root(tmp_path,4096)/'builds'/'1'/'boot'/'file')
+    files=tftpserv.filecache()
+    first=files.open(path)
+    second=files.open(path)
+    assert first is second and isinstance(first[2],mmap.mmap)
+    files.release(first)
+    assert not first[2].closed
+    files.release(second)
+    assert files.files=={} and first[2].closed
+
+def test_transfer_releases_its_mapping(tmp_path):
+    root=boot_root(tmp_path,1280)
+    loop=asyncio.new_event_loop()
+    server,transport=tftpserv.serve(loop,str(root),'127.0.0.1',0,quiet=True)
+    port=transport.get_extra_info('sockname')[1]
+    thread=threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        client=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        client.settimeout(5)
+        client.sendto(struct.pack('!H',tftpserv.RRQ)+b'file\0octet\0',('127.0.0.1',port))
+        received=b''
+        while True:
+            packet,addr=client.recvfrom(65536)
+            op,block=struct.unpack('!HH',packet[:4])
+            assert op==tftpserv.DATA
+            received+=packet[4:]
+            client.sendto(struct.pack('!HH',tftpserv.ACK,block),addr)
+            if len(packet)-4<512: break
+        assert received==(root/'builds'/'1'/'boot'/'file').read_bytes()
+        for _ in range(50):
+            if server.stats['transfers']: break
+            threading.Event().wait(0.1)
+        assert server.stats=={'transfers':1,'failed':0,'bytes':1280,'retransmits':0}
+        assert server.files.files=={}
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        transport.close()
+        loop.close()
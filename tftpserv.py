@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# TFTP server for netbooting the published images.  Runs on the NAS from the
+# root of NAS_IMAGE_PATH (see README.md) and serves, read-only, the /boot of
+# the build a client is to boot: the build named in mounts/<client MAC> if
+# there is one, else the one in mounts/latest.  So /grub/i386-pc/core.0 is
+# builds/<timestamp>/boot/grub/i386-pc/core.0.
+#
+# Negotiates blksize (RFC 2348), tsize and timeout (RFC 2349) and windowsize
+# (RFC 7440), so a client that asks for them gets large blocks and many blocks
+# per acknowledgement instead of lock-step 512 byte blocks.  Files are
+# memory-mapped once and shared by the transfers of them running at the same
+# time.  Each transfer's
+# size, options, duration, throughput and retransmissions are appended to a
+# JSON lines metrics file.
+#
+# Needs only Python 3.6 or later.
+import os
+import sys
+import json
+import mmap
+import time
+import socket
+import struct
+import asyncio
+import argparse
+
+RRQ, WRQ, DATA, ACK, ERROR, OACK = 1, 2, 3, 4, 5, 6
+NOT_FOUND, ACCESS_VIOLATION, ILLEGAL_OPERATION, UNKNOWN_TID, BAD_OPTIONS = 1, 2, 4, 5, 8
+
+def error_packet(code,message):
+    return struct.pack('!HH',ERROR,code)+message.encode()+b'\0'
+
+class filecache():
+    # Files being served, mapped once and shared by the transfers of them.  A
+    # mapping is closed when its last transfer ends, so the files of builds
+    # no longer served keep nothing open on their datasets.  A file replaced
+    # on disk (a new build published) is mapped anew; transfers still
+    # reading the old mapping keep it until they finish.
+    def __init__(self):
+        self.files={}
+    def open(self,path):
+        # Returns the file's entry, [path, key, data, transfers], for one
+        # more transfer; release() it when the transfer ends.
+        st=os.stat(path)
+        key=(st.st_dev,st.st_ino,st.st_size,st.st_mtime_ns)
+        entry=self.files.get(path)
+        if not entry or entry[1]!=key:
+            with open(path,'rb') as f:
+                data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) if st.st_size else b''
+            entry=self.files[path]=[path,key,data,0]
+        entry[3]+=1
+        return entry
+    def release(self,entry):
+        entry[3]-=1
+        if entry[3]>0: return
+        if self.files.get(entry[0]) is entry:
+            del self.files[entry[0]]
+        if isinstance(entry[2],mmap.mmap):
+            entry[2].close()
+
+class resolver():
+    # Maps a requested file name to a path in the /boot of the client's build.
+    def __init__(self,root):
+        self.root=os.path.abspath(root)
+    def mac(self,ip):
+        # The client's MAC address from the kernel's ARP table, as the
+        # mounts/ files name it: lower case, without colons.
+        try:
+            with open('/proc/net/arp','r') as f:
+                for line in f.read().split('\n')[1:]:
+                    fields=line.split()
+                    if len(fields)>=4 and fields[0]==ip:
+                        return fields[3].replace(':','').lower()
+        except OSError:
+            pass
+        return None
+    def build(self,ip):
+        for name in [self.mac(ip),'latest']:
+            if not name: continue
+            try:
+                with open(os.path.join(self.root,'mounts',name),'r') as f:
+                    build=f.read().strip()
+            except OSError:
+                continue
+            if build and '/' not in build:
+                return build
+        return None
+    def resolve(self,ip,filename):
+        build=self.build(ip)
+        if build is None:
+            return None
+        base=os.path.join(self.root,'builds',build,'boot')
+        path=os.path.normpath(os.path.join(base,filename.replace('\\','/').lstrip('/')))
+        if not path.startswith(base+os.sep):
+            return None
+        return path
+
+class transfer(asyncio.DatagramProtocol):
+    # One read request, served from its own port.  Blocks are numbered from 1
+    # and sent windowsize at a time; an acknowledgement of any block in the
+    # window moves the window past it, so a client that missed a block gets
+    # the window resent from there.  Without an acknowledgement the window is
+    # resent every timeout seconds, retries times.
+    def __init__(self,server,client,filename,path,entry,options):
+        self.server=server
+        self.client=client
+        self.filename=filename
+        self.path=path
+        self.entry=entry
+        self.data=entry[2]
+        self.blksize=options.get('blksize',512)
+        self.windowsize=options.get('windowsize',1)
+        self.timeout=options.get('timeout',server.timeout)
+        self.options=options
+        self.blocks=len(self.data)//self.blksize+1
+        self.base=0 if options else 1
+        self.retries=0
+        self.retransmits=0
+        self.timer=None
+        self.start=time.time()
+        self.done=False
+    def connection_made(self,transport):
+        self.transport=transport
+        sock=transport.get_extra_info('socket')
+        try:
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,1<<22)
+        except OSError:
+            pass
+        self.send_window()
+    def packet(self,block):
+        if block==0:
+            # The OACK, answering the options that were accepted.
+            fields=b''
+            for name,value in self.options.items():
+                fields+=name.encode()+b'\0'+str(value).encode()+b'\0'
+            return struct.pack('!H',OACK)+fields
+        offset=(block-1)*self.blksize
+        return struct.pack('!HH',DATA,block&0xffff)+self.data[offset:offset+self.blksize]
+    def send_window(self):
+        # The OACK is a window of its own.
+        self.last=self.base if self.base==0 else min(self.base+self.windowsize-1,self.blocks)
+        for block in range(self.base,self.last+1):
+            self.transport.sendto(self.packet(block),self.client)
+        if self.timer:
+            self.timer.cancel()
+        self.timer=asyncio.get_event_loop().call_later(self.timeout,self.expired)
+    def expired(self):
+        self.retries+=1
+        if self.retries>self.server.retries:
+            self.finish('timed out')
+            return
+        self.retransmits+=1
+        self.send_window()
+    def datagram_received(self,packet,addr):
+        if addr!=self.client:
+            self.transport.sendto(error_packet(UNKNOWN_TID,'Unknown transfer ID'),addr)
+            return
+        if len(packet)<4:
+            return
+        op,number=struct.unpack('!HH',packet[:4])
+        if op==ERROR:
+            self.finish('client error: '+packet[4:].rstrip(b'\0').decode(errors='replace'))
+            return
+        if op!=ACK or self.done:
+            return
+        # The block numbers wrap at 65536; the acknowledged block is the one
+        # with that number in the window just sent.
+        block=self.last-((self.last-number)&0xffff)
+        if block<self.base:
+            # A duplicate of an older acknowledgement; resending on those would
+            # double every packet from then on.
+            return
+        self.retries=0
+        self.base=block+1
+        if block>=self.blocks:
+            self.finish(None)
+        else:
+            self.send_window()
+    def error_received(self,exc):
+        pass
+    def finish(self,error):
+        if self.done: return
+        self.done=True
+        if self.timer:
+            self.timer.cancel()
+        self.transport.close()
+        self.server.record(self,error)
+
+class tftpserver(asyncio.DatagramProtocol):
+    # Listens for requests on the TFTP port and starts a transfer for each
+    # read request.
+    def __init__(self,root,bind,max_blksize=65464,max_windowsize=64,timeout=1,retries=5,metrics=None,quiet=False):
+        self.resolver=resolver(root)
+        self.files=filecache()
+        self.bind=bind
+        self.max_blksize=max_blksize
+        self.max_windowsize=max_windowsize
+        self.timeout=timeout
+        self.retries=retries
+        self.metrics=metrics
+        self.quiet=quiet
+        self.active=0
+        self.stats={'transfers':0,'failed':0,'bytes':0,'retransmits':0}
+    def connection_made(self,transport):
+        self.transport=transport
+    def datagram_received(self,packet,addr):
+        if len(packet)<4: return
+        op=struct.unpack('!H',packet[:2])[0]
+        if op==WRQ:
+            self.transport.sendto(error_packet(ACCESS_VIOLATION,'Read only'),addr)
+            return
+        if op!=RRQ:
+            self.transport.sendto(error_packet(ILLEGAL_OPERATION,'Illegal operation'),addr)
+            return
+        fields=packet[2:].split(b'\0')
+        if len(fields)<3:
+            return
+        filename=fields[0].decode(errors='replace')
+        # netascii is served as it is; boot files are binary either way.
+        requested={}
+        for i in range(2,len(fields)-1,2):
+            requested[fields[i].decode(errors='replace').lower()]=fields[i+1].decode(errors='replace')
+        asyncio.ensure_future(self.start(addr,filename,requested))
+    def negotiate(self,requested,size):
+        options={}
+        try:
+            if 'blksize' in requested:
+                options['blksize']=max(8,min(int(requested['blksize']),self.max_blksize))
+            if 'windowsize' in requested:
+                options['windowsize']=max(1,min(int(requested['windowsize']),self.max_windowsize))
+            if 'timeout' in requested and 1<=int(requested['timeout'])<=255:
+                options['timeout']=int(requested['timeout'])
+            if 'tsize' in requested:
+                options['tsize']=size
+        except ValueError:
+            return None
+        return options
+    async def start(self,client,filename,requested):
+        path=self.resolver.resolve(client[0],filename)
+        reply=None
+        try:
+            if path is None:
+                reply=error_packet(ACCESS_VIOLATION,'Access violation')
+            else:
+                entry=self.files.open(path)
+        except (FileNotFoundError,IsADirectoryError,NotADirectoryError):
+            reply=error_packet(NOT_FOUND,'File not found')
+        except OSError:
+            reply=error_packet(ACCESS_VIOLATION,'Access violation')
+        if reply is None:
+            options=self.negotiate(requested,len(entry[2]))
+            if options is None:
+                reply=error_packet(BAD_OPTIONS,'Bad options')
+                self.files.release(entry)
+        if reply is not None:
+            self.transport.sendto(reply,client)
+            if not self.quiet:
+                print(f'{client[0]} {filename}: {reply[4:-1].decode()}',flush=True)
+            return
+        self.active+=1
+        loop=asyncio.get_event_loop()
+        try:
+            await loop.create_datagram_endpoint(lambda: transfer(self,client,filename,path,entry,options),local_addr=(self.bind,0))
+        except OSError:
+            self.active-=1
+            self.files.release(entry)
+            raise
+    def record(self,t,error):
+        self.active-=1
+        seconds=time.time()-t.start
+        sent=len(t.data) if error is None else min(len(t.data),max(t.base-1,0)*t.blksize)
+        self.stats['transfers']+=1
+        self.stats['failed']+=error is not None
+        self.stats['bytes']+=sent
+        self.stats['retransmits']+=t.retransmits
+        record=dict(time=t.start,client=t.client[0],file=t.filename,path=t.path,bytes=sent,size=len(t.data),
+                    blksize=t.blksize,windowsize=t.windowsize,seconds=seconds,
+                    mib_per_second=sent/2**20/seconds if seconds>0 else 0,retransmits=t.retransmits,error=error)
+        if not self.quiet:
+            print(f"{t.client[0]} {t.filename}: {sent/2**20:.1f} MiB in {seconds:.2f} s ({record['mib_per_second']:.1f} MiB/s, blksize {t.blksize}, windowsize {t.windowsize}, {t.retransmits} retransmits){' '+error if error else ''}",flush=True)
+        if self.metrics:
+            with open(self.metrics,'a') as f:
+                f.write(json.dumps(record)+'\n')
+        self.files.release(t.entry)
+
+def serve(loop,root,bind='0.0.0.0',port=69,**settings):
+    # Starts the server on loop; returns it and its listening transport.
+    server=tftpserver(root,bind,**settings)
+    transport,_=loop.run_until_complete(loop.create_datagram_endpoint(lambda: server,local_addr=(bind,port)))
+    return server,transport
+
+if __name__=="__main__":
+    here=os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Serve the boot files of the published builds over TFTP.')
+    parser.add_argument('--root',default=here,help='NAS_IMAGE_PATH, with builds/ and mounts/ (default: the directory of this script)')
+    parser.add_argument('--bind',default='0.0.0.0',help='address to listen on')
+    parser.add_argument('--port',type=int,default=69)
+    parser.add_argument('--max-blksize',type=int,default=65464,help='largest block size granted')
+    parser.add_argument('--max-windowsize',type=int,default=64,help='largest window size granted')
+    parser.add_argument('--timeout',type=int,default=1,help='seconds before a window is resent, unless the client asks otherwise')
+    parser.add_argument('--retries',type=int,default=5,help='resends of a window before a transfer is abandoned')
+    parser.add_argument('--metrics',default=os.path.join(here,'tftp-metrics.jsonl'),help='JSON lines file the transfers are recorded in')
+    parser.add_argument('--quiet',action='store_true',help='do not print a line per transfer')
+    args = parser.parse_args()
+    loop=asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    serve(loop,args.root,args.bind,args.port,max_blksize=args.max_blksize,max_windowsize=args.max_windowsize,
+          timeout=args.timeout,retries=args.retries,metrics=args.metrics,quiet=args.quiet)
+    print(f'Serving {args.root} on {args.bind}:{args.port}',flush=True)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)